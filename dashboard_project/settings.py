@@ -87,6 +87,17 @@ DATABASES = {
 }
 
 
+# Cache
+# Senza CACHE_URL cache locale al processo: l'invalidazione resta esatta (la versione
+# del corpus è nel database), ma ogni worker Gunicorn calcola e tiene i propri risultati.
+# In produzione meglio un backend condiviso, es. CACHE_URL=redis://127.0.0.1:6379/1
+# (richiede il pacchetto redis)
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -128,6 +139,67 @@ STATIC_ROOT = env('STATIC_ROOT')
 # Configurazione per la cartella dei file di procedure
 PROCEDURE_FILES_DIR = BASE_DIR / 'procedure_files'
 
+# Indice full-text SQLite FTS5 per la ricerca (se disattivato si scansionano i file)
+PROCEDURE_SEARCH_INDEX = env.bool('PROCEDURE_SEARCH_INDEX', default=True)
+
+# Cartella dei sidecar con le procedure già parsate (vuoto per disattivarli)
+PROCEDURE_COMPILED_DIR = env('PROCEDURE_COMPILED_DIR', default=str(BASE_DIR / 'procedure_compiled'))
+
+# Cartella delle varianti precompresse (gzip/brotli/zstd) delle risposte sulle procedure (vuoto per disattivarle)
+PROCEDURE_COMPRESSED_DIR = env('PROCEDURE_COMPRESSED_DIR', default=str(BASE_DIR / 'procedure_compiled' / 'compressed'))
+
+# Invio dei file scaricati: 'python' (dal worker, con supporto Range) o 'x-accel'
+# (X-Accel-Redirect verso la location interna di nginx indicata dal prefisso)
+PROCEDURE_DOWNLOAD_MODE = env('PROCEDURE_DOWNLOAD_MODE', default='python')
+PROCEDURE_DOWNLOAD_ACCEL_PREFIX = env('PROCEDURE_DOWNLOAD_ACCEL_PREFIX', default='/protected/procedures/')
+
+# API /api/procedures/batch/: procedure per richiesta e dimensione totale massima dei file inclusi
+PROCEDURE_BATCH_MAX_IDS = env.int('PROCEDURE_BATCH_MAX_IDS', default=20)
+PROCEDURE_BATCH_MAX_BYTES = env.int('PROCEDURE_BATCH_MAX_BYTES', default=4 * 1024 * 1024)
+
+# Importazione di archivi: limiti sul numero di file e sui byte non compressi,
+# processi usati per il parsing (default: numero di CPU)
+PROCEDURE_IMPORT_MAX_FILES = env.int('PROCEDURE_IMPORT_MAX_FILES', default=1000)
+PROCEDURE_IMPORT_MAX_BYTES = env.int('PROCEDURE_IMPORT_MAX_BYTES', default=64 * 1024 * 1024)
+PROCEDURE_IMPORT_WORKERS = env.int('PROCEDURE_IMPORT_WORKERS', default=os.cpu_count() or 1)
+
+# Viste async (procedures/async_views.py) per contenuto, ricerca e download, da
+# attivare con il deploy ASGI (uvicorn); thread del pool per l'I/O sui file
+PROCEDURE_ASYNC_VIEWS = env.bool('PROCEDURE_ASYNC_VIEWS', default=False)
+PROCEDURE_ASYNC_IO_WORKERS = env.int('PROCEDURE_ASYNC_IO_WORKERS', default=8)
+
+# Eventi di modifica per l'aggiornamento della dashboard (api/events/): eventi
+# conservati, secondi tra due controlli nello stream async, secondi tra due
+# richieste del browser (riconnessione con WSGI o polling) e durata massima di
+# uno stream aperto con le viste async
+PROCEDURE_EVENTS_KEEP = env.int('PROCEDURE_EVENTS_KEEP', default=1000)
+PROCEDURE_EVENTS_POLL_INTERVAL = env.float('PROCEDURE_EVENTS_POLL_INTERVAL', default=3)
+PROCEDURE_EVENTS_RETRY = env.float('PROCEDURE_EVENTS_RETRY', default=10)
+PROCEDURE_EVENTS_STREAM_TIMEOUT = env.int('PROCEDURE_EVENTS_STREAM_TIMEOUT', default=300)
+
+# Dimensione massima (byte stimati) della cache per processo delle procedure parsate
+PROCEDURE_PARSE_CACHE_MAX_BYTES = env.int('PROCEDURE_PARSE_CACHE_MAX_BYTES', default=64 * 1024 * 1024)
+
+# Ricerca: pesi di rilevanza (BM25) per campo e paginazione dei risultati
+PROCEDURE_SEARCH_WEIGHTS = {
+    'name': 3.0,         # nome della categoria
+    'description': 1.5,  # descrizione della categoria
+    'title': 2.0,        # titolo della sezione
+    'desc': 1.0,         # descrizione della sezione
+    'label': 2.0,        # etichetta del comando
+    'cmd': 1.0,          # corpo del comando
+}
+PROCEDURE_SEARCH_DEFAULT_LIMIT = 20
+PROCEDURE_SEARCH_MAX_LIMIT = 100
+# Comandi evidenziati al massimo per ogni risultato
+PROCEDURE_SEARCH_MAX_COMMANDS = 20
+# Durata (secondi) dei risultati di ricerca in cache, invalidati comunque ad ogni modifica
+PROCEDURE_SEARCH_CACHE_TIMEOUT = env.int('PROCEDURE_SEARCH_CACHE_TIMEOUT', default=300)
+# Scansione dei file senza indice: thread per processo e tempo massimo (secondi) per richiesta,
+# oltre il quale si ritornano risultati parziali (truncated)
+PROCEDURE_SEARCH_WORKERS = env.int('PROCEDURE_SEARCH_WORKERS', default=4)
+PROCEDURE_SEARCH_DEADLINE = env.float('PROCEDURE_SEARCH_DEADLINE', default=5.0)
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
@@ -218,6 +218,7 @@ DEBUG=False
 SECRET_KEY=${SECRET_KEY}
 STATIC_ROOT=${PROJECT_PATH}/staticfiles
 STATIC_URL=/static/
+PROCEDURE_DOWNLOAD_MODE=x-accel
 EOF
 
 chown ${PROJECT_NAME}:${PROJECT_NAME} ${PROJECT_PATH}/.env
@@ -261,6 +262,10 @@ print_info "Impostazione permessi file statici..."
 chmod -R 755 ${PROJECT_PATH}/staticfiles
 chown -R ${PROJECT_NAME}:${PROJECT_NAME} ${PROJECT_PATH}/staticfiles
 
+print_info "Impostazione permessi file delle procedure (download serviti da Nginx)..."
+chmod 755 ${PROJECT_PATH}/procedure_files
+chmod 644 ${PROJECT_PATH}/procedure_files/*.txt
+
 # Verifica permessi
 print_info "Verifica accesso www-data ai file statici..."
 if sudo -u ${NGINX_USER} test -r ${PROJECT_PATH}/staticfiles/css/dashboard.css; then
@@ -296,6 +301,15 @@ server {
         add_header Cache-Control "public, immutable";
     }
     
+    # Download delle procedure: Django verifica i permessi e risponde con
+    # X-Accel-Redirect, Nginx invia il file (PROCEDURE_DOWNLOAD_MODE=x-accel)
+    location /protected/procedures/ {
+        internal;
+        alias ${PROJECT_PATH}/procedure_files/;
+        gzip on;
+        gzip_types text/plain;
+    }
+    
     # Tutte le altre richieste vanno a Gunicorn
     location / {
         proxy_pass http://${PROJECT_NAME};
@@ -0,0 +1,180 @@
+"""
+Controlli e parametri comuni alle API delle procedure, condivisi dalle viste
+sincrone (views.py) e da quelle async (async_views.py): le due varianti
+applicano così gli stessi permessi e rispondono con gli stessi errori.
+
+Le funzioni non fanno I/O sui file e le query sono lasciate al chiamante
+(queryset restituiti da visible_categories), che le esegue con l'API
+sincrona o async dell'ORM.
+"""
+import os
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import JsonResponse
+
+from .models import ProcedureCategory
+from .query import compile_query
+from . import conditional, events, search
+
+
+def sees_all_procedures(user):
+    """Admin e superuser vedono tutte le procedure"""
+    return user.is_superuser or (hasattr(user, 'profile') and user.profile.role == 'admin')
+
+
+def visible_categories(user):
+    """Categorie visibili all'utente: admin vede tutto, gli altri solo pubbliche o proprie"""
+    if sees_all_procedures(user):
+        return ProcedureCategory.objects.all()
+    return ProcedureCategory.objects.filter(
+        Q(is_public=True) | Q(owner=user)
+    ).distinct()
+
+
+def user_can_edit(user, category):
+    """L'utente può modificare se è admin o se è l'owner (editor)"""
+    return (
+        user.is_authenticated and
+        (user.profile.role == 'admin' or
+         (user.profile.role == 'editor' and category.owner_id == user.id))
+    )
+
+
+def procedure_file_path(filename):
+    return os.path.join(settings.PROCEDURE_FILES_DIR, filename)
+
+
+def is_inside_files_dir(file_path):
+    """Il percorso è nella cartella delle procedure (previene path traversal)"""
+    return os.path.abspath(file_path).startswith(str(settings.PROCEDURE_FILES_DIR))
+
+
+def file_error(file_path, exists):
+    """Risposta di errore se il file di procedura non esiste o è fuori dalla sua cartella, altrimenti None"""
+    if not exists:
+        return JsonResponse({'error': 'File non trovato'}, status=404)
+    if not is_inside_files_dir(file_path):
+        return JsonResponse({'error': 'Accesso negato'}, status=403)
+    return None
+
+
+def category_access(user, category):
+    """
+    (risposta di errore o None, can_edit) per la categoria del file, cercata
+    tra visible_categories(user): None se l'utente non può vederla.
+    """
+    if category is None:
+        return JsonResponse({'error': 'File non trovato'}, status=404), False
+    return None, user_can_edit(user, category)
+
+
+def procedure_file_access(user, filename):
+    """
+    Controlli comuni alle API di lettura di un file di procedura.
+    Ritorna (risposta di errore o None, can_edit).
+    """
+    file_path = procedure_file_path(filename)
+    error = file_error(file_path, os.path.exists(file_path))
+    if error:
+        return error, False
+    # Solo le procedure visibili all'utente, come nella dashboard
+    return category_access(user, visible_categories(user).filter(filename=filename).first())
+
+
+def procedure_validators(filename, can_edit, encoding, st=None):
+    """ETag e Last-Modified delle risposte JSON su un file di procedura (`st`: stat già letto)"""
+    if st is None:
+        st = os.stat(procedure_file_path(filename))
+    variant = 'edit' if can_edit else 'read'
+    if encoding:
+        variant = f'{variant}-{encoding}'
+    return conditional.file_validators(st, variant)
+
+
+def search_params(request):
+    """
+    Parametri della ricerca dalla query string.
+    Ritorna (risposta di errore o None, dict con query, compiled, limit, offset, highlight, fuzzy).
+    """
+    query = request.GET.get('q', '').strip()
+
+    if not query or len(query) < 2:
+        return JsonResponse({
+            'success': False,
+            'message': 'Query troppo corta (minimo 2 caratteri)'
+        }), None
+
+    # Compila la query una sola volta: termini, "frasi", !esclusioni, campo:termine
+    compiled = compile_query(query)
+    if compiled.is_empty():
+        return JsonResponse({
+            'success': False,
+            'message': 'Specifica almeno un termine da cercare (non solo esclusioni)'
+        }), None
+
+    # Evidenziazione: tag <mark> nel testo oppure offset dei match
+    highlight = request.GET.get('highlight', 'html')
+    if highlight not in search.HIGHLIGHT_MODES:
+        return JsonResponse({'error': 'Parametro highlight non valido (html o offsets)'}, status=400), None
+
+    # Ricerca fuzzy: auto (se non ci sono risultati esatti), 1 (sempre) o 0 (mai)
+    fuzzy = search.FUZZY_MODES.get(request.GET.get('fuzzy', 'auto').lower())
+    if fuzzy is None:
+        return JsonResponse({'error': 'Parametro fuzzy non valido (auto, 1 o 0)'}, status=400), None
+
+    # Paginazione
+    max_limit = getattr(settings, 'PROCEDURE_SEARCH_MAX_LIMIT', 100)
+    try:
+        limit = int(request.GET.get('limit', getattr(settings, 'PROCEDURE_SEARCH_DEFAULT_LIMIT', 20)))
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        return JsonResponse({'error': 'Parametri limit/offset non validi'}, status=400), None
+    if limit < 1 or offset < 0:
+        return JsonResponse({'error': 'Parametri limit/offset non validi'}, status=400), None
+    limit = min(limit, max_limit)
+
+    return None, {
+        'query': query,
+        'compiled': compiled,
+        'limit': limit,
+        'offset': offset,
+        'highlight': highlight,
+        'fuzzy': fuzzy
+    }
+
+
+def search_response(params, found):
+    """Risposta JSON della ricerca"""
+    return JsonResponse({
+        'success': True,
+        'query': params['query'],
+        'results': found['results'],
+        'total': found['total'],
+        'limit': params['limit'],
+        'offset': params['offset'],
+        'has_more': params['offset'] + len(found['results']) < found['total'],
+        'truncated': found['truncated'],
+        'fuzzy': found['fuzzy'],
+        'corrections': found['corrections']
+    })
+
+
+def events_since(request):
+    """
+    Versione da cui riprendere gli eventi: Last-Event-ID (riconnessione di
+    EventSource) o ?since=. None se assente; ValueError se non valida.
+    """
+    value = request.headers.get('Last-Event-ID') or request.GET.get('since')
+    return events.parse_version(value) if value else None
+
+
+def wants_event_stream(request):
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+
+def event_stream_headers(response):
+    response['Cache-Control'] = 'no-cache'
+    # nginx non deve bufferizzare lo stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
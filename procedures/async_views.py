@@ -0,0 +1,336 @@
+"""
+Varianti async (ASGI) delle API legate ai file di procedura (contenuto,
+ricerca e download) e dello stream degli eventi. Sono usate al posto di
+quelle di views.py se PROCEDURE_ASYNC_VIEWS è attivo (deploy con uvicorn,
+vedi README).
+
+Le risposte sono identiche a quelle delle viste sincrone. L'event loop non
+esegue mai I/O bloccante:
+- le query usano l'API async dell'ORM (aget, aexists, async for);
+- letture, stat, parsing e compressione dei file girano in un pool di
+  thread limitato a PROCEDURE_ASYNC_IO_WORKERS, così un picco di richieste
+  non apre più file di quanti il disco ne serva in modo utile;
+- i download sono inviati a blocchi da un iteratore async;
+- lo stream degli eventi resta aperto e controlla i nuovi eventi con
+  asyncio.sleep tra una query e l'altra, senza occupare thread.
+La ricerca legge la cache dei risultati in modo async; in caso di miss la
+ricerca vera e propria (indice FTS5 e scansione dei file) gira con
+sync_to_async, perché esegue query SQL dirette.
+"""
+import asyncio
+import mimetypes
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+from . import api, conditional, corpus, downloads, events, precompressed, search
+from .api import visible_categories
+from .decorators import ajax_login_required
+from .models import ProcedureCategory, UserProfile
+from .parsing import sections_to_dicts
+from .procedure_cache import parsed_procedures
+
+_io_executor = None
+_io_executor_lock = threading.Lock()
+
+
+def get_io_executor():
+    """Pool di thread condiviso dal processo per l'I/O sui file delle viste async"""
+    global _io_executor
+    if _io_executor is None:
+        with _io_executor_lock:
+            if _io_executor is None:
+                _io_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'PROCEDURE_ASYNC_IO_WORKERS', 8),
+                    thread_name_prefix='procedure-io'
+                )
+    return _io_executor
+
+
+async def _run_io(func, *args):
+    """Esegue func(*args) nel pool di I/O"""
+    return await asyncio.get_running_loop().run_in_executor(get_io_executor(), func, *args)
+
+
+async def _request_user(request):
+    """Utente della richiesta con il profilo già caricato (request.user non è usabile nelle viste async)"""
+    user = await request.auser()
+    if user.is_authenticated:
+        try:
+            user.profile = await UserProfile.objects.aget(user_id=user.pk)
+        except UserProfile.DoesNotExist:
+            # Profilo assente in cache: hasattr(user, 'profile') è False senza nuove query
+            type(user)._meta.get_field('profile').set_cached_value(user, None)
+    return user
+
+
+def _stat_or_none(file_path):
+    try:
+        return os.stat(file_path)
+    except OSError:
+        return None
+
+
+async def _procedure_file_access(user, filename):
+    """
+    Come api.procedure_file_access, con una sola stat che serve anche per i
+    validatori. Ritorna (risposta di errore o None, can_edit, stat del file).
+    """
+    file_path = api.procedure_file_path(filename)
+    st = await _run_io(_stat_or_none, file_path)
+    error = api.file_error(file_path, st is not None)
+    if error:
+        return error, False, None
+
+    # Solo le procedure visibili all'utente, come nella dashboard
+    category = await visible_categories(user).filter(filename=filename).afirst()
+    error, can_edit = api.category_access(user, category)
+    return error, can_edit, st
+
+
+def _content_response(filename, can_edit, encoding, etag, last_modified):
+    """Risposta JSON completa di get_procedure_content (parsing, serializzazione e compressione)"""
+    sections = parsed_procedures.get(filename)
+    response = conditional.set_validators(JsonResponse({
+        'success': True,
+        'sections': sections_to_dicts(sections),
+        'can_edit': can_edit
+    }), etag, last_modified)
+    return precompressed.compress_response(response, filename, encoding)
+
+
+@ajax_login_required
+async def get_procedure_content(request, filename):
+    """API per ottenere il contenuto di un file di procedura"""
+    try:
+        user = await _request_user(request)
+        error, can_edit, st = await _procedure_file_access(user, filename)
+        if error:
+            return error
+
+        # Se il client ha già questa versione si risponde 304 senza parsare il file
+        encoding = precompressed.negotiate(request)
+        etag, last_modified = api.procedure_validators(filename, can_edit, encoding, st)
+        response = conditional.not_modified(request, etag, last_modified, vary=('Accept-Encoding',))
+        if response is not None:
+            return response
+
+        return await _run_io(_content_response, filename, can_edit, encoding, etag, last_modified)
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+@ajax_login_required
+async def search_procedures(request):
+    """API per ricerca full-text nelle procedure, con risultati ordinati per rilevanza e paginati"""
+    try:
+        error, params = api.search_params(request)
+        if error:
+            return error
+
+        user = await _request_user(request)
+        categories = visible_categories(user)
+
+        # Stessa chiave di search.cached_search, calcolata con l'API async di ORM e cache
+        visible_ids = [category_id async for category_id in categories.values_list('id', flat=True)]
+        key = search.result_cache_key(
+            params['compiled'], visible_ids, params['limit'], params['offset'],
+            params['highlight'], params['fuzzy'], version=await corpus.aget_version()
+        )
+        found = await cache.aget(key)
+        if found is None:
+            visible = [category async for category in categories.select_related('owner')]
+            found = await sync_to_async(search.run_search)(
+                visible, params['compiled'], params['limit'], params['offset'],
+                params['highlight'], params['fuzzy']
+            )
+            if not found['truncated']:
+                await cache.aset(key, found, search.result_cache_timeout())
+
+        return api.search_response(params, found)
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+async def _read_chunks(f, start, length):
+    """Iteratore async dei byte [start, start + length) del file aperto f, letti nel pool di I/O"""
+    try:
+        await _run_io(f.seek, start)
+        while length > 0:
+            chunk = await _run_io(f.read, min(downloads.CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await _run_io(f.close)
+
+
+def _open_with_stat(file_path):
+    f = open(file_path, 'rb')
+    return f, os.fstat(f.fileno())
+
+
+@ajax_login_required
+async def download_procedure_file(request, category_id):
+    """
+    API per scaricare il file di procedura. Il file è inviato dall'event loop
+    a blocchi (con supporto Range) o, con PROCEDURE_DOWNLOAD_MODE='x-accel', da nginx.
+    """
+    try:
+        user = await _request_user(request)
+        category = await ProcedureCategory.objects.aget(id=category_id)
+        file_path = api.procedure_file_path(category.filename)
+
+        # Verifica permessi: stesse procedure visibili nella dashboard
+        if not await visible_categories(user).filter(id=category.id).aexists():
+            raise Http404("Categoria non trovata")
+
+        # Verifica che il file esista
+        if not await _run_io(os.path.exists, file_path):
+            raise Http404("File non trovato")
+
+        # Verifica sicurezza path
+        if not api.is_inside_files_dir(file_path):
+            raise Http404("Accesso negato")
+
+        # Determina il mime type
+        mime_type, _ = mimetypes.guess_type(file_path)
+        if mime_type is None:
+            mime_type = 'text/plain'
+
+        if downloads.mode() == 'x-accel':
+            # nginx invia il file (validatori, Range e compressione compresi)
+            response = downloads.accel_response(category.filename, mime_type)
+            response['Content-Disposition'] = f'attachment; filename="{category.filename}"'
+            response['Cache-Control'] = 'private, no-cache'
+            return response
+
+        file_handle, st = await _run_io(_open_with_stat, file_path)
+
+        # Se il client ha già questa versione del file si risponde 304 senza inviarlo.
+        # Le richieste Range si riferiscono sempre al file non compresso.
+        range_header = request.headers.get('Range')
+        encoding = None if range_header else precompressed.negotiate(request)
+        etag, last_modified = conditional.file_validators(st, encoding or '')
+        response = conditional.not_modified(request, etag, last_modified, vary=('Accept-Encoding',))
+        if response is not None:
+            await _run_io(file_handle.close)
+            return response
+
+        byte_range = None
+        if range_header and downloads.if_range_matches(request, etag, last_modified):
+            byte_range = downloads.parse_range(range_header, st.st_size)
+
+        if byte_range is False:
+            await _run_io(file_handle.close)
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{st.st_size}'
+        elif byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(
+                _read_chunks(file_handle, start, length), status=206, content_type=mime_type
+            )
+            response['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+            response['Content-Length'] = str(length)
+        else:
+            # Variante precompressa del file, se il client la accetta
+            compressed_path = await _run_io(precompressed.file_variant, category.filename, file_handle, st, encoding)
+            length = st.st_size
+            compressed = await _run_io(precompressed.open_variant, compressed_path) if compressed_path else None
+            if compressed:
+                await _run_io(file_handle.close)
+                file_handle, compressed_st = compressed
+                length = compressed_st.st_size
+
+            response = StreamingHttpResponse(_read_chunks(file_handle, 0, length), content_type=mime_type)
+            response['Content-Length'] = str(length)
+            if compressed:
+                response['Content-Encoding'] = encoding
+
+        response['Content-Disposition'] = f'attachment; filename="{category.filename}"'
+        response['Accept-Ranges'] = 'bytes'
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        return conditional.set_validators(response, etag, last_modified)
+
+    except ProcedureCategory.DoesNotExist:
+        raise Http404("Categoria non trovata")
+    except Http404:
+        raise
+    except Exception as e:
+        raise Http404(f"Errore: {str(e)}")
+
+
+async def _event_stream(user, since):
+    """
+    Stream SSE: eventi in attesa, poi i nuovi ogni events.poll_interval()
+    secondi, con un commento di heartbeat per i proxy. Si chiude dopo
+    PROCEDURE_EVENTS_STREAM_TIMEOUT secondi: EventSource si riconnette dopo
+    events.retry_interval() secondi riprendendo da Last-Event-ID.
+    """
+    loop = asyncio.get_running_loop()
+    interval = events.poll_interval()
+    deadline = loop.time() + events.stream_timeout()
+    heartbeat = loop.time() + events.HEARTBEAT_INTERVAL
+    categories = visible_categories(user)
+
+    yield f'retry: {int(events.retry_interval() * 1000)}\n\n'
+    if since is None:
+        since = await events.alatest_version()
+        yield f'id: {since}\n\n'
+
+    while True:
+        batch = await events.apending(user, categories, since)
+        chunk = events.sse(batch, since)
+        if chunk:
+            yield chunk
+            heartbeat = loop.time() + events.HEARTBEAT_INTERVAL
+        if batch['reset']:
+            return
+        since = batch['version']
+        if batch['has_more']:
+            continue
+        if loop.time() >= deadline:
+            return
+        await asyncio.sleep(interval)
+        if loop.time() >= heartbeat:
+            yield ': ping\n\n'
+            heartbeat = loop.time() + events.HEARTBEAT_INTERVAL
+
+
+@ajax_login_required
+async def procedure_events(request):
+    """
+    API degli eventi di modifica delle procedure, come views.procedure_events;
+    lo stream SSE resta aperto e invia gli eventi appena vengono registrati.
+    """
+    try:
+        since = api.events_since(request)
+    except ValueError:
+        return JsonResponse({'error': 'Versione non valida'}, status=400)
+
+    try:
+        user = await _request_user(request)
+        if api.wants_event_stream(request):
+            return api.event_stream_headers(
+                StreamingHttpResponse(_event_stream(user, since), content_type='text/event-stream')
+            )
+
+        if since is None:
+            batch = {'version': await events.alatest_version(), 'events': [], 'reset': False, 'has_more': False}
+        else:
+            batch = await events.apending(user, visible_categories(user), since)
+        return JsonResponse({'success': True, **batch})
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
@@ -0,0 +1,429 @@
+"""
+Benchmark delle parti critiche del parsing e della ricerca delle procedure.
+
+Ogni suite è una funzione registrata con @suite che riceve la dimensione del
+corpus sintetico e ritorna una lista di righe (metrica, valore, unità).
+Si eseguono con: python manage.py benchmark [suite ...] [--size N]
+"""
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from django.test.utils import override_settings
+
+from .parsing import iter_procedure, parse_procedure_lines, SECTION
+
+SUITES = {}
+
+# Vocabolario del corpus sintetico: etichette e titoli si ripetono tra le procedure,
+# come nei runbook reali
+_LABELS = [
+    'Lista container attivi', 'Riavvia servizio', 'Stato servizio', 'Log in tempo reale',
+    'Verifica spazio disco', 'Backup database', 'Aggiorna pacchetti', 'Controlla porte in ascolto',
+]
+_TITLES = ['Comandi Base', 'Gestione Servizi', 'Manutenzione', 'Diagnostica', 'Rete']
+_WORDS = ['docker', 'systemctl', 'restart', 'nginx', '--force', '-a', 'grep', 'tail', '/var/log', 'sudo']
+
+
+def suite(name):
+    """Registra una suite di benchmark"""
+    def register(func):
+        SUITES[name] = func
+        return func
+    return register
+
+
+def synthetic_procedure(rng, sections=5, commands=8):
+    """Testo di una procedura sintetica nel formato [SEZIONE] / COMANDO:"""
+    lines = []
+    for s in range(sections):
+        lines.append(f'[{rng.choice(_TITLES)} {s}]')
+        lines.append(' '.join(rng.choices(_WORDS, k=6)))
+        lines.append('')
+        for _ in range(commands):
+            lines.append(f'COMANDO: {rng.choice(_LABELS)}')
+            for _ in range(rng.randint(1, 3)):
+                lines.append(' '.join(rng.choices(_WORDS, k=rng.randint(2, 6))))
+            lines.append('')
+    return '\n'.join(lines)
+
+
+def synthetic_corpus(size, seed=0):
+    """Lista di `size` procedure sintetiche (come liste di righe)"""
+    rng = random.Random(seed)
+    return [synthetic_procedure(rng).split('\n') for _ in range(size)]
+
+
+def _parse_as_dicts(lines):
+    """Rappresentazione precedente: liste di dict {'title','desc','commands':[{'label','cmd'}]}"""
+    sections = []
+    for kind, first, second, _, _ in iter_procedure(lines):
+        if kind == SECTION:
+            sections.append({'title': first, 'desc': second, 'commands': []})
+        else:
+            sections[-1]['commands'].append({'label': first, 'cmd': second})
+    return sections
+
+
+def _retained_bytes(build):
+    """Byte ancora allocati dopo build() (cioè occupati dal risultato)"""
+    tracemalloc.start()
+    try:
+        result = build()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, retained
+
+
+@suite('memory')
+def memory_suite(size):
+    """Memoria per comando delle procedure parsate: dict annidati contro Section/Command"""
+    corpus = synthetic_corpus(size)
+
+    dicts, dict_bytes = _retained_bytes(lambda: [_parse_as_dicts(lines) for lines in corpus])
+    commands = sum(len(section['commands']) for sections in dicts for section in sections)
+    del dicts
+
+    compact, compact_bytes = _retained_bytes(lambda: [parse_procedure_lines(lines) for lines in corpus])
+    del compact
+
+    return [
+        ('procedure', size, ''),
+        ('comandi', commands, ''),
+        ('dict: byte per comando', round(dict_bytes / commands, 1), 'B'),
+        ('Section/Command: byte per comando', round(compact_bytes / commands, 1), 'B'),
+        ('riduzione', round(100 * (1 - compact_bytes / dict_bytes), 1), '%'),
+    ]
+
+
+def _legacy_update_command(file_path, section_name, command_label, new_command):
+    """Algoritmo precedente di update_single_command: readlines() + pop() + riscrittura in place"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    current_section = None
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        if line.startswith('[') and line.endswith(']'):
+            current_section = line[1:-1].strip()
+        if current_section == section_name and line.startswith('COMANDO:'):
+            if line.replace('COMANDO:', '').strip() == command_label:
+                i += 1
+                while i < len(lines) and not lines[i].strip().startswith('COMANDO:') and not lines[i].strip().startswith('['):
+                    lines.pop(i)
+                lines.insert(i, new_command + '\n')
+                if i + 1 < len(lines) and lines[i + 1].strip() != '':
+                    lines.insert(i + 1, '\n')
+                break
+        i += 1
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.writelines(lines)
+
+
+def _timed(func, repeat=3):
+    """Tempo medio in millisecondi"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+@suite('patch')
+def patch_suite(size):
+    """Modifica di un comando lungo in un file con migliaia di comandi: readlines/pop contro patch atomica"""
+    from . import patching
+    from .compiled import parse_file
+
+    rng = random.Random(0)
+    commands = size * 20
+    body_lines = size * 10
+    lines = ['[Runbook]', 'Procedura sintetica', '']
+    for n in range(commands):
+        lines.append(f'COMANDO: Passo {n}')
+        count = body_lines if n == commands // 2 else rng.randint(1, 3)
+        lines.extend(' '.join(rng.choices(_WORDS, k=5)) for _ in range(count))
+        lines.append('')
+    content = '\n'.join(lines) + '\n'
+    target = f'Passo {commands // 2}'
+    new_body = '\n'.join(' '.join(rng.choices(_WORDS, k=5)) for _ in range(body_lines))
+
+    files_dir = tempfile.mkdtemp()
+    compiled_dir = tempfile.mkdtemp()
+    file_path = os.path.join(files_dir, 'runbook.txt')
+    try:
+        def reset():
+            with open(file_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+
+        reset()
+        legacy_ms = _timed(lambda: (reset(), _legacy_update_command(file_path, 'Runbook', target, new_body)))
+        reset_ms = _timed(reset)
+        # Con la vecchia scrittura il file modificato andava poi ri-parsato da cache e indici
+        reparse_ms = _timed(lambda: parse_file(file_path))
+
+        with override_settings(PROCEDURE_FILES_DIR=files_dir, PROCEDURE_COMPILED_DIR=compiled_dir):
+            reset()
+            # Prima modifica: include la costruzione dell'indice delle posizioni
+            cold_ms = _timed(lambda: patching.replace_command('runbook.txt', 'Runbook', target, new_body), repeat=1)
+            # Successive: indice già noto (aggiornato dalla modifica precedente)
+            warm_ms = _timed(lambda: patching.replace_command('runbook.txt', 'Runbook', target, new_body))
+    finally:
+        shutil.rmtree(files_dir, ignore_errors=True)
+        shutil.rmtree(compiled_dir, ignore_errors=True)
+
+    return [
+        ('comandi nel file', commands, ''),
+        ('righe del comando modificato', body_lines, ''),
+        ('dimensione file', round(len(content.encode()) / 1024), 'KiB'),
+        ('readlines/pop (precedente)', round(legacy_ms - reset_ms, 1), 'ms'),
+        ('readlines/pop + nuovo parsing', round(legacy_ms - reset_ms + reparse_ms, 1), 'ms'),
+        ('patch atomica, indice da costruire', round(cold_ms, 1), 'ms'),
+        ('patch atomica, indice in cache', round(warm_ms, 1), 'ms'),
+    ]
+
+
+def _legacy_convert_html(html_content):
+    """Conversione HTML precedente: classe ridefinita a ogni chiamata e concatenazione con +="""
+    from html.parser import HTMLParser
+
+    class ProcedureHTMLParser(HTMLParser):
+        def __init__(self):
+            super().__init__()
+            self.sections = []
+            self.current_section = None
+            self.current_command = None
+            self.in_section_title = False
+            self.in_section_desc = False
+            self.in_command_label = False
+            self.in_command_code = False
+            self.text_buffer = []
+
+        def handle_starttag(self, tag, attrs):
+            attrs_dict = dict(attrs)
+
+            if tag == 'h2':
+                self.in_section_title = True
+                if self.current_section:
+                    self.sections.append(self.current_section)
+                self.current_section = {'title': '', 'desc': '', 'commands': []}
+            elif tag == 'p' and self.current_section and not self.current_section['desc']:
+                self.in_section_desc = True
+            elif tag == 'h3':
+                self.in_command_label = True
+                self.current_command = {'label': '', 'cmd': ''}
+            elif tag == 'pre' or tag == 'code':
+                self.in_command_code = True
+
+        def handle_endtag(self, tag):
+            if tag == 'h2':
+                self.in_section_title = False
+            elif tag == 'p':
+                self.in_section_desc = False
+            elif tag == 'h3':
+                self.in_command_label = False
+            elif tag == 'pre' or tag == 'code':
+                self.in_command_code = False
+                if self.current_command and self.current_section:
+                    self.current_section['commands'].append(self.current_command)
+                    self.current_command = None
+
+        def handle_data(self, data):
+            data = data.strip()
+            if not data:
+                return
+
+            if self.in_section_title and self.current_section is not None:
+                self.current_section['title'] += data
+            elif self.in_section_desc and self.current_section is not None:
+                self.current_section['desc'] += data
+            elif self.in_command_label and self.current_command is not None:
+                self.current_command['label'] += data
+            elif self.in_command_code and self.current_command is not None:
+                self.current_command['cmd'] += data
+
+    parser = ProcedureHTMLParser()
+    parser.feed(html_content)
+
+    # Aggiungi l'ultima sezione
+    if parser.current_section:
+        parser.sections.append(parser.current_section)
+
+    # Genera formato .txt
+    txt_lines = []
+    for section in parser.sections:
+        txt_lines.append(f"[{section['title']}]")
+        txt_lines.append(section['desc'])
+        txt_lines.append('')
+
+        for cmd in section['commands']:
+            txt_lines.append(f"COMANDO: {cmd['label']}")
+            txt_lines.append(cmd['cmd'])
+            txt_lines.append('')
+
+    return '\n'.join(txt_lines)
+
+
+def synthetic_editor_html(rng, sections, commands=8, tokens=20):
+    """
+    HTML come quello dell'editor visuale: ogni comando è un <pre> con la
+    sintassi evidenziata, cioè spezzato in molti <span>
+    """
+    parts = []
+    for s in range(sections):
+        parts.append(f'<h2>{rng.choice(_TITLES)} {s}</h2><p>{" ".join(rng.choices(_WORDS, k=6))}</p>')
+        for _ in range(commands):
+            parts.append(f'<h3>{rng.choice(_LABELS)}</h3><pre class="ql-syntax">')
+            parts.extend(f'<span class="hljs-built_in">{word}</span> ' for word in rng.choices(_WORDS, k=tokens))
+            parts.append('</pre>')
+    return ''.join(parts)
+
+
+@suite('html')
+def html_suite(size):
+    """Conversione HTML dell'editor in formato procedura: conversione precedente contro html_format"""
+    from .html_format import convert_html_to_procedure_format
+
+    rng = random.Random(0)
+    payloads = [
+        (f'{sections} sezioni', synthetic_editor_html(rng, sections))
+        for sections in (max(size // 20, 1), max(size // 4, 1), size)
+    ]
+    # Un singolo comando incollato molto lungo: caso peggiore della concatenazione con +=
+    payloads.append((f'1 comando da {size * 250} nodi', synthetic_editor_html(rng, 1, commands=1, tokens=size * 250)))
+
+    rows = []
+    for name, html in payloads:
+        if _legacy_convert_html(html) != convert_html_to_procedure_format(html):
+            raise AssertionError(f'Output diverso dalla conversione precedente ({name})')
+        megabytes = len(html.encode('utf-8')) / 1024 / 1024
+        legacy_ms = _timed(lambda: _legacy_convert_html(html), repeat=1)
+        new_ms = _timed(lambda: convert_html_to_procedure_format(html), repeat=1)
+        rows.append((f'{name}: dimensione', round(megabytes, 2), 'MiB'))
+        rows.append((f'{name}: precedente', round(megabytes / legacy_ms * 1000, 2), 'MiB/s'))
+        rows.append((f'{name}: html_format', round(megabytes / new_ms * 1000, 2), 'MiB/s'))
+    return rows
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+@suite('asgi')
+def asgi_suite(size):
+    """Richieste concorrenti (contenuto, ricerca, download): viste sincrone con 3 worker WSGI contro viste async"""
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    from asgiref.sync import ThreadSensitiveContext
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import AsyncRequestFactory, RequestFactory
+    from django.test.utils import setup_databases, teardown_databases
+
+    from . import async_views, search_index, views
+    from .models import ProcedureCategory
+
+    wsgi_workers = 3
+    asgi_concurrency = 50
+    rng = random.Random(0)
+    files_dir = tempfile.mkdtemp()
+    compiled_dir = tempfile.mkdtemp()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        with override_settings(PROCEDURE_FILES_DIR=files_dir, PROCEDURE_COMPILED_DIR=compiled_dir,
+                               PROCEDURE_COMPRESSED_DIR=''):
+            for n in range(size):
+                with open(os.path.join(files_dir, f'proc{n}.txt'), 'w', encoding='utf-8') as f:
+                    f.write(synthetic_procedure(rng))
+            # bulk_create non invia i segnali: l'indice full-text viene costruito una volta sola
+            ProcedureCategory.objects.bulk_create(
+                ProcedureCategory(name=f'Procedura {n}', icon='📄', description='', filename=f'proc{n}.txt', order=n)
+                for n in range(size)
+            )
+            search_index.rebuild_index()
+            user = User.objects.create_user('benchmark', password='benchmark')
+            ids = list(ProcedureCategory.objects.values_list('id', flat=True))
+
+            requests = []
+            for n in range(size * 3):
+                kind = n % 3
+                if kind == 0:
+                    filename = f'proc{rng.randrange(size)}.txt'
+                    requests.append((f'/api/procedure/{filename}/', 'get_procedure_content', (filename,)))
+                elif kind == 1:
+                    requests.append((f'/api/search/?q={rng.choice(_WORDS[:6])}', 'search_procedures', ()))
+                else:
+                    category_id = rng.choice(ids)
+                    requests.append((f'/api/category/{category_id}/download/', 'download_procedure_file', (category_id,)))
+
+            def wsgi_request(item, client_delay):
+                path, view, args = item
+                request = RequestFactory().get(path)
+                request.user = user
+                response = getattr(views, view)(request, *args)
+                # Il worker resta occupato finché il client non ha ricevuto ogni blocco
+                for _ in (response.streaming_content if response.streaming else [response.content]):
+                    time.sleep(client_delay)
+                response.close()
+                return time.perf_counter()
+
+            async def asgi_request(semaphore, item, client_delay):
+                path, view, args = item
+                # Come ASGIHandler: ogni richiesta ha il suo thread per le chiamate sync_to_async
+                async with semaphore, ThreadSensitiveContext():
+                    request = AsyncRequestFactory().get(path)
+                    request.user = user
+
+                    async def auser():
+                        return user
+
+                    request.auser = auser
+                    response = await getattr(async_views, view)(request, *args)
+                    if response.streaming:
+                        async for _ in response.streaming_content:
+                            await asyncio.sleep(client_delay)
+                    else:
+                        await asyncio.sleep(client_delay)
+                    return time.perf_counter()
+
+            async def asgi_run(client_delay):
+                semaphore = asyncio.Semaphore(asgi_concurrency)
+                return await asyncio.gather(*(asgi_request(semaphore, item, client_delay) for item in requests))
+
+            # Primo giro per popolare cache delle procedure parsate e dei risultati di ricerca
+            for item in requests[:size]:
+                wsgi_request(item, 0)
+
+            rows = [('richieste per scenario', len(requests), '')]
+            # File in page cache e client veloci; client lenti (es. rete mobile): 20 ms per invio
+            for scenario, client_delay in (('client veloci', 0), ('client lenti', 0.02)):
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=wsgi_workers) as executor:
+                    wsgi_done = list(executor.map(lambda item: wsgi_request(item, client_delay), requests))
+                wsgi_seconds = time.perf_counter() - start
+                # Tutte le richieste arrivano insieme: il tempo di risposta include l'attesa di un worker
+                wsgi_latencies = [done - start for done in wsgi_done]
+
+                start = time.perf_counter()
+                asgi_done = asyncio.run(asgi_run(client_delay))
+                asgi_seconds = time.perf_counter() - start
+                asgi_latencies = [done - start for done in asgi_done]
+
+                rows += [
+                    (f'{scenario}: WSGI ({wsgi_workers} worker)', round(len(requests) / wsgi_seconds, 1), 'req/s'),
+                    (f'{scenario}: WSGI tempo di risposta p95', round(_percentile(wsgi_latencies, 0.95) * 1000, 1), 'ms'),
+                    (f'{scenario}: ASGI ({asgi_concurrency} in parallelo)', round(len(requests) / asgi_seconds, 1), 'req/s'),
+                    (f'{scenario}: ASGI tempo di risposta p95', round(_percentile(asgi_latencies, 0.95) * 1000, 1), 'ms'),
+                ]
+    finally:
+        connection.close()
+        teardown_databases(old_config, verbosity=0)
+        shutil.rmtree(files_dir, ignore_errors=True)
+        shutil.rmtree(compiled_dir, ignore_errors=True)
+
+    return rows
@@ -0,0 +1,208 @@
+"""
+Forma compilata delle procedure (sidecar).
+
+Per ogni file di procedura viene salvato in PROCEDURE_COMPILED_DIR un JSON con
+le sezioni già parsate, le posizioni in byte di sezioni e comandi (vedi
+offsets.py), l'hash SHA-256 del contenuto e lo stamp (st_mtime_ns, st_size)
+del file al momento della compilazione. Sezioni e posizioni sono calcolate in
+un solo passaggio sul file, una volta per versione del contenuto. Alla lettura:
+- stamp uguale: il sidecar viene caricato senza leggere il file;
+- stamp diverso ma stesso hash (es. file solo "toccato"): il sidecar è ancora
+  valido e viene aggiornato con il nuovo stamp;
+- hash diverso o sidecar assente/illeggibile: il file viene parsato e il
+  sidecar rigenerato.
+Le scritture dalla dashboard rigenerano il sidecar tramite i segnali, così un
+worker appena avviato non deve ri-parsare il corpus.
+"""
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+from django.conf import settings
+
+from .parsing import Command, CommandSpan, Section, SectionSpan, parse_procedure_with_offsets
+
+# Da incrementare quando cambia il formato del sidecar o la semantica del parser
+FORMAT_VERSION = 2
+
+
+def _compiled_dir():
+    return getattr(settings, 'PROCEDURE_COMPILED_DIR', None)
+
+
+def enabled():
+    return bool(_compiled_dir())
+
+
+def sidecar_path(filename):
+    return os.path.join(_compiled_dir(), f'{filename}.json')
+
+
+def source_path(filename):
+    return os.path.join(settings.PROCEDURE_FILES_DIR, filename)
+
+
+def file_hash(file_path):
+    """SHA-256 del contenuto del file, letto a blocchi"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_file(file_path):
+    """Sezioni e posizioni in byte di un file di procedura (un solo passaggio)"""
+    # Parsing in streaming: il file non viene mai caricato per intero in memoria
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        return parse_procedure_with_offsets(f, os.fstat(f.fileno()).st_size)
+
+
+def parse_content(data):
+    """
+    Sezioni, posizioni e SHA-256 di un contenuto in byte.
+    Solleva UnicodeDecodeError se il contenuto non è UTF-8.
+    """
+    text = data.decode('utf-8')
+    sections, spans = parse_procedure_with_offsets(io.StringIO(text, newline=''), len(data))
+    return sections, spans, hashlib.sha256(data).hexdigest()
+
+
+def compile_content(data):
+    """
+    Come parse_content, ma ritorna la forma compilata (vedi _encode) al posto
+    di sezioni e posizioni: usa solo tipi semplici in ingresso e in uscita,
+    così può essere eseguita in un processo separato (vedi importing.py).
+    """
+    sections, spans, digest = parse_content(data)
+    return _encode(sections, spans), digest
+
+
+def decode(data):
+    """Sezioni e posizioni dalla forma compilata prodotta da compile_content"""
+    return _decode(data)
+
+
+def _encode(sections, spans):
+    return [
+        [
+            section.title, section.desc, span.start, span.end,
+            [[cmd.label, cmd.cmd, cmd_span.start, cmd_span.end]
+             for cmd, cmd_span in zip(section.commands, span.commands)]
+        ]
+        for section, span in zip(sections, spans)
+    ]
+
+
+def _decode(data):
+    sections = []
+    spans = []
+    for title, desc, start, end, commands in data:
+        section = Section(title, desc, tuple(Command(label, cmd) for label, cmd, _, _ in commands))
+        sections.append(section)
+        spans.append(SectionSpan(section.title, desc, start, end, tuple(
+            CommandSpan(cmd.label, cmd_start, cmd_end)
+            for cmd, (_, _, cmd_start, cmd_end) in zip(section.commands, commands)
+        )))
+    return sections, spans
+
+
+def _read(filename):
+    try:
+        with open(sidecar_path(filename), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != FORMAT_VERSION:
+        return None
+    return data
+
+
+def write(filename, sections, spans, digest, stamp):
+    """Salva il sidecar in modo atomico; gli errori di scrittura vengono ignorati"""
+    directory = _compiled_dir()
+    if not directory:
+        return
+    data = {
+        'version': FORMAT_VERSION,
+        'sha256': digest,
+        'stamp': list(stamp),
+        'sections': _encode(sections, spans),
+    }
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                # json.dumps usa l'encoder C, json.dump no
+                f.write(json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+            os.replace(tmp_path, sidecar_path(filename))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        # Cartella non scrivibile: si continua a parsare i file
+        pass
+
+
+def load(filename, stamp):
+    """
+    Sezioni e posizioni del file dal sidecar, se ancora valido per lo stamp indicato.
+    Ritorna (sezioni, posizioni, parsed): parsed è True se il file è stato ri-parsato.
+    Solleva FileNotFoundError se il file non esiste.
+    """
+    file_path = source_path(filename)
+    if not _compiled_dir():
+        return parse_file(file_path) + (True,)
+
+    data = _read(filename)
+    if data is not None and tuple(data['stamp']) == tuple(stamp):
+        return _decode(data['sections']) + (False,)
+    return _refresh(filename, stamp, data)
+
+
+def _refresh(filename, stamp, data):
+    """
+    Come load quando lo stamp del sidecar già letto (`data`, None se assente)
+    non corrisponde: confronta l'hash e rigenera il sidecar.
+    """
+    file_path = source_path(filename)
+    digest = file_hash(file_path)
+    if data is not None and data['sha256'] == digest:
+        sections, spans = _decode(data['sections'])
+        write(filename, sections, spans, digest, stamp)
+        return sections, spans, False
+
+    sections, spans = parse_file(file_path)
+    write(filename, sections, spans, digest, stamp)
+    return sections, spans, True
+
+
+def compile_procedure(filename):
+    """Rigenera il sidecar di un file (dopo una scrittura)"""
+    if not _compiled_dir():
+        return
+    file_path = source_path(filename)
+    try:
+        st = os.stat(file_path)
+        # Sidecar già scritto per questa versione (es. dopo un'importazione): non serve decodificarlo
+        data = _read(filename)
+        if data is not None and tuple(data['stamp']) == (st.st_mtime_ns, st.st_size):
+            return
+        # Se il contenuto non è cambiato (es. modifica dei soli metadati) non si
+        # ri-parsa; il sidecar già letto non viene riletto
+        _refresh(filename, (st.st_mtime_ns, st.st_size), data)
+    except (OSError, UnicodeDecodeError):
+        remove(filename)
+
+
+def remove(filename):
+    """Elimina il sidecar di un file"""
+    if not _compiled_dir():
+        return
+    try:
+        os.remove(sidecar_path(filename))
+    except OSError:
+        pass
@@ -0,0 +1,43 @@
+"""
+Richieste condizionali (ETag / Last-Modified / 304) per le API che servono i
+file di procedura.
+
+Il validatore deriva dallo stamp del file (st_mtime_ns, st_size), ottenuto con
+una sola stat: se il client ha già la versione corrente la risposta 304 viene
+prodotta prima di leggere o parsare il file. Le risposte JSON dipendono anche
+dai permessi dell'utente (can_edit) e tutte dalla codifica negoziata (vedi
+precompressed.py), che entrano nell'ETag come variante.
+Cache-Control "private, no-cache": il browser può conservare la risposta ma
+deve sempre rivalidarla.
+"""
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+
+def file_validators(st, variant=''):
+    """(ETag forte, Last-Modified come timestamp) di una versione del file"""
+    tag = f'{st.st_mtime_ns:x}-{st.st_size:x}'
+    if variant:
+        tag = f'{tag}-{variant}'
+    return f'"{tag}"', int(st.st_mtime)
+
+
+def set_validators(response, etag, last_modified):
+    """Aggiunge alla risposta gli header di validazione e di cache"""
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def not_modified(request, etag, last_modified, vary=()):
+    """
+    Risposta 304 (o 412 per If-Match / If-Unmodified-Since) se le condizioni
+    della richiesta lo prevedono, altrimenti None. `vary`: header da cui
+    dipende la risposta completa (es. Accept-Encoding), ripetuti nel 304.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+        patch_vary_headers(response, vary)
+    return response
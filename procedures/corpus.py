@@ -0,0 +1,117 @@
+"""
+Versione globale del corpus delle procedure.
+
+La versione è l'id dell'ultimo evento di modifica registrato nel database
+(vedi events.py): ogni creazione, modifica o eliminazione ne registra uno,
+quindi tutti i worker vedono la stessa versione subito dopo la scrittura,
+qualunque sia il backend della cache. Le cache derivate dal corpus (es.
+risultati di ricerca) includono la versione nella chiave, quindi
+l'invalidazione è esatta.
+
+CorpusIndex è la base degli indici in memoria costruiti sul contenuto delle
+procedure (suggerimenti, ricerca fuzzy): il processo corrente li aggiorna tramite
+i segnali, le modifiche fatte da altri processi vengono rilevate confrontando
+(numero categorie, max updated_at). L'indice conserva anche visibilità e owner
+di ogni categoria, così i permessi si applicano senza altre query.
+"""
+import threading
+
+from django.db.models import Count, Max
+
+from . import events
+from .models import ProcedureCategory
+from .procedure_cache import parsed_procedures
+
+
+def get_version():
+    return events.latest_version()
+
+
+async def aget_version():
+    """Come get_version, con l'API asincrona dell'ORM (viste ASGI)"""
+    return await events.alatest_version()
+
+
+class CorpusIndex:
+    """
+    Indice in memoria allineato alle categorie del database.
+    Le sottoclassi implementano _update(loaded, removed), dove loaded è una lista
+    di (categoria, sezioni parsate) e removed una lista di id eliminati; viene
+    chiamato con il lock acquisito.
+    """
+
+    def __init__(self):
+        self._seen = {}  # category_id -> updated_at indicizzato
+        self._access = {}  # category_id -> (is_public, owner_id)
+        self._signature = None
+        self._version = None  # versione del corpus dell'ultimo refresh
+        self._lock = threading.Lock()
+
+    def _update(self, loaded, removed):
+        raise NotImplementedError
+
+    def _apply(self, changed, removed):
+        loaded = []
+        for category in changed:
+            try:
+                sections = parsed_procedures.get(category.filename)
+            except (OSError, UnicodeDecodeError):
+                sections = []
+            loaded.append((category, sections))
+            self._seen[category.id] = category.updated_at
+            self._access[category.id] = (category.is_public, category.owner_id)
+        for category_id in removed:
+            self._seen.pop(category_id, None)
+            self._access.pop(category_id, None)
+        self._update(loaded, removed)
+
+    def refresh(self, version=None):
+        """
+        Allinea l'indice al database, ricaricando solo le categorie cambiate.
+        `version`: versione del corpus già letta dalla richiesta (get_version);
+        se l'indice è allineato a quella versione il database non viene interrogato.
+        """
+        if version is not None and version == self._version:
+            return
+        stats = ProcedureCategory.objects.aggregate(count=Count('id'), last=Max('updated_at'))
+        signature = (stats['count'], stats['last'])
+        if signature != self._signature:
+            with self._lock:
+                if signature != self._signature:
+                    current = {
+                        category.id: category
+                        for category in ProcedureCategory.objects.only(
+                            'id', 'name', 'description', 'filename', 'updated_at', 'is_public', 'owner'
+                        )
+                    }
+                    changed = [c for c in current.values() if self._seen.get(c.id) != c.updated_at]
+                    removed = [category_id for category_id in self._seen if category_id not in current]
+                    if changed or removed:
+                        self._apply(changed, removed)
+                    self._signature = signature
+        self._version = version
+
+    def visible_ids(self, user_id, sees_all=False):
+        """Id delle categorie indicizzate visibili all'utente (pubbliche o proprie, tutte se `sees_all`)"""
+        access = self._access
+        if sees_all:
+            return set(access)
+        return {
+            category_id for category_id, (is_public, owner_id) in access.items()
+            if is_public or (user_id is not None and owner_id == user_id)
+        }
+
+    def update_category(self, category):
+        """Reindicizza una categoria (se l'indice è già stato costruito)"""
+        self.update_categories([category])
+
+    def update_categories(self, categories):
+        """Reindicizza più categorie con un solo aggiornamento (es. un'importazione)"""
+        with self._lock:
+            if self._signature is not None:
+                self._apply(list(categories), [])
+
+    def remove_category(self, category_id):
+        with self._lock:
+            if self._signature is not None:
+                self._apply([], [category_id])
@@ -1,3 +1,4 @@
+from asgiref.sync import iscoroutinefunction
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
 from functools import wraps
@@ -38,7 +39,18 @@ def role_required(*roles):
 def ajax_login_required(view_func):
     """
     Decoratore per API che richiede login e ritorna JSON error
+    (anche per le viste async, vedi async_views.py)
     """
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            user = await request.auser()
+            if not user.is_authenticated:
+                return JsonResponse({'error': 'Autenticazione richiesta'}, status=401)
+            return await view_func(request, *args, **kwargs)
+
+        return async_wrapper
+
     @wraps(view_func)
     def wrapper(request, *args, **kwargs):
         if not request.user.is_authenticated:
@@ -0,0 +1,93 @@
+"""
+Invio dei file di procedura scaricati.
+
+PROCEDURE_DOWNLOAD_MODE sceglie chi trasferisce i byte, dopo che la vista ha
+verificato i permessi:
+- 'python' (predefinito): il worker invia il file, con supporto alle
+  richieste Range (206 Partial Content / 416);
+- 'x-accel': la risposta contiene solo l'header X-Accel-Redirect verso la
+  location interna di nginx PROCEDURE_DOWNLOAD_ACCEL_PREFIX, che serve il
+  file (Range compresi) senza occupare il worker.
+"""
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def mode():
+    return getattr(settings, 'PROCEDURE_DOWNLOAD_MODE', 'python')
+
+
+def accel_response(filename, content_type):
+    """Risposta vuota che delega a nginx l'invio del file (location internal)"""
+    prefix = getattr(settings, 'PROCEDURE_DOWNLOAD_ACCEL_PREFIX', '/protected/procedures/')
+    response = HttpResponse(content_type=content_type)
+    response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(filename)
+    return response
+
+
+def parse_range(header, size):
+    """
+    Intervallo [start, end] (estremi inclusi) richiesto dall'header Range.
+    Ritorna None se l'header va ignorato (assente, non valido o con più
+    intervalli: si invia il file intero) e False se l'intervallo non è
+    soddisfacibile (416).
+    """
+    match = _RANGE_RE.match(header.replace(' ', '')) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Ultimi N byte
+        length = int(last)
+        if length == 0 or size == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    return start, end
+
+
+def if_range_matches(request, etag, last_modified):
+    """False se If-Range indica una versione diversa da quella corrente (si invia il file intero)"""
+    if_range = request.headers.get('If-Range')
+    return if_range is None or if_range in (etag, http_date(last_modified))
+
+
+def _read_range(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def range_response(f, size, byte_range, content_type):
+    """Risposta 206 con i byte [start, end] del file aperto f, o 416 se byte_range è False"""
+    if byte_range is False:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    start, end = byte_range
+    length = end - start + 1
+    response = StreamingHttpResponse(_read_range(f, start, length), status=206, content_type=content_type)
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(length)
+    return response
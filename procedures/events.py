@@ -0,0 +1,200 @@
+"""
+Eventi di modifica delle procedure per le dashboard aperte.
+
+Ogni creazione, modifica o eliminazione di una procedura registra un
+ProcedureEvent (receiver in signals.py); l'id dell'evento è la versione.
+/api/events/ invia al client gli eventi successivi all'ultima versione che
+conosce, come server-sent events (EventSource, che alla riconnessione riparte
+da Last-Event-ID) o come JSON per il polling (?since=<versione>).
+
+Gli eventi di un blocco vengono ridotti all'ultimo per categoria e completati
+con i dati della card, letti con una sola query tra le categorie visibili
+all'utente: una categoria che l'utente non vede più arriva come 'deleted'.
+
+Vengono conservati solo gli ultimi PROCEDURE_EVENTS_KEEP eventi: un client
+rimasto indietro oltre questo limite riceve reset e ricarica la dashboard.
+L'id dell'ultimo evento è anche la versione del corpus (vedi corpus.py).
+"""
+import json
+
+from django.conf import settings
+from django.db.models import Max, Min
+
+from .models import ProcedureEvent
+
+# Eventi letti per richiesta (o per giro dello stream)
+BATCH_SIZE = 200
+
+# Ogni quanti eventi registrati si eliminano i più vecchi
+PRUNE_EVERY = 100
+
+# Secondi senza eventi dopo cui lo stream async invia un commento, perché
+# proxy e load balancer non chiudano la connessione inattiva
+HEARTBEAT_INTERVAL = 15
+
+
+def keep():
+    return getattr(settings, 'PROCEDURE_EVENTS_KEEP', 1000)
+
+
+def poll_interval():
+    """Secondi tra due controlli di nuovi eventi nello stream async (lato server)"""
+    return getattr(settings, 'PROCEDURE_EVENTS_POLL_INTERVAL', 3)
+
+
+def retry_interval():
+    """
+    Secondi tra due richieste del browser: riconnessione di EventSource (a ogni
+    risposta con WSGI) e polling di fallback, così lo stream non interroga il
+    server più spesso del polling
+    """
+    return getattr(settings, 'PROCEDURE_EVENTS_RETRY', 10)
+
+
+def stream_timeout():
+    """Durata massima in secondi di uno stream SSE aperto (viste async)"""
+    return getattr(settings, 'PROCEDURE_EVENTS_STREAM_TIMEOUT', 300)
+
+
+def record(kind, category_id):
+    """Registra un evento ('created', 'updated' o 'deleted') per la categoria"""
+    event = ProcedureEvent.objects.create(kind=kind, category_id=category_id)
+    _prune(event.id, 1)
+    return event
+
+
+def record_many(kind, category_ids):
+    """Registra un evento per ogni categoria con un'unica INSERT (es. un'importazione)"""
+    created = ProcedureEvent.objects.bulk_create(
+        [ProcedureEvent(kind=kind, category_id=category_id) for category_id in category_ids]
+    )
+    if created:
+        _prune(max(event.id for event in created), len(created))
+    return created
+
+
+def _prune(latest, count):
+    """Elimina gli eventi più vecchi se gli ultimi `count` registrati hanno superato un multiplo di PRUNE_EVERY"""
+    if latest // PRUNE_EVERY != (latest - count) // PRUNE_EVERY:
+        # Almeno l'ultimo evento resta: il suo id è anche la versione del corpus
+        ProcedureEvent.objects.filter(id__lte=latest - max(keep(), 1)).delete()
+
+
+def latest_version():
+    return ProcedureEvent.objects.aggregate(latest=Max('id'))['latest'] or 0
+
+
+async def alatest_version():
+    return (await ProcedureEvent.objects.aaggregate(latest=Max('id')))['latest'] or 0
+
+
+def parse_version(value):
+    """Versione da query string o Last-Event-ID; solleva ValueError se non valida"""
+    version = int(value)
+    if version < 0:
+        raise ValueError(value)
+    return version
+
+
+def _lost(since, bounds):
+    """True se gli eventi successivi a `since` non sono più (o non sono mai stati) nel database"""
+    latest = bounds['latest'] or 0
+    if since > latest:
+        # Versione mai esistita: database ricreato
+        return True
+    return bounds['oldest'] is not None and since < bounds['oldest'] - 1
+
+
+def _last_per_category(rows):
+    last = {}
+    for event in rows:
+        last[event.category_id] = event
+    return sorted(last.values(), key=lambda event: event.id)
+
+
+def card(category, user):
+    """Dati della card della dashboard per la categoria"""
+    return {
+        'id': category.id,
+        'name': category.name,
+        'icon': category.icon,
+        'description': category.description,
+        'filename': category.filename,
+        'order': category.order,
+        'is_public': category.is_public,
+        'owner': category.owner.username if category.owner else None,
+        'can_edit': category.can_user_edit(user),
+        'can_delete': category.can_user_delete(user),
+    }
+
+
+def _messages(user, events, visible):
+    messages = []
+    for event in events:
+        category = visible.get(event.category_id)
+        if category is not None:
+            messages.append({
+                'version': event.id,
+                'type': event.kind,
+                'category_id': event.category_id,
+                'category': card(category, user),
+            })
+        elif event.kind != 'created':
+            # Eliminata o non più visibile all'utente
+            messages.append({'version': event.id, 'type': 'deleted', 'category_id': event.category_id})
+    return messages
+
+
+def _batch(user, since, bounds, rows, events, visible):
+    if _lost(since, bounds):
+        return {'version': bounds['latest'] or 0, 'events': [], 'reset': True, 'has_more': False}
+    return {
+        'version': rows[-1].id if rows else since,
+        'events': _messages(user, events, visible),
+        'reset': False,
+        'has_more': len(rows) == BATCH_SIZE,
+    }
+
+
+def pending(user, categories, since):
+    """
+    Eventi successivi a `since` per l'utente; `categories` sono le categorie
+    che può vedere. Ritorna {'version', 'events', 'reset', 'has_more'}.
+    """
+    bounds = ProcedureEvent.objects.aggregate(oldest=Min('id'), latest=Max('id'))
+    rows, events, visible = [], [], {}
+    if not _lost(since, bounds):
+        rows = list(ProcedureEvent.objects.filter(id__gt=since)[:BATCH_SIZE])
+        events = _last_per_category(rows)
+        ids = [event.category_id for event in events if event.kind != 'deleted']
+        if ids:
+            visible = {c.id: c for c in categories.filter(id__in=ids).select_related('owner')}
+    return _batch(user, since, bounds, rows, events, visible)
+
+
+async def apending(user, categories, since):
+    """Come pending, con l'API async dell'ORM (viste ASGI)"""
+    bounds = await ProcedureEvent.objects.aaggregate(oldest=Min('id'), latest=Max('id'))
+    rows, events, visible = [], [], {}
+    if not _lost(since, bounds):
+        rows = [event async for event in ProcedureEvent.objects.filter(id__gt=since)[:BATCH_SIZE]]
+        events = _last_per_category(rows)
+        ids = [event.category_id for event in events if event.kind != 'deleted']
+        if ids:
+            visible = {c.id: c async for c in categories.filter(id__in=ids).select_related('owner')}
+    return _batch(user, since, bounds, rows, events, visible)
+
+
+def sse(batch, since):
+    """Blocco di eventi nel formato text/event-stream"""
+    if batch['reset']:
+        return f'id: {batch["version"]}\nevent: reset\ndata: {{}}\n\n'
+    chunks = [
+        f'id: {message["version"]}\nevent: procedure\ndata: {json.dumps(message)}\n\n'
+        for message in batch['events']
+    ]
+    # Eventi ridotti o non visibili: Last-Event-ID deve comunque avanzare
+    last = batch['events'][-1]['version'] if batch['events'] else since
+    if batch['version'] != last:
+        chunks.append(f'id: {batch["version"]}\n\n')
+    return ''.join(chunks)
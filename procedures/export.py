@@ -0,0 +1,195 @@
+"""
+Esportazione delle procedure come archivio zip o tar.gz.
+
+L'archivio contiene procedure_files/<file> per ogni procedura e, in fondo,
+manifest.json con i metadati di ProcedureCategory, la dimensione e lo SHA-256
+di ogni file. Viene prodotto da un generatore di blocchi di byte: i file sono
+letti a blocchi e ogni blocco compresso viene ceduto subito, così la memoria
+usata non dipende dalla dimensione del corpus e i primi byte partono subito
+(StreamingHttpResponse o scrittura su file nel comando export_procedures).
+"""
+import gzip
+import hashlib
+import json
+import os
+import tarfile
+import time
+import zipfile
+
+from django.conf import settings
+from django.utils import timezone
+
+FORMATS = {
+    'zip': ('application/zip', 'zip'),
+    'tar.gz': ('application/gzip', 'tar.gz'),
+}
+
+MANIFEST_NAME = 'manifest.json'
+FILES_PREFIX = 'procedure_files/'
+MANIFEST_VERSION = 1
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class _StreamBuffer:
+    """File di sola scrittura (non posizionabile): accumula i byte finché il generatore non li preleva"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def archive_name(fmt):
+    """Nome del file di esportazione, es. procedures-20250101-120000.zip"""
+    return f'procedures-{timezone.localtime().strftime("%Y%m%d-%H%M%S")}.{FORMATS[fmt][1]}'
+
+
+def _category_metadata(category):
+    return {
+        'name': category.name,
+        'icon': category.icon,
+        'description': category.description,
+        'filename': category.filename,
+        'order': category.order,
+        'is_public': category.is_public,
+        'owner': category.owner.username if category.owner else None,
+        'created_at': category.created_at.isoformat(),
+        'updated_at': category.updated_at.isoformat(),
+    }
+
+
+def _procedure_files(categories, manifest):
+    """
+    Per ogni procedura con file leggibile: (nome nell'archivio, dimensione,
+    mtime, generatore dei blocchi). Completa `manifest` con metadati, dimensione
+    e hash man mano che i file vengono letti; i file mancanti sono elencati in
+    manifest['missing'].
+    """
+    for category in categories:
+        file_path = os.path.join(settings.PROCEDURE_FILES_DIR, category.filename)
+        # Verifica sicurezza path
+        if not os.path.abspath(file_path).startswith(str(settings.PROCEDURE_FILES_DIR)):
+            manifest['missing'].append(category.filename)
+            continue
+        try:
+            f = open(file_path, 'rb')
+        except OSError:
+            manifest['missing'].append(category.filename)
+            continue
+        with f:
+            st = os.fstat(f.fileno())
+            entry = _category_metadata(category)
+            entry['size'] = st.st_size
+            manifest['procedures'].append(entry)
+
+            def chunks(f=f, entry=entry, size=st.st_size):
+                digest = hashlib.sha256()
+                remaining = size
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        # File accorciato durante l'esportazione: la dimensione nell'header è già scritta
+                        chunk = b'\0' * remaining
+                    remaining -= len(chunk)
+                    digest.update(chunk)
+                    yield chunk
+                entry['sha256'] = digest.hexdigest()
+
+            yield FILES_PREFIX + category.filename, st.st_size, st.st_mtime, chunks()
+
+
+def _new_manifest():
+    return {
+        'version': MANIFEST_VERSION,
+        'exported_at': timezone.now().isoformat(),
+        'procedures': [],
+        'missing': [],
+    }
+
+
+def _manifest_bytes(manifest):
+    return json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def _zip_stream(categories):
+    buffer = _StreamBuffer()
+    manifest = _new_manifest()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, size, mtime, chunks in _procedure_files(categories, manifest):
+            info = zipfile.ZipInfo(name, date_time=time.localtime(mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.file_size = size
+            with archive.open(info, mode='w', force_zip64=size > zipfile.ZIP64_LIMIT) as member:
+                for chunk in chunks:
+                    member.write(chunk)
+                    yield buffer.pop()
+            yield buffer.pop()
+        archive.writestr(MANIFEST_NAME, _manifest_bytes(manifest))
+    yield buffer.pop()
+
+
+def _tar_header(name, size, mtime):
+    """Header tar (formato PAX) di un file regolare"""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+
+def _tar_padding(size):
+    return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+
+def _tar_gz_stream(categories):
+    # Il tar è scritto direttamente (header con TarInfo.tobuf e contenuto a
+    # blocchi): tarfile.addfile leggerebbe ogni file in un'unica volta
+    buffer = _StreamBuffer()
+    manifest = _new_manifest()
+    written = 0
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=int(time.time())) as archive:
+        def write(data):
+            nonlocal written
+            archive.write(data)
+            written += len(data)
+
+        for name, size, mtime, chunks in _procedure_files(categories, manifest):
+            write(_tar_header(name, size, mtime))
+            for chunk in chunks:
+                write(chunk)
+                yield buffer.pop()
+            write(_tar_padding(size))
+
+        data = _manifest_bytes(manifest)
+        write(_tar_header(MANIFEST_NAME, len(data), time.time()))
+        write(data + _tar_padding(len(data)))
+
+        # Fine archivio: due blocchi vuoti e riempimento fino al record, come tarfile
+        write(b'\0' * (2 * tarfile.BLOCKSIZE))
+        write(b'\0' * (-written % tarfile.RECORDSIZE))
+    yield buffer.pop()
+
+
+def stream(categories, fmt):
+    """
+    Generatore dei byte dell'archivio (`fmt`: 'zip' o 'tar.gz') con i file e
+    i metadati delle procedure `categories`, nell'ordine dato.
+    """
+    if fmt == 'zip':
+        chunks = _zip_stream(categories)
+    else:
+        chunks = _tar_gz_stream(categories)
+    for chunk in chunks:
+        if chunk:
+            yield chunk
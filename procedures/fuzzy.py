@@ -0,0 +1,170 @@
+"""
+Ricerca tollerante agli errori di battitura ("dokcer", "sytemctl").
+
+Il vocabolario delle parole presenti nelle procedure (nomi e descrizioni delle
+categorie, titoli e descrizioni delle sezioni, etichette e corpo dei comandi) è
+indicizzato per trigrammi: i candidati per un termine sono solo le parole che
+condividono almeno un trigramma con esso, poi verificati con la distanza di
+Damerau-Levenshtein (trasposizioni adiacenti incluse). L'allineamento al
+database è gestito da corpus.CorpusIndex.
+"""
+import itertools
+import re
+from collections import Counter, defaultdict
+
+from .corpus import CorpusIndex
+
+_WORD_RE = re.compile(r'\w+')
+
+# Le parole più corte non vengono né indicizzate né corrette
+MIN_LENGTH = 3
+
+# Parole verificate con la distanza di edit al massimo per termine
+MAX_CANDIDATES = 200
+
+# Correzioni proposte al massimo per termine e query riscritte al massimo per ricerca
+MAX_CORRECTIONS = 3
+MAX_ALTERNATIVES = 5
+
+
+def max_distance(term):
+    """Errori tollerati: uno per le parole brevi, due per le altre"""
+    return 1 if len(term) <= 4 else 2
+
+
+def _trigrams(word):
+    padded = f'${word}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    """
+    Distanza di Damerau-Levenshtein ristretta (optimal string alignment).
+    Ritorna limit + 1 appena la distanza supera limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(prev[j] + 1, current[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], prev2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        prev2, prev = prev, current
+    return prev[-1]
+
+
+def _category_words(category, sections):
+    texts = [category.name, category.description]
+    for section in sections:
+        texts.append(section.title)
+        texts.append(section.desc)
+        for cmd in section.commands:
+            texts.append(cmd.label)
+            texts.append(cmd.cmd)
+    return {
+        word
+        for text in texts
+        for word in _WORD_RE.findall(text.lower())
+        if len(word) >= MIN_LENGTH
+    }
+
+
+class FuzzyIndex(CorpusIndex):
+    """Vocabolario delle procedure con indice per trigrammi"""
+
+    def __init__(self):
+        super().__init__()
+        self._words = {}                      # category_id -> parole della categoria
+        self._postings = defaultdict(set)     # parola -> id delle categorie che la contengono
+        self._trigrams = defaultdict(set)     # trigramma -> parole
+
+    def _add_word(self, word, category_id):
+        if word not in self._postings:
+            for trigram in _trigrams(word):
+                self._trigrams[trigram].add(word)
+        self._postings[word].add(category_id)
+
+    def _remove_word(self, word, category_id):
+        postings = self._postings[word]
+        postings.discard(category_id)
+        if postings:
+            return
+        del self._postings[word]
+        for trigram in _trigrams(word):
+            words = self._trigrams[trigram]
+            words.discard(word)
+            if not words:
+                del self._trigrams[trigram]
+
+    def _update(self, loaded, removed):
+        for category_id in itertools.chain(removed, (category.id for category, _ in loaded)):
+            for word in self._words.pop(category_id, ()):
+                self._remove_word(word, category_id)
+        for category, sections in loaded:
+            words = _category_words(category, sections)
+            self._words[category.id] = words
+            for word in words:
+                self._add_word(word, category.id)
+
+    def corrections(self, term, visible_ids):
+        """
+        Parole del vocabolario visibile entro max_distance(term) dal termine,
+        come lista di (distanza, parola) ordinata per distanza e diffusione.
+        """
+        if len(term) < MIN_LENGTH or not _WORD_RE.fullmatch(term):
+            return []
+        limit = max_distance(term)
+        with self._lock:
+            shared = Counter()
+            for trigram in _trigrams(term):
+                shared.update(self._trigrams.get(trigram, ()))
+            found = []
+            for word, _ in shared.most_common(MAX_CANDIDATES):
+                if word == term:
+                    continue
+                visible = len(self._postings[word] & visible_ids)
+                if not visible:
+                    continue
+                distance = edit_distance(term, word, limit)
+                if distance <= limit:
+                    found.append((distance, -visible, word))
+        found.sort()
+        return [(distance, word) for distance, _, word in found[:MAX_CORRECTIONS]]
+
+    def alternatives(self, query, visible_ids):
+        """
+        Riscritture della query con i termini corretti, come lista di
+        (distanza totale, {termine: correzione}) ordinata per distanza.
+        """
+        options = []
+        for term in query.positive:
+            if term.phrase:
+                continue
+            found = self.corrections(term.needle, visible_ids)
+            if found:
+                options.append([(0, term.needle, term.needle)] + [
+                    (distance, term.needle, word) for distance, word in found
+                ])
+        if not options:
+            return []
+        if len(options) > 3:
+            # Molti termini da correggere: solo la correzione migliore per ciascuno
+            options = [choices[:2] for choices in options]
+
+        rewrites = []
+        for combination in itertools.product(*options):
+            distance = sum(choice[0] for choice in combination)
+            if distance:
+                corrections = {needle: word for _, needle, word in combination if needle != word}
+                rewrites.append((distance, corrections))
+        rewrites.sort(key=lambda r: (r[0], sorted(r[1].items())))
+        return rewrites[:MAX_ALTERNATIVES]
+
+
+fuzzy_index = FuzzyIndex()
@@ -0,0 +1,161 @@
+"""
+Conversione dell'HTML dell'editor visuale nel formato testuale delle procedure.
+
+Struttura attesa (come la produce l'editor):
+<h2>Titolo sezione</h2> <p>Descrizione</p> <h3>Etichetta comando</h3> <pre>comando</pre>
+
+Il parser è definito una sola volta a livello di modulo e accumula il testo in
+liste di frammenti unite alla fine: il tempo è lineare nella dimensione
+dell'HTML anche quando un titolo o un comando è spezzato in migliaia di nodi
+(es. <span> dell'evidenziazione della sintassi).
+
+L'HTML prodotto dall'editor (solo tag semplici e testo) viene suddiviso con
+un'unica espressione regolare, più veloce del tokenizer di HTMLParser; tutto
+il resto (commenti, <script>, tag malformati, ...) passa da HTMLParser, così
+il risultato è sempre identico a quello della conversione originale.
+"""
+import re
+from html import unescape
+from html.parser import HTMLParser
+
+_WS = '[ \t\n\r\f]'
+_ATTRIBUTE = f'(?:{_WS}+[a-zA-Z_:][-a-zA-Z0-9_:.]*(?:{_WS}*={_WS}*(?:"[^"<>&]*"|\'[^\'<>&]*\'))?)'
+# Tag di apertura (gruppi 1-2), di chiusura (3) o testo (4)
+_SIMPLE_TOKEN = re.compile(
+    f'<([a-zA-Z][a-zA-Z0-9]*){_ATTRIBUTE}*{_WS}*(/?)>|</([a-zA-Z][a-zA-Z0-9]*)>|([^<]+)'
+)
+# Elementi il cui contenuto HTMLParser non tratta come HTML
+_RAW_TEXT_TAGS = frozenset({
+    'script', 'style', 'textarea', 'title', 'xmp', 'iframe', 'noembed', 'noframes', 'plaintext', 'noscript',
+})
+
+
+class ProcedureHTMLParser(HTMLParser):
+    """
+    Raccoglie sezioni e comandi dall'HTML. Una sezione è
+    [frammenti titolo, frammenti descrizione, comandi], un comando
+    [frammenti etichetta, frammenti comando].
+    """
+
+    def reset(self):
+        # Chiamato anche da HTMLParser.__init__
+        super().reset()
+        self.sections = []
+        self.current_section = None
+        self.current_command = None
+        self.in_section_title = False
+        self.in_section_desc = False
+        self.in_command_label = False
+        self.in_command_code = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'h2':
+            self.in_section_title = True
+            if self.current_section is not None:
+                self.sections.append(self.current_section)
+            self.current_section = [[], [], []]
+        elif tag == 'p' and self.current_section is not None and not self.current_section[1]:
+            self.in_section_desc = True
+        elif tag == 'h3':
+            self.in_command_label = True
+            self.current_command = [[], []]
+        elif tag == 'pre' or tag == 'code':
+            self.in_command_code = True
+
+    def handle_endtag(self, tag):
+        if tag == 'h2':
+            self.in_section_title = False
+        elif tag == 'p':
+            self.in_section_desc = False
+        elif tag == 'h3':
+            self.in_command_label = False
+        elif tag == 'pre' or tag == 'code':
+            self.in_command_code = False
+            if self.current_command is not None and self.current_section is not None:
+                self.current_section[2].append(self.current_command)
+                self.current_command = None
+
+    def handle_data(self, data):
+        data = data.strip()
+        if not data:
+            return
+
+        if self.in_section_title and self.current_section is not None:
+            self.current_section[0].append(data)
+        elif self.in_section_desc and self.current_section is not None:
+            self.current_section[1].append(data)
+        elif self.in_command_label and self.current_command is not None:
+            self.current_command[0].append(data)
+        elif self.in_command_code and self.current_command is not None:
+            self.current_command[1].append(data)
+
+    def finish(self):
+        """
+        Ritorna le sezioni raccolte. Non chiama close(): come la conversione
+        originale, l'eventuale testo finale ancora nel buffer viene ignorato.
+        """
+        # Aggiungi l'ultima sezione
+        if self.current_section is not None:
+            self.sections.append(self.current_section)
+            self.current_section = None
+        return self.sections
+
+
+def _is_simple(html_content):
+    """True se l'HTML è composto solo da tag semplici e testo (vedi _feed_simple)"""
+    pos = 0
+    for match in _SIMPLE_TOKEN.finditer(html_content):
+        if match.start() != pos:
+            return False
+        pos = match.end()
+        tag = match.group(1)
+        if tag is not None and tag.lower() in _RAW_TEXT_TAGS:
+            return False
+        # Un riferimento a entità in fondo al testo HTMLParser lo trattiene nel buffer
+        if match.group(4) is not None and pos == len(html_content) and '&' in match.group(4):
+            return False
+    return pos == len(html_content)
+
+
+def _feed_simple(parser, html_content):
+    """
+    Passa al parser i tag e il testo di un HTML composto solo da tag semplici,
+    come farebbe HTMLParser.feed. Ritorna False, senza chiamare alcun handler,
+    se l'HTML contiene altro: va allora usato HTMLParser.
+    """
+    # Due passaggi (verifica, poi eventi) per non tenere in memoria i token
+    if not _is_simple(html_content):
+        return False
+    for match in _SIMPLE_TOKEN.finditer(html_content):
+        text = match.group(4)
+        if text is not None:
+            parser.handle_data(unescape(text) if '&' in text else text)
+        elif match.group(1) is not None:
+            tag = match.group(1).lower()
+            parser.handle_starttag(tag, [])
+            if match.group(2):
+                parser.handle_endtag(tag)
+        else:
+            parser.handle_endtag(match.group(3).lower())
+    return True
+
+
+def convert_html_to_procedure_format(html_content):
+    """Converte contenuto HTML dell'editor in formato procedura .txt"""
+    parser = ProcedureHTMLParser()
+    if not _feed_simple(parser, html_content):
+        parser.feed(html_content)
+
+    # Genera formato .txt
+    txt_lines = []
+    for title, desc, commands in parser.finish():
+        txt_lines.append(f"[{''.join(title)}]")
+        txt_lines.append(''.join(desc))
+        txt_lines.append('')
+
+        for label, cmd in commands:
+            txt_lines.append(f"COMANDO: {''.join(label)}")
+            txt_lines.append(''.join(cmd))
+            txt_lines.append('')
+
+    return '\n'.join(txt_lines)
@@ -0,0 +1,270 @@
+"""
+Importazione di archivi di procedure (zip, tar, tar.gz).
+
+L'archivio contiene i file .txt delle procedure (eventuali cartelle vengono
+ignorate, conta solo il nome del file) e opzionalmente manifest.json nel
+formato prodotto dall'esportazione (export.py), da cui vengono presi nome,
+icona, descrizione, visibilità e ordine delle procedure.
+
+I file vengono validati e parsati in parallelo in un pool di processi
+(compiled.compile_content); le categorie sono create con un'unica
+bulk_create in una sola transazione. Le sezioni già parsate vengono poi
+salvate nella cache e nel sidecar compilato e passate una sola volta a
+procedures_imported: indice full-text, indici in memoria ed eventi vengono
+aggiornati per l'intero blocco, senza rileggere i file appena importati.
+
+I file non validi o già presenti vengono saltati e riportati nel risultato.
+"""
+import json
+import os
+import posixpath
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+
+from . import compiled
+from .models import ProcedureCategory
+from .offsets import offset_indexes
+from .patching import atomic_write
+from .procedure_cache import parsed_procedures
+from .signals import procedures_imported
+
+MANIFEST_NAME = 'manifest.json'
+
+# Sotto questo numero di file l'avvio del pool di processi costa più del parsing
+PARALLEL_MIN_FILES = 8
+
+
+class ArchiveError(Exception):
+    """Archivio non leggibile o oltre i limiti di importazione"""
+
+
+def safe_filename(name):
+    """Nome del file di procedura ripulito (spazi in _, solo alfanumerici e ._-)"""
+    filename = name.replace(' ', '_')
+    return ''.join(c for c in filename if c.isalnum() or c in '._-')
+
+
+def _max_files():
+    return getattr(settings, 'PROCEDURE_IMPORT_MAX_FILES', 1000)
+
+
+def _max_bytes():
+    return getattr(settings, 'PROCEDURE_IMPORT_MAX_BYTES', 64 * 1024 * 1024)
+
+
+def _workers():
+    return getattr(settings, 'PROCEDURE_IMPORT_WORKERS', os.cpu_count() or 1)
+
+
+class _MemberReader:
+    """Legge i membri dell'archivio rispettando i limiti di numero e dimensione"""
+
+    def __init__(self):
+        self.members = []
+        self.manifest = None
+        self.total = 0
+
+    def wanted(self, name):
+        """Nome del file se il membro va letto, altrimenti None"""
+        basename = posixpath.basename(name.replace('\\', '/'))
+        if not basename or basename.startswith('.') or '__MACOSX' in name:
+            return None
+        if basename == MANIFEST_NAME or basename.endswith('.txt'):
+            return basename
+        return None
+
+    def add(self, basename, size, open_member):
+        if basename != MANIFEST_NAME and len(self.members) >= _max_files():
+            raise ArchiveError(f'Troppi file nell\'archivio (massimo {_max_files()})')
+        remaining = _max_bytes() - self.total
+        if size > remaining:
+            raise ArchiveError(f'Archivio troppo grande (massimo {_max_bytes()} byte non compressi)')
+        with open_member() as f:
+            # La dimensione dichiarata non è affidabile: si legge al massimo il consentito
+            data = f.read(remaining + 1)
+        if len(data) > remaining:
+            raise ArchiveError(f'Archivio troppo grande (massimo {_max_bytes()} byte non compressi)')
+        self.total += len(data)
+
+        if basename == MANIFEST_NAME:
+            self.manifest = data
+        else:
+            self.members.append((basename, data))
+
+
+def read_archive(fileobj):
+    """
+    File .txt e manifest dell'archivio (zip, tar o tar.gz) aperto in `fileobj`.
+    Ritorna (lista di (nome file, contenuto), manifest in byte o None).
+    """
+    reader = _MemberReader()
+    try:
+        if zipfile.is_zipfile(fileobj):
+            fileobj.seek(0)
+            with zipfile.ZipFile(fileobj) as archive:
+                for info in archive.infolist():
+                    basename = None if info.is_dir() else reader.wanted(info.filename)
+                    if basename:
+                        reader.add(basename, info.file_size, lambda info=info: archive.open(info))
+        else:
+            fileobj.seek(0)
+            with tarfile.open(fileobj=fileobj, mode='r:*') as archive:
+                for info in archive:
+                    # Solo file regolari: link e dispositivi vengono ignorati
+                    basename = reader.wanted(info.name) if info.isfile() else None
+                    if basename:
+                        reader.add(basename, info.size, lambda info=info: archive.extractfile(info))
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError, RuntimeError, NotImplementedError) as e:
+        # RuntimeError / NotImplementedError: membri zip cifrati o con compressione non supportata
+        raise ArchiveError('Archivio non valido: usa zip, tar o tar.gz') from e
+    return reader.members, reader.manifest
+
+
+def _manifest_entries(manifest):
+    """Metadati del manifest per nome file"""
+    if manifest is None:
+        return {}
+    try:
+        data = json.loads(manifest.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        raise ArchiveError('manifest.json non valido')
+    procedures = data.get('procedures') if isinstance(data, dict) else None
+    if not isinstance(procedures, list):
+        raise ArchiveError('manifest.json non valido: manca l\'elenco "procedures"')
+    return {
+        entry['filename']: entry
+        for entry in procedures
+        if isinstance(entry, dict) and isinstance(entry.get('filename'), str)
+    }
+
+
+def _parse_all(contents):
+    """
+    Sezioni, posizioni e hash di ogni contenuto (vedi compiled.parse_content),
+    in un pool di processi se sono molti. Per i contenuti non validi ritorna
+    l'eccezione sollevata.
+    """
+    workers = min(_workers(), len(contents))
+    if workers > 1 and len(contents) >= PARALLEL_MIN_FILES:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(compiled.compile_content, data) for data in contents]
+            results = []
+            for future in futures:
+                try:
+                    encoded, digest = future.result()
+                    results.append(compiled.decode(encoded) + (digest,))
+                except (UnicodeDecodeError, ValueError) as e:
+                    results.append(e)
+            return results
+
+    results = []
+    for data in contents:
+        try:
+            results.append(compiled.parse_content(data))
+        except (UnicodeDecodeError, ValueError) as e:
+            results.append(e)
+    return results
+
+
+def _text(value, default, max_length=None):
+    if not isinstance(value, str) or not value.strip():
+        return default
+    return value.strip()[:max_length] if max_length else value.strip()
+
+
+def import_archive(fileobj, owner=None, is_public=True):
+    """
+    Importa le procedure dell'archivio aperto in `fileobj`.
+    Ritorna (categorie create, file saltati come lista di {'filename', 'error'}).
+    Solleva ArchiveError se l'archivio non è leggibile o supera i limiti.
+    """
+    members, manifest = read_archive(fileobj)
+    entries = _manifest_entries(manifest)
+    skipped = []
+
+    # Nomi validi e non già presenti (sul disco, nel database o nell'archivio stesso)
+    candidates = {}
+    for name, data in members:
+        filename = safe_filename(name)
+        if filename in ('', '.txt') or len(filename) > ProcedureCategory._meta.get_field('filename').max_length:
+            skipped.append({'filename': name, 'error': 'Nome file non valido'})
+        elif filename in candidates:
+            skipped.append({'filename': name, 'error': 'File duplicato nell\'archivio'})
+        else:
+            candidates[filename] = (name, data)
+
+    existing = set(ProcedureCategory.objects.filter(filename__in=list(candidates)).values_list('filename', flat=True))
+    for filename in list(candidates):
+        if filename in existing or os.path.exists(os.path.join(settings.PROCEDURE_FILES_DIR, filename)):
+            skipped.append({'filename': candidates.pop(filename)[0], 'error': 'Un file con questo nome esiste già'})
+
+    # Validazione e parsing in parallelo
+    filenames = list(candidates)
+    results = _parse_all([candidates[filename][1] for filename in filenames])
+    parsed = []
+    for filename, result in zip(filenames, results):
+        name, data = candidates[filename]
+        if isinstance(result, UnicodeDecodeError):
+            skipped.append({'filename': name, 'error': 'Il file non è in formato UTF-8'})
+        elif isinstance(result, Exception):
+            skipped.append({'filename': name, 'error': str(result)})
+        elif not result[0]:
+            skipped.append({'filename': name, 'error': 'Nessuna sezione [TITOLO] trovata'})
+        else:
+            parsed.append((filename, data) + result)
+
+    # Ordine del manifest, poi quello dell'archivio, in coda alle procedure esistenti
+    def manifest_order(item):
+        order = entries.get(item[1][0], {}).get('order')
+        return (0, order, item[0]) if isinstance(order, int) else (1, 0, item[0])
+
+    parsed = [item for _, item in sorted(enumerate(parsed), key=manifest_order)]
+    first_order = ProcedureCategory.objects.count() + 1
+
+    categories = []
+    for n, (filename, _, _, _, _) in enumerate(parsed):
+        entry = entries.get(filename, {})
+        default_name = filename.replace('.txt', '').replace('_', ' ').title()
+        categories.append(ProcedureCategory(
+            name=_text(entry.get('name'), default_name, ProcedureCategory._meta.get_field('name').max_length),
+            icon=_text(entry.get('icon'), '📄', ProcedureCategory._meta.get_field('icon').max_length),
+            description=_text(entry.get('description'), ''),
+            filename=filename,
+            order=first_order + n,
+            owner=owner,
+            is_public=entry['is_public'] if isinstance(entry.get('is_public'), bool) else is_public,
+        ))
+
+    # Scrittura dei file, poi un'unica INSERT: se fallisce i file scritti vengono rimossi
+    stats = []
+    try:
+        for filename, data, _, _, _ in parsed:
+            file_path = os.path.join(settings.PROCEDURE_FILES_DIR, filename)
+            stats.append(atomic_write(file_path, lambda f, data=data: f.write(data)))
+        with transaction.atomic():
+            categories = ProcedureCategory.objects.bulk_create(categories)
+    except BaseException:
+        for filename, _, _, _, _ in parsed[:len(stats)]:
+            try:
+                os.remove(os.path.join(settings.PROCEDURE_FILES_DIR, filename))
+            except OSError:
+                pass
+        raise
+
+    # Cache e sidecar con le sezioni già parsate, poi indici ed eventi in blocco
+    # (bulk_create non invia post_save)
+    for (filename, _, sections, spans, digest), st in zip(parsed, stats):
+        stamp = (st.st_mtime_ns, st.st_size)
+        compiled.write(filename, sections, spans, digest, stamp)
+        parsed_procedures.store(filename, stamp, sections)
+        offset_indexes.store(filename, stamp, spans)
+    if categories:
+        procedures_imported.send(
+            sender=ProcedureCategory, categories=categories, sections=[item[2] for item in parsed]
+        )
+
+    return categories, skipped
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from procedures.benchmarks import SUITES
+
+
+class Command(BaseCommand):
+    help = 'Esegue i benchmark delle procedure su un corpus sintetico'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'suites', nargs='*',
+            help=f'Suite da eseguire (default tutte): {", ".join(SUITES)}'
+        )
+        parser.add_argument(
+            '--size', type=int, default=200,
+            help='Numero di procedure del corpus sintetico (default 200)'
+        )
+
+    def handle(self, *args, **options):
+        names = options['suites'] or list(SUITES)
+        unknown = [name for name in names if name not in SUITES]
+        if unknown:
+            raise CommandError(f'Suite sconosciute: {", ".join(unknown)}')
+
+        for name in names:
+            self.stdout.write(self.style.SUCCESS(f'▶ {name}: {SUITES[name].__doc__}'))
+            for metric, value, unit in SUITES[name](options['size']):
+                self.stdout.write(f'  {metric:<40} {value:>12} {unit}')
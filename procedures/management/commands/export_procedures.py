@@ -0,0 +1,60 @@
+import os
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from procedures import api, export
+from procedures.models import ProcedureCategory
+
+
+class Command(BaseCommand):
+    help = 'Esporta le procedure (file e manifest.json dei metadati) in un archivio zip o tar.gz'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', type=str,
+                            help='File di destinazione ("-" per lo standard output; predefinito: procedures-<data>.<formato>)')
+        parser.add_argument('--format', type=str, choices=list(export.FORMATS), default='zip',
+                            help='Formato dell\'archivio')
+        parser.add_argument('--user', type=str,
+                            help='Esporta solo le procedure visibili a questo utente (predefinito: tutte)')
+
+    def handle(self, *args, **options):
+        fmt = options['format']
+
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f'Utente "{options["user"]}" non trovato')
+            categories = api.visible_categories(user)
+        else:
+            categories = ProcedureCategory.objects.all()
+        categories = categories.select_related('owner')
+
+        output = options['output'] or export.archive_name(fmt)
+        if output == '-':
+            total = self._write(sys.stdout.buffer, categories, fmt)
+            sys.stdout.buffer.flush()
+            # Lo standard output contiene l'archivio: il riepilogo va su stderr
+            self.stderr.write(self.style.SUCCESS(f'✓ Archivio {fmt} esportato ({total} byte)'))
+            return
+
+        # Scrittura su file temporaneo: un'esportazione interrotta non lascia un archivio troncato
+        tmp_path = f'{output}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                total = self._write(f, categories, fmt)
+            os.replace(tmp_path, output)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        self.stdout.write(self.style.SUCCESS(f'✓ Procedure esportate in {output} ({total} byte)'))
+
+    def _write(self, f, categories, fmt):
+        total = 0
+        for chunk in export.stream(categories, fmt):
+            f.write(chunk)
+            total += len(chunk)
+        return total
@@ -0,0 +1,36 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from procedures import importing
+
+
+class Command(BaseCommand):
+    help = 'Importa un archivio (zip, tar o tar.gz) di file di procedura, con manifest.json opzionale'
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive', type=str, help='Archivio da importare')
+        parser.add_argument('--owner', type=str, help='Username del proprietario delle procedure importate')
+        parser.add_argument('--private', action='store_true',
+                            help='Procedure private se il manifest non indica la visibilità')
+
+    def handle(self, *args, **options):
+        owner = None
+        if options['owner']:
+            try:
+                owner = User.objects.get(username=options['owner'])
+            except User.DoesNotExist:
+                raise CommandError(f'Utente "{options["owner"]}" non trovato')
+
+        try:
+            with open(options['archive'], 'rb') as f:
+                categories, skipped = importing.import_archive(f, owner=owner, is_public=not options['private'])
+        except OSError as e:
+            raise CommandError(f'Impossibile leggere l\'archivio: {e}')
+        except importing.ArchiveError as e:
+            raise CommandError(str(e))
+
+        for item in skipped:
+            self.stdout.write(self.style.WARNING(f'  Saltato {item["filename"]}: {item["error"]}'))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Importate {len(categories)} procedure ({len(skipped)} file saltati)'
+        ))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from procedures import search_index
+
+
+class Command(BaseCommand):
+    help = 'Ricostruisce da zero l\'indice full-text delle procedure'
+
+    def handle(self, *args, **kwargs):
+        if not search_index.is_available():
+            self.stdout.write(self.style.ERROR(
+                'Indice full-text non disponibile (PROCEDURE_SEARCH_INDEX disattivato, '
+                'database non SQLite o migrazioni non applicate)'
+            ))
+            return
+
+        categories, rows = search_index.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Indice ricostruito: {categories} procedure, {rows} righe indicizzate'
+        ))
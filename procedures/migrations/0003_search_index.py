@@ -0,0 +1,30 @@
+# Indice full-text FTS5 sul contenuto delle procedure
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from procedures import search_index
+
+    if not search_index.create_table(schema_editor):
+        return
+    # Indicizza le procedure già presenti
+    ProcedureCategory = apps.get_model('procedures', 'ProcedureCategory')
+    search_index.rebuild_index(ProcedureCategory.objects.all())
+
+
+def drop_search_index(apps, schema_editor):
+    from procedures import search_index
+
+    search_index.drop_table(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('procedures', '0002_authentication_system'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.7 on 2026-10-18 01:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('procedures', '0003_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcedureEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('created', 'Creata'), ('updated', 'Modificata'), ('deleted', 'Eliminata')], max_length=10)),
+                ('category_id', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Evento Procedura',
+                'verbose_name_plural': 'Eventi Procedure',
+                'ordering': ['id'],
+            },
+        ),
+    ]
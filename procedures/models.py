@@ -86,3 +86,28 @@ class ProcedureCategory(models.Model):
         if hasattr(user, 'profile'):
             return user.profile.can_delete(self)
         return False
+
+
+class ProcedureEvent(models.Model):
+    """
+    Modifica a una procedura, per aggiornare le dashboard aperte (vedi events.py).
+    L'id fa da numero di versione: i client chiedono gli eventi successivi all'ultimo ricevuto.
+    """
+    KIND_CHOICES = [
+        ('created', 'Creata'),
+        ('updated', 'Modificata'),
+        ('deleted', 'Eliminata'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # Nessuna FK: l'evento deve sopravvivere all'eliminazione della categoria
+    category_id = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = "Evento Procedura"
+        verbose_name_plural = "Eventi Procedure"
+
+    def __str__(self):
+        return f"#{self.id} {self.get_kind_display()} {self.category_id}"
@@ -0,0 +1,159 @@
+"""
+Indice delle posizioni in byte di sezioni e comandi nei file di procedura.
+
+Per ogni sezione: titolo, descrizione, intervallo [start, end) dal titolo
+all'inizio della sezione successiva e intervalli dei suoi comandi (dalla riga
+COMANDO: all'ultima riga non vuota del corpo). Una singola sezione o un singolo
+comando si leggono così con una seek e una read, senza scorrere il resto del file.
+
+L'indice è costruito insieme alle sezioni parsate e salvato nel sidecar
+compilato (vedi compiled.py): viene calcolato una volta per versione del
+contenuto e ricostruito automaticamente se il file viene modificato fuori
+dall'applicazione. In memoria è validato con (st_mtime_ns, st_size).
+
+Lo stesso stamp dà la versione del file e ogni sezione ha un identificatore
+stabile (vedi section_ids): l'editor visuale li usa per salvare solo le sezioni
+modificate (patching.replace_sections).
+"""
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .parsing import parse_procedure_lines
+from .procedure_cache import parsed_procedures
+from . import compiled
+
+# Indici tenuti in memoria per processo
+MAX_ENTRIES = 256
+
+
+class OffsetIndexCache:
+    """LRU degli indici delle posizioni (liste di parsing.SectionSpan) per nome file"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # filename -> (stamp, posizioni)
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """
+        Ritorna (stamp, lista di SectionSpan) del file.
+        Solleva FileNotFoundError se il file non esiste.
+        """
+        file_path = os.path.join(settings.PROCEDURE_FILES_DIR, filename)
+        st = os.stat(file_path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(filename)
+                return entry
+
+        _, spans, _ = compiled.load(filename, stamp)
+        entry = (stamp, spans)
+        with self._lock:
+            self._entries[filename] = entry
+            self._entries.move_to_end(filename)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def store(self, filename, stamp, spans):
+        """Inserisce l'indice di una versione del file già noto (es. dopo una modifica)"""
+        with self._lock:
+            self._entries[filename] = (tuple(stamp), spans)
+            self._entries.move_to_end(filename)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, filename):
+        with self._lock:
+            self._entries.pop(filename, None)
+
+
+offset_indexes = OffsetIndexCache(MAX_ENTRIES)
+
+
+def version(stamp):
+    """Versione di un file per i salvataggi incrementali, da (st_mtime_ns, st_size)"""
+    return f'{stamp[0]:x}-{stamp[1]:x}'
+
+
+def section_ids(spans):
+    """
+    Identificatori delle sezioni: SHA-1 del titolo e del numero di sezioni con
+    lo stesso titolo che la precedono. Non cambiano se si modifica il contenuto
+    della sezione o un'altra sezione (salvo titoli uguali che la precedono).
+    """
+    seen = {}
+    ids = []
+    for span in spans:
+        occurrence = seen.get(span.title, 0)
+        seen[span.title] = occurrence + 1
+        ids.append(hashlib.sha1(f'{span.title}\0{occurrence}'.encode('utf-8')).hexdigest()[:16])
+    return ids
+
+
+def find_command(spans, section_title, label):
+    """
+    Posizione del primo comando con etichetta `label` nelle sezioni intitolate
+    `section_title`, come (indice sezione, indice comando, CommandSpan).
+    Ritorna None se non esiste.
+    """
+    for s_index, span in enumerate(spans):
+        if span.title != section_title:
+            continue
+        for c_index, cmd_span in enumerate(span.commands):
+            if cmd_span.label == label:
+                return s_index, c_index, cmd_span
+    return None
+
+
+def read_span(filename, start, end, stamp):
+    """
+    Legge i byte [start, end) del file con una seek.
+    Ritorna None se nel frattempo il file è cambiato rispetto a stamp.
+    """
+    file_path = os.path.join(settings.PROCEDURE_FILES_DIR, filename)
+    with open(file_path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if (st.st_mtime_ns, st.st_size) != tuple(stamp):
+            return None
+        f.seek(start)
+        return f.read(end - start).decode('utf-8')
+
+
+def toc_entries(spans):
+    """Voci dell'indice: posizione, id, titolo, descrizione e numero di comandi di ogni sezione"""
+    return [
+        {'index': n, 'id': section_id, 'title': span.title, 'desc': span.desc, 'commands': len(span.commands)}
+        for n, (section_id, span) in enumerate(zip(section_ids(spans), spans))
+    ]
+
+
+def table_of_contents(filename):
+    """Versione del file e voci dell'indice delle sue sezioni"""
+    stamp, spans = offset_indexes.get(filename)
+    return version(stamp), toc_entries(spans)
+
+
+def read_section(filename, n):
+    """
+    Sezione n del file (parsing.Section), letta con una sola seek.
+    Solleva IndexError se la sezione non esiste.
+    """
+    for _ in range(2):
+        stamp, sections = offset_indexes.get(filename)
+        if n < 0:
+            raise IndexError(n)
+        span = sections[n]
+        text = read_span(filename, span.start, span.end, stamp)
+        if text is not None:
+            return parse_procedure_lines(io.StringIO(text, newline=''))[0]
+        # File modificato tra la lettura dell'indice e la seek: si ricostruisce l'indice
+    # File che continua a cambiare: si usa il parsing completo
+    return parsed_procedures.get(filename)[n]
@@ -0,0 +1,226 @@
+"""
+Parser del formato testuale delle procedure ([SEZIONE] / COMANDO:).
+
+Il parser lavora riga per riga su un qualsiasi iterabile di righe (anche un file
+aperto) e genera eventi man mano che sezioni e comandi sono completi: la memoria
+usata non dipende dalla dimensione del file ma solo dal comando più lungo.
+
+Le procedure parsate sono liste di Section/Command con __slots__ (titoli ed
+etichette internati, comandi in tuple): vengono convertite nella forma JSON
+({'title', 'desc', 'commands': [{'label', 'cmd'}]}) con to_dict() solo quando
+si costruisce la risposta.
+"""
+import sys
+from collections import namedtuple
+
+SECTION = 'section'
+COMMAND = 'command'
+
+# Posizioni in byte [start, end) di sezioni e comandi nel file (vedi parse_procedure_with_offsets)
+CommandSpan = namedtuple('CommandSpan', ['label', 'start', 'end'])
+SectionSpan = namedtuple('SectionSpan', ['title', 'desc', 'start', 'end', 'commands'])
+
+
+class Command:
+    """Un comando di una sezione"""
+    __slots__ = ('label', 'cmd')
+
+    def __init__(self, label, cmd):
+        # Le etichette si ripetono molto tra le procedure ("Lista container", "Riavvia servizio")
+        self.label = sys.intern(label)
+        self.cmd = cmd
+
+    def __eq__(self, other):
+        return isinstance(other, Command) and (self.label, self.cmd) == (other.label, other.cmd)
+
+    def __repr__(self):
+        return f'Command({self.label!r}, {self.cmd!r})'
+
+    def to_dict(self):
+        return {'label': self.label, 'cmd': self.cmd}
+
+
+class Section:
+    """Una sezione di una procedura; commands è una sequenza di Command (tuple se parsata)"""
+    __slots__ = ('title', 'desc', 'commands')
+
+    def __init__(self, title, desc, commands=()):
+        self.title = sys.intern(title)
+        self.desc = desc
+        self.commands = commands
+
+    def __eq__(self, other):
+        return isinstance(other, Section) and (
+            (self.title, self.desc, list(self.commands)) == (other.title, other.desc, list(other.commands))
+        )
+
+    def __repr__(self):
+        return f'Section({self.title!r}, {self.desc!r}, {self.commands!r})'
+
+    def to_dict(self):
+        return {
+            'title': self.title,
+            'desc': self.desc,
+            'commands': [cmd.to_dict() for cmd in self.commands]
+        }
+
+
+def sections_to_dicts(sections):
+    """Forma JSON di una lista di sezioni"""
+    return [section.to_dict() for section in sections]
+
+
+def _is_section_header(line):
+    return line.startswith('[') and line.endswith(']')
+
+
+def iter_procedure(lines, measure=None):
+    """
+    Genera gli eventi di parsing di una procedura:
+    (SECTION, titolo, descrizione, inizio, fine) e
+    (COMMAND, etichetta, comando, inizio, fine).
+    Ogni comando appartiene all'ultima sezione generata; i comandi prima della
+    prima sezione e quelli vuoti vengono scartati.
+
+    inizio/fine delimitano le righe dell'elemento: per una sezione il titolo e
+    la descrizione, per un comando la riga COMANDO: e il corpo fino all'ultima
+    riga non vuota. Sono numeri di riga, oppure posizioni nell'unità di
+    `measure(riga)` se indicata (es. la lunghezza in byte della riga).
+
+    Formato:
+    [SEZIONE]
+    Descrizione sezione
+
+    COMANDO: Descrizione comando
+    comando riga 1
+    comando riga 2
+    comando riga 3
+
+    COMANDO: Altro comando
+    altro comando
+
+    La descrizione della sezione è la prossima riga non vuota dopo il titolo
+    (qualunque sia il suo contenuto). Un comando prosegue su più righe fino
+    alla prossima sezione o comando.
+    """
+    in_section = False
+    title = None            # sezione in attesa della descrizione
+    label = None            # comando in corso
+    cmd_lines = []
+    pos = 0                 # posizione della fine della riga corrente
+    item_start = item_end = 0
+
+    for raw in lines:
+        start = pos
+        pos += measure(raw) if measure else 1
+        line = raw.strip()
+
+        # Descrizione della sezione: prima riga non vuota dopo il titolo
+        if title is not None:
+            if line:
+                yield SECTION, title, line, item_start, pos
+                title = None
+            continue
+
+        is_header = _is_section_header(line)
+        is_command = line.startswith('COMANDO:')
+
+        if label is not None:
+            if not (is_header or is_command):
+                # Aggiungi la riga (anche se vuota, per mantenere la formattazione)
+                cmd_lines.append(raw.rstrip())
+                if cmd_lines[-1]:
+                    item_end = pos
+                continue
+            # Fine del comando: la riga corrente viene poi gestita normalmente
+            cmd = '\n'.join(cmd_lines).strip()
+            if in_section and cmd:
+                yield COMMAND, label, cmd, item_start, item_end
+            label = None
+
+        # Nuova sezione
+        if is_header:
+            title = line[1:-1]
+            in_section = True
+            item_start = start
+
+        # Nuovo comando
+        elif is_command:
+            label = line.replace('COMANDO:', '').strip()
+            cmd_lines = []
+            item_start, item_end = start, pos
+
+    if title is not None:
+        yield SECTION, title, '', item_start, pos
+    elif label is not None:
+        cmd = '\n'.join(cmd_lines).strip()
+        if in_section and cmd:
+            yield COMMAND, label, cmd, item_start, item_end
+
+
+def parse_procedure_lines(lines):
+    """
+    Parsa una procedura da un iterabile di righe (es. un file aperto in modalità testo).
+    Ritorna una lista di Section.
+    """
+    sections = []
+    commands = []
+    for kind, first, second, _, _ in iter_procedure(lines):
+        if kind == SECTION:
+            if sections:
+                sections[-1].commands = tuple(commands)
+                commands = []
+            sections.append(Section(first, second))
+        else:
+            commands.append(Command(first, second))
+    if sections:
+        sections[-1].commands = tuple(commands)
+    return sections
+
+
+def utf8_length(line):
+    """Lunghezza in byte di una riga codificata in UTF-8 (misura per iter_procedure)"""
+    return len(line) if line.isascii() else len(line.encode('utf-8'))
+
+
+def parse_procedure_with_offsets(lines, size):
+    """
+    Parsa una procedura e ne calcola le posizioni in byte in un solo passaggio.
+    `lines` deve essere un file aperto con newline='' (fine riga non tradotti,
+    così le lunghezze corrispondono ai byte) e `size` la sua dimensione.
+
+    Ritorna (lista di Section, lista di SectionSpan): una sezione va dal titolo
+    all'inizio della sezione successiva, un comando dalla riga COMANDO:
+    all'ultima riga non vuota del corpo.
+    """
+    sections = []
+    spans = []
+    commands = []
+    command_spans = []
+
+    def close_section(end):
+        sections[-1].commands = tuple(commands)
+        spans[-1] = spans[-1]._replace(end=end, commands=tuple(command_spans))
+
+    for kind, first, second, start, end in iter_procedure(lines, measure=utf8_length):
+        if kind == SECTION:
+            if sections:
+                close_section(start)
+                commands = []
+                command_spans = []
+            sections.append(Section(first, second))
+            spans.append(SectionSpan(sections[-1].title, second, start, None, ()))
+        else:
+            commands.append(Command(first, second))
+            command_spans.append(CommandSpan(commands[-1].label, start, end))
+    if sections:
+        close_section(size)
+    return sections, spans
+
+
+def parse_procedure_file(content):
+    """
+    Parsa il contenuto di un file di procedura con formato specifico.
+    Supporta comandi su più righe fino alla prossima sezione o comando.
+    """
+    return parse_procedure_lines(content.strip().split('\n'))
@@ -0,0 +1,639 @@
+"""
+Modifiche puntuali ai file di procedura.
+
+Il comando da modificare viene localizzato con l'indice delle posizioni in byte
+(offsets.py): il nuovo file è scritto in un file temporaneo copiando a blocchi
+la parte prima e dopo il comando, poi sostituisce l'originale con os.replace.
+Il costo è lineare nella dimensione del file e un lettore concorrente vede
+sempre il file vecchio o quello nuovo, mai uno scritto a metà. Tra più
+scrittori (thread o processi) il controllo della versione e la sostituzione
+del file avvengono con un lock esclusivo sul file (file_lock): una modifica
+basata su una versione superata viene sempre rilevata.
+
+Dopo la scrittura sezioni e posizioni del nuovo file sono note senza ri-parsarlo:
+il sidecar compilato viene aggiornato direttamente.
+
+apply_operations applica invece un elenco di modifiche (aggiornamento, aggiunta,
+eliminazione e riordino di comandi) con una sola scrittura: solo le sezioni
+toccate vengono ricomposte, e anche in queste titolo, descrizione e comandi non
+modificati sono copiati byte per byte, comprese le righe che il parser ignora
+(comandi vuoti, testo prima della prima sezione, indentazione).
+
+replace_sections sostituisce intere sezioni (salvataggi incrementali dell'editor
+visuale): solo il testo delle sezioni modificate viene parsato, il resto del
+file è copiato così com'è.
+"""
+import fcntl
+import hashlib
+import io
+import os
+import re
+import stat
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .parsing import Command, Section, _is_section_header, parse_procedure_with_offsets
+from .offsets import find_command, offset_indexes, section_ids, version
+from .procedure_cache import parsed_procedures
+from . import compiled
+
+_NEWLINE_RE = re.compile(r'\r\n|\r|\n')
+_NEWLINE_BYTES_RE = re.compile(rb'\r\n|\r|\n')
+
+COPY_CHUNK = 1024 * 1024
+
+# Tentativi se il file viene modificato da un'altra richiesta durante la scrittura
+MAX_ATTEMPTS = 3
+
+# Operazioni ammesse in una modifica multipla e loro numero massimo per richiesta
+BATCH_OPERATIONS = ('update', 'add', 'delete', 'reorder')
+MAX_BATCH_OPERATIONS = 500
+
+
+class PatchError(Exception):
+    """Modifica non applicabile (il messaggio è mostrato all'utente)"""
+
+
+class CommandNotFound(PatchError):
+    pass
+
+
+class SectionNotFound(PatchError):
+    pass
+
+
+class ConcurrentModification(PatchError):
+    pass
+
+
+class VersionMismatch(ConcurrentModification):
+    """La versione di partenza del client non è più quella del file"""
+
+
+def normalize_command(text):
+    """
+    Righe del corpo di un comando come verranno scritte nel file: senza spazi
+    finali e senza righe vuote iniziali o finali. Solleva PatchError se il
+    corpo è vuoto o contiene righe che il parser leggerebbe come nuova sezione
+    o nuovo comando.
+    """
+    lines = [line.rstrip() for line in _NEWLINE_RE.split(text)]
+    while lines and not lines[0]:
+        lines.pop(0)
+    while lines and not lines[-1]:
+        lines.pop()
+    if not lines:
+        raise PatchError('Il comando non può essere vuoto')
+    for line in lines:
+        stripped = line.strip()
+        if _is_section_header(stripped) or stripped.startswith('COMANDO:'):
+            raise PatchError(f'Riga non ammessa nel corpo del comando: "{stripped}"')
+    return lines
+
+
+def _lock_path(file_path):
+    directory, name = os.path.split(file_path)
+    return os.path.join(directory, f'.{name}.lock')
+
+
+@contextmanager
+def file_lock(file_path):
+    """
+    Lock esclusivo (flock) sul file di lock della procedura, valido tra thread
+    e processi: va tenuto dal controllo della versione fino a os.replace
+    """
+    fd = os.open(_lock_path(file_path), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # La chiusura rilascia il lock
+        os.close(fd)
+
+
+def remove_lock(filename):
+    """Elimina il file di lock della procedura eliminata"""
+    try:
+        os.remove(_lock_path(os.path.join(settings.PROCEDURE_FILES_DIR, filename)))
+    except FileNotFoundError:
+        pass
+
+
+def _copy_range(src, dst, length):
+    """Copia `length` byte da src a dst a blocchi"""
+    while length > 0:
+        chunk = src.read(min(COPY_CHUNK, length))
+        if not chunk:
+            break
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def atomic_write(file_path, write, mode=None):
+    """
+    Scrive un file in modo atomico: write(f) riceve un file temporaneo (binario)
+    nella stessa cartella, che poi sostituisce file_path con os.replace.
+    Ritorna os.stat del nuovo file.
+    """
+    directory = os.path.dirname(file_path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp crea il file con permessi 0600: si mantengono quelli dell'originale
+        os.chmod(tmp_path, mode if mode is not None else 0o644)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return os.stat(file_path)
+
+
+def replace_file(file_path, write):
+    """
+    Sostituisce l'intero file (es. salvataggio completo dall'editor o upload)
+    con una scrittura atomica sotto file_lock, mantenendo i permessi: chi legge
+    il file vede la versione precedente o quella nuova, mai una scritta a metà.
+    write(f) riceve il file temporaneo (binario). Ritorna os.stat del nuovo file.
+    """
+    with file_lock(file_path):
+        try:
+            mode = stat.S_IMODE(os.stat(file_path).st_mode)
+        except FileNotFoundError:
+            mode = None
+        return atomic_write(file_path, write, mode=mode)
+
+
+def _stamp(st):
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _unchanged(file_path, stamp, st):
+    """
+    True se il file è ancora quello letto (stesso inode, `st`) alla versione
+    `stamp`; va chiamata tenendo file_lock
+    """
+    current = os.stat(file_path)
+    return _stamp(current) == tuple(stamp) and current.st_ino == st.st_ino
+
+
+def _shift(span, delta):
+    return span._replace(start=span.start + delta, end=span.end + delta)
+
+
+def replace_command(filename, section_title, label, new_command):
+    """
+    Sostituisce il corpo del primo comando `label` della sezione `section_title`.
+    Ritorna il testo del comando come verrà letto dal parser.
+    Solleva CommandNotFound, PatchError o ConcurrentModification.
+    """
+    file_path = os.path.join(settings.PROCEDURE_FILES_DIR, filename)
+    lines = normalize_command(new_command)
+    cmd = '\n'.join(lines).strip()
+
+    for _ in range(MAX_ATTEMPTS):
+        stamp, spans = offset_indexes.get(filename)
+        found = find_command(spans, section_title, label)
+        if found is None:
+            raise CommandNotFound('Comando non trovato')
+        s_index, c_index, cmd_span = found
+        # Sezioni della stessa versione del file, per aggiornare cache e sidecar dopo la scrittura
+        sections = parsed_procedures.lookup(filename, stamp) or compiled.load(filename, stamp)[0]
+
+        with open(file_path, 'rb') as src:
+            st = os.fstat(src.fileno())
+            if _stamp(st) != tuple(stamp):
+                continue
+
+            # Riga COMANDO: originale con il suo fine riga, riusato per il nuovo corpo
+            src.seek(cmd_span.start)
+            first_line = src.readline().decode('utf-8')
+            match = _NEWLINE_RE.search(first_line)
+            if match:
+                eol = match.group(0)
+                header = first_line[:match.end()].encode('utf-8')
+            else:
+                eol = '\n'
+                header = (first_line + eol).encode('utf-8')
+            body = (eol.join(lines) + eol).encode('utf-8')
+
+            def write(dst):
+                src.seek(0)
+                _copy_range(src, dst, cmd_span.start)
+                dst.write(header)
+                dst.write(body)
+                src.seek(cmd_span.end)
+                _copy_range(src, dst, st.st_size - cmd_span.end)
+
+            # Il file non deve essere cambiato nel frattempo: il controllo e la
+            # sostituzione avvengono sotto lock
+            with file_lock(file_path):
+                if not _unchanged(file_path, stamp, st):
+                    continue
+                new_st = atomic_write(file_path, write, mode=stat.S_IMODE(st.st_mode))
+
+        delta = cmd_span.start + len(header) + len(body) - cmd_span.end
+        _update_compiled(filename, new_st, sections, spans, s_index, c_index, cmd, delta)
+        return cmd
+
+    raise ConcurrentModification('La procedura è stata modificata da un\'altra richiesta, riprova')
+
+
+def _update_compiled(filename, new_st, sections, spans, s_index, c_index, cmd, delta):
+    """
+    Aggiorna cache, indice delle posizioni e sidecar compilato con il nuovo
+    comando e le posizioni spostate, senza ri-parsare il file.
+    """
+    new_sections = list(sections)
+    section = sections[s_index]
+    commands = list(section.commands)
+    commands[c_index] = Command(commands[c_index].label, cmd)
+    new_sections[s_index] = Section(section.title, section.desc, tuple(commands))
+
+    new_spans = []
+    for n, span in enumerate(spans):
+        if n < s_index:
+            new_spans.append(span)
+        elif n > s_index:
+            new_spans.append(_shift(span, delta)._replace(
+                commands=tuple(_shift(c, delta) for c in span.commands)
+            ))
+        else:
+            cmd_spans = list(span.commands)
+            cmd_spans[c_index] = cmd_spans[c_index]._replace(end=cmd_spans[c_index].end + delta)
+            for i in range(c_index + 1, len(cmd_spans)):
+                cmd_spans[i] = _shift(cmd_spans[i], delta)
+            new_spans.append(span._replace(end=span.end + delta, commands=tuple(cmd_spans)))
+
+    _remember(filename, new_st, new_sections, new_spans)
+
+
+def _remember(filename, new_st, sections, spans, digest=None):
+    """Salva in cache, nell'indice delle posizioni e nel sidecar la nuova versione del file"""
+    stamp = _stamp(new_st)
+    parsed_procedures.store(filename, stamp, sections)
+    offset_indexes.store(filename, stamp, spans)
+    if compiled.enabled():
+        if digest is None:
+            digest = compiled.file_hash(compiled.source_path(filename))
+        compiled.write(filename, sections, spans, digest, stamp)
+
+
+def _text_field(op, key):
+    value = op.get(key)
+    if not isinstance(value, str) or not value.strip():
+        raise PatchError(f'Campo "{key}" mancante')
+    return value
+
+
+def _label_field(op, key='command_label'):
+    """Etichetta di un comando, come verrà riletta dal parser"""
+    label = _text_field(op, key).strip()
+    if '\n' in label or '\r' in label or 'COMANDO:' in label:
+        raise PatchError(f'Etichetta non valida: "{label}"')
+    return label
+
+
+def _find_command(sections, title, label):
+    """(sezione, indice) del primo comando `label` nelle sezioni intitolate `title`"""
+    for section in sections:
+        if section.title != title:
+            continue
+        for n, command in enumerate(section.commands):
+            if command.label == label:
+                return section, n
+    raise CommandNotFound(f'Comando "{label}" non trovato nella sezione "{title}"')
+
+
+def _find_section(sections, title):
+    for section in sections:
+        if section.title == title:
+            return section
+    raise CommandNotFound(f'Sezione "{title}" non trovata')
+
+
+class _WorkingCommand(Command):
+    """
+    Comando durante una modifica multipla: origin è la posizione del comando
+    originale nella sezione (None se aggiunto), lines il nuovo corpo da
+    scrivere (None se invariato)
+    """
+    __slots__ = ('origin', 'lines')
+
+    def __init__(self, label, cmd, origin=None, lines=None):
+        super().__init__(label, cmd)
+        self.origin = origin
+        self.lines = lines
+
+
+def _apply_operation(sections, op):
+    """Applica una singola operazione alle sezioni (con commands come liste)"""
+    if not isinstance(op, dict):
+        raise PatchError('Operazione non valida')
+    kind = op.get('op', 'update')
+    if kind not in BATCH_OPERATIONS:
+        raise PatchError(f'Operazione sconosciuta: "{kind}"')
+    title = _text_field(op, 'section')
+
+    if kind == 'update':
+        section, n = _find_command(sections, title, _label_field(op))
+        lines = normalize_command(_text_field(op, 'new_command'))
+        old = section.commands[n]
+        section.commands[n] = _WorkingCommand(old.label, '\n'.join(lines).strip(), old.origin, lines)
+
+    elif kind == 'add':
+        section = _find_section(sections, title)
+        if not section.desc:
+            # Senza descrizione il parser leggerebbe la riga COMANDO: come descrizione
+            raise PatchError(f'La sezione "{title}" non ha una descrizione: impossibile aggiungere comandi')
+        lines = normalize_command(_text_field(op, 'new_command'))
+        command = _WorkingCommand(_label_field(op), '\n'.join(lines).strip(), lines=lines)
+        position = op.get('position', len(section.commands))
+        if not isinstance(position, int) or isinstance(position, bool) or not 0 <= position <= len(section.commands):
+            raise PatchError('Posizione non valida')
+        section.commands.insert(position, command)
+
+    elif kind == 'delete':
+        section, n = _find_command(sections, title, _label_field(op))
+        del section.commands[n]
+
+    else:
+        section = _find_section(sections, title)
+        order = op.get('order')
+        if not isinstance(order, list) or not all(isinstance(label, str) for label in order):
+            raise PatchError('Campo "order" mancante')
+        # Le etichette possono ripetersi: ognuna prende il primo comando non ancora usato
+        remaining = list(section.commands)
+        reordered = []
+        for label in order:
+            for n, command in enumerate(remaining):
+                if command.label == label.strip():
+                    reordered.append(remaining.pop(n))
+                    break
+            else:
+                raise CommandNotFound(f'Comando "{label}" non trovato nella sezione "{title}"')
+        if remaining:
+            raise PatchError('L\'ordine deve elencare tutti i comandi della sezione')
+        section.commands = reordered
+
+
+def _section_changed(section, count):
+    """True se le operazioni hanno toccato la sezione, che aveva `count` comandi"""
+    return (
+        [command.origin for command in section.commands] != list(range(count))
+        or any(command.lines is not None for command in section.commands)
+    )
+
+
+def _section_bytes(data, span, section, eol):
+    """
+    Nuovo testo di una sezione modificata da apply_operations. Titolo e
+    descrizione, comandi invariati e righe che seguono ogni comando fino al
+    successivo (righe vuote, comandi vuoti ignorati dal parser) sono copiati
+    dal file originale `data`; i comandi aggiornati mantengono la riga COMANDO:
+    originale e quelli aggiunti sono scritti nel formato del file.
+    """
+    starts = [c.start for c in span.commands]
+    ends = starts[1:] + [span.end]
+    eol_bytes = eol.encode('utf-8')
+    parts = [data[span.start:starts[0] if starts else span.end]]
+
+    def emit(chunk):
+        # Ogni parte deve iniziare su una nuova riga
+        if chunk and parts[-1] and not parts[-1].endswith((b'\n', b'\r')):
+            parts.append(eol_bytes)
+        parts.append(chunk)
+
+    # Righe non vuote che seguivano un comando eliminato: restano dopo il comando
+    # originale precedente ancora presente (o dopo la descrizione)
+    kept = {command.origin for command in section.commands if command.origin is not None}
+    orphans = {}
+    for n, cmd_span in enumerate(span.commands):
+        gap = data[cmd_span.end:ends[n]]
+        if n not in kept and gap.strip():
+            previous = max((i for i in kept if i < n), default=None)
+            orphans.setdefault(previous, []).append(gap)
+    for gap in orphans.get(None, []):
+        emit(gap)
+
+    for command in section.commands:
+        n = command.origin
+        if n is None:
+            body = eol.join(command.lines) + eol
+            emit(f'COMANDO: {command.label}{eol}{body}{eol}'.encode('utf-8'))
+            continue
+        cmd_span = span.commands[n]
+        if command.lines is None:
+            emit(data[cmd_span.start:ends[n]])
+        else:
+            # Riga COMANDO: originale con il suo fine riga, poi il nuovo corpo
+            match = _NEWLINE_BYTES_RE.search(data, cmd_span.start)
+            line_eol = match.group(0).decode('ascii')
+            body = (line_eol.join(command.lines) + line_eol).encode('utf-8')
+            emit(data[cmd_span.start:match.end()] + body + data[cmd_span.end:ends[n]])
+        for gap in orphans.get(n, []):
+            emit(gap)
+
+    return b''.join(parts)
+
+
+def apply_operations(filename, operations):
+    """
+    Applica in ordine un elenco di operazioni ai comandi di una procedura e
+    riscrive il file con una sola scrittura atomica. Ogni operazione è un dict:
+    - {'op': 'update', 'section', 'command_label', 'new_command'} ('op' predefinito)
+    - {'op': 'add', 'section', 'command_label', 'new_command', 'position' (opzionale)}
+    - {'op': 'delete', 'section', 'command_label'}
+    - {'op': 'reorder', 'section', 'order': [etichette]}
+    Le operazioni sono validate tutte prima della scrittura: se una fallisce il
+    file non viene modificato. Il contenuto fuori dalle sezioni toccate resta
+    identico byte per byte. Ritorna le nuove sezioni.
+    Solleva CommandNotFound, PatchError o ConcurrentModification.
+    """
+    file_path = os.path.join(settings.PROCEDURE_FILES_DIR, filename)
+
+    for _ in range(MAX_ATTEMPTS):
+        stamp, spans = offset_indexes.get(filename)
+        sections = parsed_procedures.lookup(filename, stamp) or compiled.load(filename, stamp)[0]
+
+        # Copie modificabili (le sezioni in cache sono condivise), ognuna con la
+        # posizione del comando originale
+        working = [
+            Section(section.title, section.desc, [
+                _WorkingCommand(command.label, command.cmd, n) for n, command in enumerate(section.commands)
+            ])
+            for section in sections
+        ]
+        for n, op in enumerate(operations):
+            try:
+                _apply_operation(working, op)
+            except PatchError as e:
+                raise type(e)(f'Operazione {n + 1}: {e}') from e
+
+        changed = [
+            n for n, section in enumerate(working) if _section_changed(section, len(sections[n].commands))
+        ]
+        if not changed:
+            return sections
+
+        with open(file_path, 'rb') as src:
+            st = os.fstat(src.fileno())
+            if _stamp(st) != tuple(stamp):
+                continue
+            original = src.read()
+
+            # Le sezioni toccate sostituiscono i loro byte, il resto è copiato così com'è
+            first_line_end = original.find(b'\n')
+            eol = '\r\n' if first_line_end > 0 and original[first_line_end - 1:first_line_end] == b'\r' else '\n'
+            parts = []
+            pos = 0
+            for n in changed:
+                parts.append(original[pos:spans[n].start])
+                parts.append(_section_bytes(original, spans[n], working[n], eol))
+                pos = spans[n].end
+            parts.append(original[pos:])
+            data = b''.join(parts)
+
+            # Il testo riletto dal parser deve dare esattamente le sezioni modificate
+            new_sections, new_spans = parse_procedure_with_offsets(
+                io.StringIO(data.decode('utf-8'), newline=''), len(data)
+            )
+            if new_sections != working:
+                raise PatchError('Le modifiche producono una procedura non valida')
+
+            with file_lock(file_path):
+                if not _unchanged(file_path, stamp, st):
+                    continue
+                new_st = atomic_write(file_path, lambda f: f.write(data), mode=stat.S_IMODE(st.st_mode))
+
+        _remember(filename, new_st, new_sections, new_spans, hashlib.sha256(data).hexdigest())
+        return new_sections
+
+    raise ConcurrentModification('La procedura è stata modificata da un\'altra richiesta, riprova')
+
+
+def _section_chunk(text, eol):
+    """
+    Testo di una o più sezioni come verrà scritto nel file (fine riga del file,
+    righe vuote iniziali rimosse), con sezioni e posizioni relative al testo.
+    """
+    lines = [line.rstrip() for line in _NEWLINE_RE.split(text)]
+    while lines and not lines[0]:
+        lines.pop(0)
+    while lines and not lines[-1]:
+        lines.pop()
+    if not lines:
+        return b'', [], []
+    # Il testo prima del primo titolo finirebbe nell'ultimo comando della sezione precedente
+    if not _is_section_header(lines[0].strip()):
+        raise PatchError('Il contenuto di una sezione deve iniziare con il titolo [SEZIONE]')
+    text = ''.join(line + eol for line in lines) + eol
+    data = text.encode('utf-8')
+    sections, spans = parse_procedure_with_offsets(io.StringIO(text, newline=''), len(data))
+    for section in sections:
+        # Senza descrizione il parser leggerebbe la riga successiva del file come descrizione
+        if not section.desc:
+            raise PatchError(f'La sezione "{section.title}" deve avere una descrizione')
+    return data, sections, spans
+
+
+def replace_sections(filename, base_version, changes):
+    """
+    Sostituisce sezioni del file partendo dalla versione base_version (vedi
+    offsets.version). changes è una lista di (id sezione, testo): il testo
+    sostituisce la sezione (testo vuoto la elimina); con id None le sezioni del
+    testo vengono aggiunte in fondo.
+    Il costo di parsing è proporzionale alle sole sezioni modificate.
+    Ritorna (nuova versione, lista di SectionSpan).
+    Solleva VersionMismatch, SectionNotFound o PatchError.
+    """
+    file_path = os.path.join(settings.PROCEDURE_FILES_DIR, filename)
+    stamp, spans = offset_indexes.get(filename)
+    if version(stamp) != base_version:
+        raise VersionMismatch('La procedura è stata modificata nel frattempo: ricarica e riprova')
+
+    index = {section_id: n for n, section_id in enumerate(section_ids(spans))}
+    replaced = {}
+    appended = []
+    for section_id, text in changes:
+        if section_id is None:
+            appended.append(text)
+        elif section_id not in index:
+            raise SectionNotFound(f'Sezione "{section_id}" non trovata')
+        elif index[section_id] in replaced:
+            raise PatchError(f'Sezione "{section_id}" indicata più volte')
+        else:
+            replaced[index[section_id]] = text
+    sections = parsed_procedures.lookup(filename, stamp) or compiled.load(filename, stamp)[0]
+
+    with open(file_path, 'rb') as src:
+        st = os.fstat(src.fileno())
+        if _stamp(st) != tuple(stamp):
+            raise VersionMismatch('La procedura è stata modificata nel frattempo: ricarica e riprova')
+        first_line = src.readline()
+        eol = '\r\n' if first_line.endswith(b'\r\n') else '\n'
+
+        chunks = {n: _section_chunk(text, eol) for n, text in replaced.items()}
+        tail, tail_sections, tail_spans = _section_chunk(''.join(text + '\n' for text in appended), eol)
+        separator = b''
+        if tail and st.st_size and len(spans) - 1 not in chunks:
+            if spans and not sections[-1].desc:
+                raise PatchError(f'La sezione "{sections[-1].title}" deve avere una descrizione')
+            # Le sezioni aggiunte devono iniziare su una nuova riga
+            src.seek(st.st_size - 1)
+            if src.read(1) not in (b'\n', b'\r'):
+                separator = eol.encode('utf-8')
+
+        # Nuove sezioni e posizioni: quelle non modificate sono spostate della
+        # differenza di lunghezza accumulata
+        new_sections = []
+        new_spans = []
+        delta = 0
+
+        def place(chunk_sections, chunk_spans, offset):
+            new_sections.extend(chunk_sections)
+            new_spans.extend(_shift(span, offset)._replace(
+                commands=tuple(_shift(c, offset) for c in span.commands)
+            ) for span in chunk_spans)
+
+        for n, span in enumerate(spans):
+            if n in chunks:
+                data, chunk_sections, chunk_spans = chunks[n]
+                place(chunk_sections, chunk_spans, span.start + delta)
+                delta += len(data) - (span.end - span.start)
+            else:
+                place([sections[n]], [span], delta)
+        if separator and new_spans:
+            # Il fine riga aggiunto appartiene all'ultima sezione (e al suo ultimo comando)
+            last = new_spans[-1]
+            commands = list(last.commands)
+            if commands and commands[-1].end == last.end:
+                commands[-1] = commands[-1]._replace(end=last.end + len(separator))
+            new_spans[-1] = last._replace(end=last.end + len(separator), commands=tuple(commands))
+        place(tail_sections, tail_spans, st.st_size + delta + len(separator))
+
+        def write(dst):
+            pos = 0
+            for n in sorted(chunks):
+                src.seek(pos)
+                _copy_range(src, dst, spans[n].start - pos)
+                dst.write(chunks[n][0])
+                pos = spans[n].end
+            src.seek(pos)
+            _copy_range(src, dst, st.st_size - pos)
+            dst.write(separator + tail)
+
+        # Il file non deve essere cambiato nel frattempo: il controllo e la
+        # sostituzione avvengono sotto lock
+        with file_lock(file_path):
+            if not _unchanged(file_path, stamp, st):
+                raise VersionMismatch('La procedura è stata modificata nel frattempo: ricarica e riprova')
+            new_st = atomic_write(file_path, write, mode=stat.S_IMODE(st.st_mode))
+
+    _remember(filename, new_st, new_sections, new_spans)
+    return version(_stamp(new_st)), new_spans
@@ -0,0 +1,226 @@
+"""
+Varianti precompresse delle risposte sui file di procedura.
+
+Il JSON delle procedure e i file .txt scaricati vengono compressi una sola
+volta per versione del contenuto: la variante è salvata in
+PROCEDURE_COMPRESSED_DIR/<file>/<sha256 del contenuto>.<estensione> e
+riutilizzata finché il contenuto non cambia, così la CPU di compressione non
+si paga a ogni richiesta. Le varianti di un file vengono eliminate quando la
+procedura viene modificata o eliminata (vedi signals.py).
+
+gzip è sempre disponibile; brotli e zstd si usano se i moduli `brotli` e
+`zstandard` sono installati. La codifica è scelta secondo Accept-Encoding.
+"""
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Sotto questa dimensione la compressione non conviene
+MIN_SIZE = 512
+
+# Codifiche disponibili in ordine di preferenza: (nome, estensione, compressione).
+# La variante viene creata nella richiesta che la chiede per prima: livelli
+# moderati, perché i livelli massimi costano secondi su un file di qualche MB
+# e guadagnano pochi punti percentuali.
+ENCODINGS = []
+if zstandard is not None:
+    ENCODINGS.append(('zstd', 'zst', lambda data: zstandard.ZstdCompressor(level=6).compress(data)))
+if brotli is not None:
+    ENCODINGS.append(('br', 'br', lambda data: brotli.compress(data, quality=5)))
+ENCODINGS.append(('gzip', 'gz', lambda data: gzip.compress(data, compresslevel=6, mtime=0)))
+
+_EXTENSIONS = {name: extension for name, extension, _ in ENCODINGS}
+_COMPRESSORS = {name: compress for name, _, compress in ENCODINGS}
+
+# Varianti in corso di creazione in questo processo
+_in_progress = set()
+_in_progress_lock = threading.Lock()
+
+
+def _compressed_dir():
+    return getattr(settings, 'PROCEDURE_COMPRESSED_DIR', None)
+
+
+def enabled():
+    return bool(_compressed_dir())
+
+
+def negotiate(request):
+    """Codifica da usare per la risposta secondo Accept-Encoding (None: nessuna)"""
+    if not enabled():
+        return None
+    accepted = {}
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+    for name, _, _ in ENCODINGS:
+        if accepted.get(name, accepted.get('*', 0)) > 0:
+            return name
+    return None
+
+
+def variant_path(filename, digest, encoding):
+    return os.path.join(_compressed_dir(), filename, f'{digest}.{_EXTENSIONS[encoding]}')
+
+
+def variant(filename, digest, encoding, read):
+    """
+    Percorso della variante compressa del contenuto con hash `digest`, creata
+    la prima volta comprimendo read(). Ritorna None se non può essere salvata,
+    se read() ritorna None o se un'altra richiesta la sta già creando (la
+    risposta viene inviata non compressa invece di comprimere due volte).
+    """
+    path = variant_path(filename, digest, encoding)
+    if os.path.exists(path):
+        return path
+    with _in_progress_lock:
+        if path in _in_progress:
+            return None
+        _in_progress.add(path)
+    try:
+        content = read()
+        if content is None:
+            return None
+        data = _COMPRESSORS[encoding](content)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            # Cartella non scrivibile: la risposta viene inviata non compressa
+            return None
+        return path
+    finally:
+        with _in_progress_lock:
+            _in_progress.discard(path)
+
+
+def open_variant(path):
+    """
+    Apre la variante `path` e ritorna (file, stat), o None se nel frattempo è
+    stata eliminata da discard(): la risposta va inviata non compressa.
+    """
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    return f, os.fstat(f.fileno())
+
+
+def compress_response(response, filename, encoding):
+    """
+    Sostituisce il corpo di una risposta in memoria (es. JsonResponse) con la
+    sua variante precompressa, se la codifica è accettata dal client.
+    """
+    patch_vary_headers(response, ('Accept-Encoding',))
+    body = response.content
+    if encoding is None or len(body) < MIN_SIZE:
+        return response
+    path = variant(filename, hashlib.sha256(body).hexdigest(), encoding, lambda: body)
+    opened = open_variant(path) if path else None
+    if opened is None:
+        return response
+    with opened[0] as f:
+        response.content = f.read()
+    response['Content-Encoding'] = encoding
+    return response
+
+
+class FileDigestCache:
+    """Hash SHA-256 dei file di procedura per (file, st_mtime_ns, st_size)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, f, st):
+        """
+        Hash del contenuto del file aperto `f` (in modalità binaria) con stat `st`.
+        Ritorna None se il file cambia mentre viene letto.
+        """
+        key = (f.name, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            digest = self._entries.get(key)
+            if digest is not None:
+                self._entries.move_to_end(key)
+                return digest
+
+        position = f.tell()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+        f.seek(position)
+        after = os.fstat(f.fileno())
+        if (after.st_mtime_ns, after.st_size) != (st.st_mtime_ns, st.st_size):
+            return None
+
+        digest = digest.hexdigest()
+        with self._lock:
+            self._entries[key] = digest
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return digest
+
+
+file_digests = FileDigestCache(256)
+
+
+def file_variant(filename, f, st, encoding):
+    """
+    Percorso della variante compressa del file aperto `f` (binario, con stat
+    `st`), o None se non serve o non è disponibile.
+    """
+    if encoding is None or st.st_size < MIN_SIZE:
+        return None
+    digest = file_digests.get(f, st)
+    if digest is None:
+        return None
+
+    def read():
+        position = f.tell()
+        content = f.read()
+        f.seek(position)
+        # Il file potrebbe essere cambiato dopo il calcolo dell'hash
+        return content if hashlib.sha256(content).hexdigest() == digest else None
+
+    return variant(filename, digest, encoding, read)
+
+
+def discard(filename):
+    """Elimina le varianti compresse di un file (dopo una modifica o un'eliminazione)"""
+    if not enabled():
+        return
+    shutil.rmtree(os.path.join(_compressed_dir(), filename), ignore_errors=True)
@@ -0,0 +1,181 @@
+"""
+Cache di processo delle procedure parsate.
+
+Le voci sono indicizzate per nome file e validate con (st_mtime_ns, st_size):
+finché il file non cambia, le letture successive non aprono né ri-parsano il file.
+Alla prima lettura (o dopo una modifica) le sezioni vengono caricate dal sidecar
+compilato (vedi compiled.py) e il file viene parsato solo se il sidecar non è valido.
+La cache è un LRU limitato dalla dimensione stimata in byte delle sezioni parsate.
+"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import compiled
+
+
+def estimate_size(sections):
+    """
+    Stima in byte della memoria occupata dalle sezioni parsate.
+    Titoli ed etichette sono internati e condivisi: vengono contati comunque
+    per intero, la stima è per eccesso.
+    """
+    size = sys.getsizeof(sections)
+    for section in sections:
+        size += sys.getsizeof(section) + sys.getsizeof(section.commands)
+        size += sys.getsizeof(section.title) + sys.getsizeof(section.desc)
+        for cmd in section.commands:
+            size += sys.getsizeof(cmd) + sys.getsizeof(cmd.label) + sys.getsizeof(cmd.cmd)
+    return size
+
+
+class ParsedProcedureCache:
+    """
+    LRU delle sezioni parsate (liste di parsing.Section) per file di procedura.
+    Le liste restituite sono condivise tra le richieste: non vanno modificate.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # filename -> (stamp, size, sections)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.parses = 0
+
+    def get(self, filename):
+        """
+        Ritorna le sezioni parsate del file.
+        Solleva FileNotFoundError se il file non esiste.
+        """
+        file_path = os.path.join(settings.PROCEDURE_FILES_DIR, filename)
+        st = os.stat(file_path)
+        stamp = (st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(filename)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        sections, _, parsed = compiled.load(filename, stamp)
+        if parsed:
+            with self._lock:
+                self.parses += 1
+
+        self._store(filename, stamp, sections)
+        return sections
+
+    def get_many(self, filenames, executor=None):
+        """
+        Sezioni parsate di più file, come dict nome file -> sezioni. I file non
+        in cache vengono letti in parallelo su `executor`, se indicato; quelli
+        che non si possono leggere sono omessi dal risultato.
+        """
+        results = {}
+        missing = []
+        for filename in filenames:
+            try:
+                st = os.stat(os.path.join(settings.PROCEDURE_FILES_DIR, filename))
+            except OSError:
+                continue
+            sections = self.lookup(filename, (st.st_mtime_ns, st.st_size))
+            if sections is not None:
+                results[filename] = sections
+            else:
+                missing.append(filename)
+
+        futures = {}
+        if executor is not None and len(missing) > 1:
+            futures = {filename: executor.submit(self.get, filename) for filename in missing}
+        for filename in missing:
+            try:
+                future = futures.get(filename)
+                results[filename] = future.result() if future else self.get(filename)
+            except Exception:
+                # Ignora errori di lettura file singoli
+                continue
+        return results
+
+    def lookup(self, filename, stamp):
+        """Sezioni in cache per una versione precisa del file (None se assenti)"""
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[0] == tuple(stamp):
+                self._entries.move_to_end(filename)
+                self.hits += 1
+                return entry[2]
+        return None
+
+    def store(self, filename, stamp, sections):
+        """Inserisce le sezioni di una versione del file già note (es. dopo una modifica)"""
+        self._store(filename, tuple(stamp), sections)
+
+    def _store(self, filename, stamp, sections):
+        size = estimate_size(sections)
+        with self._lock:
+            self._discard(filename)
+            if size > self.max_bytes:
+                # Troppo grande per la cache: viene servito ma non conservato
+                return
+            self._entries[filename] = (stamp, size, sections)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def _discard(self, filename):
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def invalidate(self, filename):
+        """Rimuove la voce di un file (dopo una scrittura o un'eliminazione)"""
+        with self._lock:
+            self._discard(filename)
+
+    def discard_stale(self, filename):
+        """
+        Rimuove la voce di un file se non è la versione su disco: quella appena
+        salvata da una modifica puntuale (vedi patching._remember) resta in cache.
+        """
+        try:
+            st = os.stat(os.path.join(settings.PROCEDURE_FILES_DIR, filename))
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[0] != stamp:
+                self._discard(filename)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Contatori di utilizzo della cache"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'parses': self.parses,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+parsed_procedures = ParsedProcedureCache(
+    getattr(settings, 'PROCEDURE_PARSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+)
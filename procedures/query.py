@@ -0,0 +1,143 @@
+"""
+Compilatore delle query di ricerca.
+
+La query `q` viene compilata una volta per richiesta in un CompiledQuery:
+- termini separati da spazi, tutti obbligatori: git push
+- frasi tra virgolette: "git push origin"
+- esclusioni: !legacy, !"force push", !cmd:sudo (anche -"force push", -cmd:sudo)
+- prefissi di campo: title:, desc:, label:, cmd:, name:, description:
+  (es. cmd:"git push" title:remote)
+
+Una parola con il trattino resta un termine letterale, perché nei comandi è
+quasi sempre un'opzione: "ls -la", "tar -xzf", "git push --force".
+Una sola regex (alternanza dei termini positivi) serve sia per scartare
+rapidamente i testi senza match sia per evidenziare o calcolare gli offset.
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# Campi: metadati della categoria, sezione, comando
+FIELDS = ('name', 'description', 'title', 'desc', 'label', 'cmd')
+
+_TOKEN_RE = re.compile(r'(?P<neg>[-!])?(?:(?P<field>[A-Za-z]+):)?(?:"(?P<phrase>[^"]*)"?|(?P<word>[^\s"]+))')
+
+
+class Term(namedtuple('Term', ['needle', 'field', 'negated', 'phrase'])):
+    """Un termine compilato; needle è in minuscolo"""
+    __slots__ = ()
+
+    def __str__(self):
+        text = f'"{self.needle}"' if self.phrase else self.needle
+        if self.field:
+            text = f'{self.field}:{text}'
+        return f'!{text}' if self.negated else text
+
+
+def _parse_terms(raw):
+    terms = []
+    for m in _TOKEN_RE.finditer(raw):
+        neg = m.group('neg')
+        negated = bool(neg)
+        field = m.group('field')
+        phrase = m.group('phrase')
+        word = m.group('word')
+        text = phrase if phrase is not None else word
+
+        if field and field.lower() not in FIELDS:
+            # Non è un prefisso di campo (es. "80:80"): termine letterale
+            text = f'{field}:{text}'
+            field = None
+        elif field:
+            field = field.lower()
+
+        if negated and phrase is None and not field and (neg == '-' or word.startswith('!')):
+            # Opzioni come -la, -xzf, --force: si cercano così come sono
+            text = neg + word
+            negated = False
+
+        if text:
+            terms.append(Term(text.lower(), field, negated, phrase is not None))
+    return terms
+
+
+class CompiledQuery:
+    """Matcher riusabile per una query: verifica dei match, evidenziazione e offset"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.terms = _parse_terms(raw)
+        self.positive = [t for t in self.terms if not t.negated]
+        self.negative = [t for t in self.terms if t.negated]
+        alternatives = sorted({t.needle for t in self.positive}, key=len, reverse=True)
+        self.pattern = (
+            re.compile('|'.join(map(re.escape, alternatives)), re.IGNORECASE)
+            if alternatives else None
+        )
+        # Forma canonica: query equivalenti hanno la stessa (usata nelle chiavi di cache)
+        self.canonical = ' '.join(sorted(str(t) for t in self.terms))
+
+    def is_empty(self):
+        """Una query senza termini positivi non può trovare nulla"""
+        return not self.positive
+
+    def matches(self, own, context=None):
+        """
+        Verifica un'unità di ricerca (metadati, sezione o comando).
+        `own` sono i campi dell'unità, `context` quelli dei contenitori
+        (sezione e categoria), entrambi come dict campo -> testo in minuscolo.
+
+        Tutti i termini positivi devono essere presenti (quelli con prefisso anche
+        nel contesto) e almeno uno nei campi propri; nessuna esclusione deve esserlo.
+        """
+        if self.pattern is None or not any(self.pattern.search(text) for text in own.values()):
+            return False
+        context = context or {}
+
+        own_hit = False
+        for term in self.positive:
+            if term.field is None:
+                if not any(term.needle in text for text in own.values()):
+                    return False
+                own_hit = True
+            elif term.field in own:
+                if term.needle not in own[term.field]:
+                    return False
+                own_hit = True
+            elif term.needle not in context.get(term.field, ''):
+                return False
+        if not own_hit:
+            return False
+
+        for term in self.negative:
+            if term.field is None:
+                if any(term.needle in text for text in own.values()):
+                    return False
+            elif term.needle in own.get(term.field, context.get(term.field, '')):
+                return False
+        return True
+
+    def rewrite(self, corrections):
+        """Query con i termini positivi sostituiti secondo corrections (needle -> nuovo needle)"""
+        terms = [
+            term if term.negated else term._replace(needle=corrections.get(term.needle, term.needle))
+            for term in self.terms
+        ]
+        return compile_query(' '.join(str(term) for term in terms))
+
+    def highlight(self, text):
+        """Evidenzia i termini nel testo con tag <mark>"""
+        if not text or self.pattern is None:
+            return text
+        return self.pattern.sub(lambda m: f'<mark class="highlight">{m.group(0)}</mark>', text)
+
+    def offsets(self, text):
+        """Posizioni [inizio, fine) dei termini nel testo (in caratteri)"""
+        if not text or self.pattern is None:
+            return []
+        return [[m.start(), m.end()] for m in self.pattern.finditer(text)]
+
+
+@lru_cache(maxsize=256)
+def compile_query(raw):
+    return CompiledQuery(raw)
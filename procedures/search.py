@@ -0,0 +1,494 @@
+"""
+Motore di ricerca delle procedure.
+
+Raccoglie i match (indice full-text se disponibile, altrimenti scansione dei
+file parsati in parallelo su un pool di thread, con un tempo massimo per
+richiesta), assegna un punteggio di rilevanza stile BM25 pesato per campo e
+seleziona i primi k risultati con un heap limitato: solo la pagina richiesta
+viene evidenziata e serializzata. Se la ricerca esatta non trova nulla (o su
+richiesta) la query viene riscritta con le correzioni dell'indice fuzzy.
+
+Le unità di ricerca sono i metadati della categoria, le sezioni e i comandi;
+la query (CompiledQuery) viene verificata su ciascuna con il contesto dei
+contenitori, così i prefissi title:/name: filtrano anche i comandi.
+"""
+import hashlib
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .parsing import Command, Section
+from .procedure_cache import parsed_procedures
+from .fuzzy import fuzzy_index
+from . import corpus, search_index
+
+# Pesi di default per campo (sovrascrivibili con PROCEDURE_SEARCH_WEIGHTS)
+DEFAULT_WEIGHTS = {
+    'name': 3.0,         # nome della categoria
+    'description': 1.5,  # descrizione della categoria
+    'title': 2.0,        # titolo della sezione
+    'desc': 1.0,         # descrizione della sezione
+    'label': 2.0,        # etichetta del comando
+    'cmd': 1.0,          # corpo del comando
+}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Colonne dell'indice full-text in cui cercare un termine, per prefisso di campo
+# (name/description non sono nell'indice: i metadati sono verificati a parte)
+INDEX_COLUMNS = {
+    None: ('title', 'description', 'label', 'body'),
+    'title': ('title',),
+    'desc': ('description',),
+    'label': ('label',),
+    'cmd': ('body',),
+}
+
+HIGHLIGHT_MODES = ('html', 'offsets')
+
+# Ricerca fuzzy: solo senza risultati esatti (auto), sempre (on) o mai (off)
+FUZZY_AUTO = 'auto'
+FUZZY_ON = 'on'
+FUZZY_OFF = 'off'
+FUZZY_MODES = {'auto': FUZZY_AUTO, '1': FUZZY_ON, 'true': FUZZY_ON, 'on': FUZZY_ON,
+               '0': FUZZY_OFF, 'false': FUZZY_OFF, 'off': FUZZY_OFF}
+
+
+def get_weights():
+    weights = dict(DEFAULT_WEIGHTS)
+    weights.update(getattr(settings, 'PROCEDURE_SEARCH_WEIGHTS', {}))
+    return weights
+
+
+class Candidate:
+    """Un risultato potenziale (metadati o contenuto di una categoria) con il suo punteggio"""
+    __slots__ = ('type', 'category', 'order', 'sections', 'score')
+
+    def __init__(self, type, category, order, sections=None):
+        self.type = type
+        self.category = category
+        self.order = order
+        self.sections = sections
+        self.score = 0.0
+
+    def fields(self):
+        """Coppie (campo, testo) su cui calcolare il punteggio"""
+        if self.type == 'category':
+            yield 'name', self.category.name
+            yield 'description', self.category.description
+            return
+        for section in self.sections:
+            yield 'title', section.title
+            yield 'desc', section.desc
+            for cmd in section.commands:
+                yield 'label', cmd.label
+                yield 'cmd', cmd.cmd
+
+
+def _category_fields(cat):
+    return {'name': cat.name.lower(), 'description': cat.description.lower()}
+
+
+def _section_fields(title, desc):
+    return {'title': title.lower(), 'desc': desc.lower()}
+
+
+def _command_fields(label, cmd):
+    return {'label': label.lower(), 'cmd': cmd.lower()}
+
+
+def content_matches_index(categories, query):
+    """Sezioni e comandi che soddisfano la query, letti dall'indice full-text"""
+    terms = [
+        (term.needle, INDEX_COLUMNS[term.field])
+        for term in query.positive
+        if term.field in INDEX_COLUMNS
+    ]
+    if not terms:
+        return []
+
+    by_id = {cat.id: cat for cat in categories}
+    contexts = {}
+    matches = {}
+    for row in search_index.search_terms(terms):
+        cat = by_id.get(row.category_id)
+        if cat is None:
+            # Categoria non visibile all'utente
+            continue
+        if row.category_id not in contexts:
+            contexts[row.category_id] = _category_fields(cat)
+        context = dict(contexts[row.category_id])
+
+        if row.command < 0:
+            own = _section_fields(row.title, row.description)
+        else:
+            own = _command_fields(row.label, row.body)
+            context.update(_section_fields(row.section_title, row.section_desc))
+        if not query.matches(own, context):
+            continue
+
+        sections = matches.setdefault(row.category_id, {})
+        section = sections.get(row.section)
+        if section is None:
+            section = sections[row.section] = Section(row.section_title, row.section_desc, [])
+        if row.command >= 0:
+            section.commands.append(Command(row.label, row.body))
+
+    # Mantiene l'ordine delle categorie
+    return [
+        (cat, list(matches[cat.id].values()))
+        for cat in categories
+        if cat.id in matches
+    ]
+
+
+def _scan_category(cat, query):
+    """Sezioni e comandi di una categoria che soddisfano la query (lettura e parsing del file)"""
+    sections = parsed_procedures.get(cat.filename)
+    category_context = _category_fields(cat)
+
+    # Trova le sezioni che soddisfano la query
+    matching_sections = []
+    for section in sections:
+        section_own = _section_fields(section.title, section.desc)
+        section_match = query.matches(section_own, category_context)
+
+        # Cerca nei comandi, con sezione e categoria come contesto
+        command_context = dict(category_context, **section_own)
+        matching_commands = [
+            cmd for cmd in section.commands
+            if query.matches(_command_fields(cmd.label, cmd.cmd), command_context)
+        ]
+        if section_match or matching_commands:
+            matching_sections.append(Section(section.title, section.desc, matching_commands))
+    return matching_sections
+
+
+_scan_executor = None
+_scan_executor_lock = threading.Lock()
+
+
+def get_scan_executor():
+    """Pool di thread condiviso dal processo per la lettura e la scansione dei file"""
+    global _scan_executor
+    if _scan_executor is None:
+        with _scan_executor_lock:
+            if _scan_executor is None:
+                _scan_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'PROCEDURE_SEARCH_WORKERS', 4),
+                    thread_name_prefix='procedure-scan'
+                )
+    return _scan_executor
+
+
+def search_deadline():
+    """
+    Istante (time.monotonic) entro cui una ricerca deve terminare: vale per
+    l'intera richiesta, comprese le riscritture della ricerca fuzzy
+    """
+    return time.monotonic() + getattr(settings, 'PROCEDURE_SEARCH_DEADLINE', 5.0)
+
+
+def content_matches_files(categories, query, deadline=None):
+    """
+    Sezioni e comandi che soddisfano la query, cercati nei file parsati.
+    Letture e parsing sono distribuiti sul pool di thread; allo scadere di
+    `deadline` (vedi search_deadline) si ritornano i match raccolti fino a
+    quel momento. Ritorna (match, truncated).
+    """
+    if deadline is None:
+        deadline = search_deadline()
+    executor = get_scan_executor()
+    futures = {executor.submit(_scan_category, cat, query): cat for cat in categories}
+    done, not_done = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+
+    # Le scansioni non ancora iniziate vengono annullate, quelle in corso ignorate
+    for future in not_done:
+        future.cancel()
+
+    found = {}
+    for future in done:
+        try:
+            sections = future.result()
+        except Exception:
+            # Ignora errori di lettura file singoli
+            continue
+        if sections:
+            found[futures[future].id] = sections
+
+    # Mantiene l'ordine delle categorie
+    content_matches = [(cat, found[cat.id]) for cat in categories if cat.id in found]
+    return content_matches, bool(not_done)
+
+
+def score_candidates(candidates, query, total_docs):
+    """
+    Punteggio BM25 pesato per campo: per ogni termine positivo e campo
+    peso * idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len / len_media)).
+    I termini con prefisso contano solo nel proprio campo.
+    Le lunghezze medie per campo sono calcolate sui candidati.
+    """
+    weights = get_weights()
+    terms = query.positive
+
+    lengths = defaultdict(lambda: [0, 0])
+    lowered = []
+    for cand in candidates:
+        fields = [(field, text.lower()) for field, text in cand.fields()]
+        lowered.append(fields)
+        for field, text in fields:
+            lengths[field][0] += len(text)
+            lengths[field][1] += 1
+    avg_len = {field: (total / count) or 1.0 for field, (total, count) in lengths.items()}
+
+    # Document frequency: categorie distinte (metadati o contenuto) che contengono il termine
+    idf = {}
+    for term in terms:
+        df = len({
+            cand.category.id
+            for cand, fields in zip(candidates, lowered)
+            if any(term.needle in text for _, text in fields)
+        })
+        idf[term] = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+
+    for cand, fields in zip(candidates, lowered):
+        score = 0.0
+        for field, text in fields:
+            norm = 1 - BM25_B + BM25_B * len(text) / avg_len[field]
+            for term in terms:
+                if term.field is not None and term.field != field:
+                    continue
+                tf = text.count(term.needle)
+                if tf:
+                    score += weights.get(field, 1.0) * idf[term] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+        cand.score = score
+
+
+def top_k(candidates, limit, offset):
+    """Pagina [offset, offset + limit) dei candidati per punteggio, con un heap di offset + limit elementi"""
+    best = heapq.nsmallest(offset + limit, candidates, key=lambda c: (-c.score, c.order, c.type))
+    return best[offset:]
+
+
+class _Marker:
+    """
+    Applica l'evidenziazione ai campi di un oggetto serializzato:
+    tag <mark> nel testo (html) oppure testo originale più offset in 'matches' (offsets).
+    """
+
+    def __init__(self, query, mode):
+        self.query = query
+        self.mode = mode
+
+    def apply(self, obj, **fields):
+        if self.mode == 'html':
+            for key, text in fields.items():
+                obj[key] = self.query.highlight(text)
+            return obj
+        matches = {}
+        for key, text in fields.items():
+            obj[key] = text
+            offsets = self.query.offsets(text)
+            if offsets:
+                matches[key] = offsets
+        obj['matches'] = matches
+        return obj
+
+
+def _render(cand, marker, max_commands):
+    cat = cand.category
+    if cand.type == 'category':
+        return marker.apply({
+            'type': 'category',
+            'category_id': cat.id,
+            'icon': cat.icon,
+            'match_type': 'metadata',
+            'owner': cat.owner.username if cat.owner else None,
+            'score': round(cand.score, 4)
+        }, category_name=cat.name, description=cat.description)
+
+    # I comandi serializzati per risultato sono limitati, i conteggi restano completi
+    budget = max_commands
+    sections = []
+    for section in cand.sections:
+        commands = section.commands[:max(budget, 0)]
+        budget -= len(commands)
+        sections.append(marker.apply({
+            'has_match': True,
+            'matching_commands': len(section.commands),
+            'commands': [
+                marker.apply({}, label=cmd.label, cmd=cmd.cmd)
+                for cmd in commands
+            ]
+        }, title=section.title, desc=section.desc))
+    return marker.apply({
+        'type': 'content',
+        'category_id': cat.id,
+        'icon': cat.icon,
+        'match_type': 'content',
+        'sections': sections,
+        'owner': cat.owner.username if cat.owner else None,
+        'score': round(cand.score, 4)
+    }, category_name=cat.name)
+
+
+def collect_candidates(categories, query, deadline=None):
+    """
+    Candidati con punteggio per la query compilata nelle categorie (lista),
+    con la scansione dei file limitata a `deadline` (vedi search_deadline).
+    Ritorna (candidati, truncated).
+    """
+    candidates = []
+
+    # Match sui metadati della categoria
+    for order, cat in enumerate(categories):
+        if query.matches(_category_fields(cat)):
+            candidates.append(Candidate('category', cat, order))
+
+    # Match nel contenuto: indice full-text se disponibile, altrimenti scansione dei file
+    truncated = False
+    if search_index.is_available():
+        content_matches = content_matches_index(categories, query)
+    else:
+        content_matches, truncated = content_matches_files(categories, query, deadline)
+
+    order_of = {cat.id: order for order, cat in enumerate(categories)}
+    for cat, sections in content_matches:
+        candidates.append(Candidate('content', cat, order_of[cat.id], sections))
+
+    score_candidates(candidates, query, len(categories))
+    return candidates, truncated
+
+
+def search_procedures(categories, query, limit, offset=0, highlight='html', deadline=None):
+    """
+    Cerca la query compilata nelle categorie visibili (lista di ProcedureCategory).
+    Ritorna (risultati della pagina serializzati, numero totale di risultati, truncated):
+    truncated indica che la scansione dei file ha superato il tempo massimo e
+    i risultati sono parziali.
+    """
+    candidates, truncated = collect_candidates(list(categories), query, deadline)
+    page = top_k(candidates, limit, offset)
+    marker = _Marker(query, highlight)
+    max_commands = getattr(settings, 'PROCEDURE_SEARCH_MAX_COMMANDS', 20)
+    return [_render(cand, marker, max_commands) for cand in page], len(candidates), truncated
+
+
+def fuzzy_search(categories, query, limit, offset=0, highlight='html', exact=True, deadline=None):
+    """
+    Ricerca tollerante agli errori: la query viene riscritta con le parole del
+    vocabolario più vicine e ogni riscrittura viene cercata normalmente
+    (con exact anche la query originale, a distanza 0).
+    Ogni risultato compare una sola volta, con la distanza di edit minima;
+    i risultati sono ordinati per distanza e poi per punteggio.
+    Tutte le riscritture condividono `deadline`: allo scadere le restanti non
+    vengono cercate e i risultati sono parziali.
+    Ritorna (risultati, totale, truncated, correzioni {termine: [parole]}).
+    """
+    if deadline is None:
+        deadline = search_deadline()
+    categories = list(categories)
+    fuzzy_index.refresh()
+    alternatives = fuzzy_index.alternatives(query, {cat.id for cat in categories})
+    if exact:
+        alternatives.insert(0, (0, {}))
+
+    best = {}
+    corrections = {}
+    truncated = False
+    for distance, rewrite in alternatives:
+        if time.monotonic() >= deadline:
+            truncated = True
+            break
+        rewritten = query.rewrite(rewrite)
+        candidates, partial = collect_candidates(categories, rewritten, deadline)
+        truncated = truncated or partial
+        if candidates:
+            for term, word in rewrite.items():
+                corrections.setdefault(term, [])
+                if word not in corrections[term]:
+                    corrections[term].append(word)
+        for cand in candidates:
+            best.setdefault((cand.type, cand.category.id), (distance, cand, rewritten))
+
+    ranked = heapq.nsmallest(
+        offset + limit, best.values(),
+        key=lambda item: (item[0], -item[1].score, item[1].order, item[1].type)
+    )[offset:]
+    max_commands = getattr(settings, 'PROCEDURE_SEARCH_MAX_COMMANDS', 20)
+    results = []
+    for distance, cand, rewritten in ranked:
+        result = _render(cand, _Marker(rewritten, highlight), max_commands)
+        result['distance'] = distance
+        results.append(result)
+    return results, len(best), truncated, corrections
+
+
+def result_cache_key(query, visible_ids, limit, offset, highlight='html', fuzzy=FUZZY_AUTO, version=None):
+    """
+    Chiave della cache dei risultati: forma canonica della query, hash dell'insieme
+    delle categorie visibili, paginazione, modalità di evidenziazione e di ricerca
+    fuzzy e versione del corpus (se non indicata, quella corrente).
+    """
+    if version is None:
+        version = corpus.get_version()
+    visibility = hashlib.sha1(','.join(map(str, sorted(visible_ids))).encode()).hexdigest()
+    request_hash = hashlib.sha1(
+        f'{query.canonical}\x00{limit}\x00{offset}\x00{highlight}\x00{fuzzy}'.encode()
+    ).hexdigest()
+    return f'procedures:search:{version}:{visibility}:{request_hash}'
+
+
+def cached_search(visible, query, limit, offset=0, highlight='html', fuzzy=FUZZY_AUTO):
+    """
+    Ricerca con cache dei risultati.
+    `visible` è il queryset delle categorie visibili all'utente; `fuzzy` è
+    FUZZY_AUTO (ricerca fuzzy solo se la ricerca esatta non trova nulla),
+    FUZZY_ON (sempre) o FUZZY_OFF.
+    Ritorna un dict con results, total, truncated, fuzzy e corrections.
+    I risultati parziali (truncated) non vengono messi in cache.
+    """
+    key = result_cache_key(query, visible.values_list('id', flat=True), limit, offset, highlight, fuzzy)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    payload = run_search(list(visible.select_related('owner')), query, limit, offset, highlight, fuzzy)
+    if not payload['truncated']:
+        cache.set(key, payload, result_cache_timeout())
+    return payload
+
+
+def result_cache_timeout():
+    return getattr(settings, 'PROCEDURE_SEARCH_CACHE_TIMEOUT', 300)
+
+
+def run_search(categories, query, limit, offset=0, highlight='html', fuzzy=FUZZY_AUTO):
+    """
+    Ricerca senza cache (vedi cached_search) sulla lista di categorie visibili,
+    entro un unico tempo massimo per l'intera richiesta
+    """
+    deadline = search_deadline()
+    payload = {'fuzzy': False, 'corrections': {}}
+    if fuzzy == FUZZY_ON:
+        results, total, truncated, corrections = fuzzy_search(
+            categories, query, limit, offset, highlight, deadline=deadline
+        )
+        payload = {'fuzzy': True, 'corrections': corrections}
+    else:
+        results, total, truncated = search_procedures(categories, query, limit, offset, highlight, deadline)
+        if fuzzy == FUZZY_AUTO and total == 0 and not truncated:
+            # Nessun risultato esatto: la query originale è inutile da ripetere
+            results, total, truncated, corrections = fuzzy_search(
+                categories, query, limit, offset, highlight, exact=False, deadline=deadline
+            )
+            payload = {'fuzzy': True, 'corrections': corrections}
+    payload.update(results=results, total=total, truncated=truncated)
+    return payload
@@ -0,0 +1,193 @@
+"""
+Indice full-text persistente sul contenuto delle procedure.
+
+Usa una tabella virtuale SQLite FTS5 (tokenizer trigram) nello stesso database
+di Django: ogni ProcedureCategory ha una riga per sezione (titolo e descrizione)
+e una riga per comando (etichetta e corpo). La ricerca non deve quindi più aprire
+e ri-parsare i file ad ogni richiesta.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connection, transaction, OperationalError
+
+from .procedure_cache import parsed_procedures
+
+TABLE = 'procedures_search_index'
+
+CREATE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5("
+    "category_id UNINDEXED, section UNINDEXED, command UNINDEXED, "
+    "section_title UNINDEXED, section_desc UNINDEXED, "
+    "title, description, label, body, "
+    "tokenize='trigram')"
+)
+DROP_SQL = f"DROP TABLE IF EXISTS {TABLE}"
+
+# Le righe di una categoria occupano il range di rowid [id << 24, (id + 1) << 24):
+# cancellare una procedura non richiede una scansione dell'intera tabella.
+ROWID_BITS = 24
+
+# Il tokenizer trigram non trova sottostringhe più corte di 3 caratteri con MATCH
+MIN_MATCH_LENGTH = 3
+
+IndexRow = namedtuple('IndexRow', [
+    'category_id', 'section', 'command', 'section_title', 'section_desc',
+    'title', 'description', 'label', 'body',
+])
+
+_COLUMNS = ', '.join(IndexRow._fields)
+_INSERT_SQL = f"INSERT INTO {TABLE} (rowid, {_COLUMNS}) VALUES (%s, {', '.join(['%s'] * len(IndexRow._fields))})"
+
+# Esito della verifica della tabella (None: non ancora verificato). Anche
+# l'assenza viene ricordata, così senza FTS5 ogni ricerca non interroga
+# sqlite_master; create_table, drop_table e rebuild_index lo azzerano.
+_table_exists = None
+
+
+def is_available():
+    """L'indice è usabile se abilitato nelle impostazioni e la tabella FTS5 esiste"""
+    global _table_exists
+    if not getattr(settings, 'PROCEDURE_SEARCH_INDEX', True):
+        return False
+    if connection.vendor != 'sqlite':
+        return False
+    if _table_exists is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [TABLE])
+            _table_exists = cursor.fetchone() is not None
+    return _table_exists
+
+
+def forget_table():
+    """Fa ripetere la verifica della tabella alla prossima chiamata di is_available"""
+    global _table_exists
+    _table_exists = None
+
+
+def create_table(schema_editor):
+    """Crea la tabella FTS5 (solo SQLite con supporto trigram, altrimenti nessuna azione)"""
+    forget_table()
+    if schema_editor.connection.vendor != 'sqlite':
+        return False
+    try:
+        schema_editor.execute(CREATE_SQL)
+    except OperationalError:
+        # SQLite senza FTS5 o troppo vecchio per il tokenizer trigram (< 3.34)
+        return False
+    return True
+
+
+def drop_table(schema_editor):
+    forget_table()
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(DROP_SQL)
+
+
+def _rowid_range(category_id):
+    start = category_id << ROWID_BITS
+    return start, start + (1 << ROWID_BITS)
+
+
+def _read_sections(filename):
+    try:
+        return parsed_procedures.get(filename)
+    except (OSError, UnicodeDecodeError):
+        # File mancante o illeggibile: la procedura resta fuori dall'indice
+        return []
+
+
+def _iter_rows(category_id, sections):
+    """Genera le righe dell'indice per le sezioni parsate di una procedura"""
+    for s_index, section in enumerate(sections):
+        yield IndexRow(category_id, s_index, -1, section.title, section.desc,
+                       section.title, section.desc, '', '')
+        for c_index, cmd in enumerate(section.commands):
+            yield IndexRow(category_id, s_index, c_index, section.title, section.desc,
+                           '', '', cmd.label, cmd.cmd)
+
+
+def remove_procedure(category_id):
+    """Rimuove dall'indice tutte le righe di una categoria"""
+    if not is_available():
+        return
+    start, end = _rowid_range(category_id)
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE rowid >= %s AND rowid < %s", [start, end])
+
+
+def index_procedure(category, sections=None):
+    """
+    Aggiorna l'indice per una categoria.
+    Se `sections` non è passato il file viene letto e parsato.
+    """
+    return index_procedures([(category, sections)])
+
+
+def index_procedures(items):
+    """
+    Aggiorna l'indice per più categorie (es. un'importazione) in una sola
+    transazione, con un'unica DELETE e un'unica INSERT preparate.
+    `items` sono coppie (categoria, sezioni o None per leggere il file).
+    """
+    if not is_available():
+        return 0
+    ranges = []
+    rows = []
+    for category, sections in items:
+        if sections is None:
+            sections = _read_sections(category.filename)
+        start, end = _rowid_range(category.id)
+        ranges.append((start, end))
+        rows.extend((start + n, *row) for n, row in enumerate(_iter_rows(category.id, sections)))
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {TABLE} WHERE rowid >= %s AND rowid < %s", ranges)
+            if rows:
+                cursor.executemany(_INSERT_SQL, rows)
+    return len(rows)
+
+
+def rebuild_index(categories=None):
+    """Svuota e ricostruisce l'indice. Ritorna (categorie, righe) indicizzate"""
+    forget_table()
+    if categories is None:
+        from .models import ProcedureCategory
+        categories = ProcedureCategory.objects.all()
+
+    indexed = rows = 0
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE}")
+        for category in categories:
+            rows += index_procedure(category)
+            indexed += 1
+    return indexed, rows
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_terms(terms):
+    """
+    Ritorna le righe (IndexRow) che contengono almeno uno dei termini nelle colonne
+    indicate, ordinate per categoria, sezione e comando.
+    `terms` è una lista di (testo, colonne) con colonne tra title, description, label, body.
+    """
+    found = {}
+    with connection.cursor() as cursor:
+        for text, columns in terms:
+            if len(text) >= MIN_MATCH_LENGTH:
+                sql = f"SELECT rowid, {_COLUMNS} FROM {TABLE} WHERE {TABLE} MATCH %s"
+                params = ['{' + ' '.join(columns) + '} : "' + text.replace('"', '""') + '"']
+            else:
+                # Termini brevi: LIKE sulla tabella dell'indice (nessun accesso ai file)
+                sql = f"SELECT rowid, {_COLUMNS} FROM {TABLE} WHERE " + ' OR '.join(
+                    f"{c} LIKE %s ESCAPE '\\'" for c in columns
+                )
+                params = ['%' + _escape_like(text) + '%'] * len(columns)
+            cursor.execute(sql, params)
+            for rowid, *row in cursor.fetchall():
+                found[rowid] = IndexRow(*row)
+    return [found[rowid] for rowid in sorted(found)]
@@ -1,7 +1,26 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
-from django.dispatch import receiver
-from .models import UserProfile
+from django.dispatch import receiver, Signal
+from .models import UserProfile, ProcedureCategory
+from .procedure_cache import parsed_procedures
+from .suggest import suggest_index
+from .fuzzy import fuzzy_index
+from . import compiled, events, patching, precompressed, search_index
+
+
+# Inviato quando una procedura viene creata o quando cambiano i suoi metadati o il suo file.
+# Argomenti: category, created, sections (opzionale, sezioni già parsate)
+procedure_changed = Signal()
+
+# Inviato quando una procedura viene eliminata.
+# Argomenti: category_id, filename
+procedure_deleted = Signal()
+
+# Inviato una sola volta per le procedure create da un'importazione (bulk_create
+# non invia post_save): file, cache e sidecar sono già scritti, i receiver
+# aggiornano indici ed eventi per l'intero blocco.
+# Argomenti: categories, sections (sezioni parsate, nello stesso ordine)
+procedures_imported = Signal()
 
 
 @receiver(post_save, sender=User)
@@ -16,3 +35,133 @@ def save_user_profile(sender, instance, **kwargs):
     """Salva il profilo quando l'utente viene salvato"""
     if hasattr(instance, 'profile'):
         instance.profile.save()
+
+
+@receiver(post_save, sender=ProcedureCategory)
+def procedure_category_saved(sender, instance, created, raw=False, **kwargs):
+    """Propaga i salvataggi della categoria (viste, admin) come procedure_changed"""
+    if raw:
+        return
+    procedure_changed.send(sender=ProcedureCategory, category=instance, created=created)
+
+
+@receiver(post_delete, sender=ProcedureCategory)
+def procedure_category_deleted(sender, instance, **kwargs):
+    """Propaga le eliminazioni della categoria come procedure_deleted"""
+    procedure_deleted.send(sender=ProcedureCategory, category_id=instance.pk, filename=instance.filename)
+
+
+# I receiver vengono eseguiti in ordine di registrazione: la cache va invalidata
+# e il sidecar rigenerato prima che gli indici rileggano il file.
+
+@receiver(procedure_changed)
+def invalidate_parsed_procedure(sender, category, **kwargs):
+    """Scarta le sezioni parsate in cache della procedura modificata, se non sono già quelle del file"""
+    parsed_procedures.discard_stale(category.filename)
+
+
+@receiver(procedure_deleted)
+def discard_parsed_procedure(sender, filename, **kwargs):
+    """Scarta le sezioni parsate in cache della procedura eliminata"""
+    parsed_procedures.invalidate(filename)
+
+
+@receiver(procedure_changed)
+def compile_procedure(sender, category, **kwargs):
+    """Rigenera il sidecar compilato della procedura modificata"""
+    compiled.compile_procedure(category.filename)
+
+
+@receiver(procedure_deleted)
+def remove_compiled_procedure(sender, filename, **kwargs):
+    """Elimina il sidecar compilato della procedura eliminata"""
+    compiled.remove(filename)
+
+
+@receiver(procedure_deleted)
+def remove_procedure_lock(sender, filename, **kwargs):
+    """Elimina il file di lock delle modifiche puntuali della procedura eliminata"""
+    patching.remove_lock(filename)
+
+
+@receiver(procedure_changed)
+def discard_compressed_procedure(sender, category, **kwargs):
+    """Elimina le varianti compresse della versione precedente della procedura"""
+    precompressed.discard(category.filename)
+
+
+@receiver(procedure_deleted)
+def remove_compressed_procedure(sender, filename, **kwargs):
+    """Elimina le varianti compresse della procedura eliminata"""
+    precompressed.discard(filename)
+
+
+@receiver(procedure_changed)
+def update_search_index(sender, category, sections=None, **kwargs):
+    """Aggiorna l'indice full-text della procedura modificata"""
+    search_index.index_procedure(category, sections=sections)
+
+
+@receiver(procedure_deleted)
+def remove_from_search_index(sender, category_id, **kwargs):
+    """Rimuove la procedura eliminata dall'indice full-text"""
+    search_index.remove_procedure(category_id)
+
+
+@receiver(procedure_changed)
+def update_suggest_index(sender, category, **kwargs):
+    """Aggiorna l'indice dei suggerimenti della procedura modificata"""
+    suggest_index.update_category(category)
+
+
+@receiver(procedure_deleted)
+def remove_from_suggest_index(sender, category_id, **kwargs):
+    """Rimuove la procedura eliminata dall'indice dei suggerimenti"""
+    suggest_index.remove_category(category_id)
+
+
+@receiver(procedure_changed)
+def update_fuzzy_index(sender, category, **kwargs):
+    """Aggiorna il vocabolario della ricerca fuzzy con la procedura modificata"""
+    fuzzy_index.update_category(category)
+
+
+@receiver(procedure_deleted)
+def remove_from_fuzzy_index(sender, category_id, **kwargs):
+    """Rimuove la procedura eliminata dal vocabolario della ricerca fuzzy"""
+    fuzzy_index.remove_category(category_id)
+
+
+@receiver(procedure_changed)
+def record_procedure_changed(sender, category, created=False, **kwargs):
+    """
+    Registra la modifica per le dashboard aperte (vedi events.py); il nuovo
+    evento è anche la nuova versione del corpus, che invalida le cache derivate
+    (es. risultati di ricerca)
+    """
+    events.record('created' if created else 'updated', category.id)
+
+
+@receiver(procedure_deleted)
+def record_procedure_deleted(sender, category_id, **kwargs):
+    """Registra l'eliminazione per le dashboard aperte e la nuova versione del corpus"""
+    events.record('deleted', category_id)
+
+
+@receiver(procedures_imported)
+def index_imported_procedures(sender, categories, sections, **kwargs):
+    """Indicizza le procedure importate in una sola transazione"""
+    search_index.index_procedures(zip(categories, sections))
+
+
+@receiver(procedures_imported)
+def update_indexes_for_imported(sender, categories, **kwargs):
+    """Aggiorna suggerimenti e vocabolario fuzzy con le procedure importate"""
+    suggest_index.update_categories(categories)
+    fuzzy_index.update_categories(categories)
+
+
+@receiver(procedures_imported)
+def record_procedures_imported(sender, categories, **kwargs):
+    """Registra gli eventi delle procedure importate con un'unica INSERT"""
+    events.record_many('created', [category.id for category in categories])
@@ -0,0 +1,90 @@
+"""
+Indice dei prefissi per i suggerimenti durante la digitazione.
+
+Contiene nomi delle categorie, titoli delle sezioni ed etichette dei comandi in
+una lista ordinata interrogata con bisect. Ogni testo è indicizzato per intero e
+a partire da ogni parola ("Lista container attivi" risponde a "lis", "cont", "att").
+L'allineamento al database è gestito da corpus.CorpusIndex.
+"""
+import bisect
+import heapq
+
+from .corpus import CorpusIndex
+
+TYPES = ('category', 'section', 'command')
+
+# Voci con lo stesso prefisso esaminate al massimo per richiesta
+MAX_SCAN = 2000
+
+
+def _normalize(text):
+    return ' '.join(text.lower().split())
+
+
+def _keys(text):
+    """Chiavi di un testo: il testo intero e i suffissi che iniziano a ogni parola"""
+    words = _normalize(text).split(' ')
+    for i in range(len(words)):
+        yield ' '.join(words[i:]), int(i > 0)
+
+
+def _category_entries(category, sections):
+    """Voci (chiave, interna, tipo, testo, category_id) di una categoria"""
+    texts = [(category.name, 0)]
+    for section in sections:
+        texts.append((section.title, 1))
+        texts.extend((cmd.label, 2) for cmd in section.commands)
+
+    entries = set()
+    for text, type_rank in texts:
+        if not text.strip():
+            continue
+        for key, inner in _keys(text):
+            entries.add((key, inner, type_rank, text, category.id))
+    return entries
+
+
+class PrefixIndex(CorpusIndex):
+    """Lista ordinata di voci interrogata per prefisso con bisect"""
+
+    def __init__(self):
+        super().__init__()
+        self._entries = []
+
+    def _update(self, loaded, removed):
+        drop = set(removed) | {category.id for category, _ in loaded}
+        added = []
+        for category, sections in loaded:
+            added.extend(_category_entries(category, sections))
+
+        kept = [e for e in self._entries if e[4] not in drop] if drop else self._entries
+        # La lista viene sostituita, mai modificata: le letture concorrenti restano coerenti
+        self._entries = list(heapq.merge(kept, sorted(added)))
+
+    def lookup(self, prefix, visible_ids, limit):
+        """Suggerimenti per prefix tra le categorie visibili, prima le corrispondenze a inizio testo"""
+        key = _normalize(prefix)
+        if not key:
+            return []
+        entries = self._entries
+        i = bisect.bisect_left(entries, (key,))
+        end = min(len(entries), i + MAX_SCAN)
+
+        found = {}
+        while i < end and entries[i][0].startswith(key):
+            _, inner, type_rank, text, category_id = entry = entries[i]
+            i += 1
+            if category_id not in visible_ids:
+                continue
+            ident = (type_rank, text, category_id)
+            if ident not in found or inner < found[ident][1]:
+                found[ident] = entry
+
+        ranked = sorted(found.values(), key=lambda e: (e[1], e[2], len(e[3]), e[3].lower()))
+        return [
+            {'text': text, 'type': TYPES[type_rank], 'category_id': category_id}
+            for _, _, type_rank, text, category_id in ranked[:limit]
+        ]
+
+
+suggest_index = PrefixIndex()
@@ -1,3 +1,1577 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings as django_settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches, resolve
+
+from . import compiled, events, export, patching, precompressed, search
+from . import search_index
+from .fuzzy import fuzzy_index
+from .html_format import ProcedureHTMLParser, _feed_simple, convert_html_to_procedure_format
+from .models import ProcedureCategory, ProcedureEvent
+from .offsets import offset_indexes, section_ids, version
+from .parsing import parse_procedure_file, parse_procedure_lines, parse_procedure_with_offsets, sections_to_dicts
+from .procedure_cache import parsed_procedures
+from .query import compile_query
+from .suggest import suggest_index
+
+PROCEDURE = (
+    'Note interne: testo prima della prima sezione\n'
+    '\n'
+    '[Docker]\n'
+    'Gestione container\n'
+    '\n'
+    'COMANDO: Lista container\n'
+    'docker ps -a\n'
+    '\n'
+    'COMANDO: Vuoto\n'
+    '\n'
+    'COMANDO: Avvia\n'
+    '    cd /srv\n'
+    '    docker compose up -d\n'
+    '\n'
+    '[Altro]\n'
+    'Comandi vari\n'
+    '\n'
+    'COMANDO: Spazio disco\n'
+    'df -h\n'
+    '\n'
+    'COMANDO: Indentato\n'
+    '    cd /opt\n'
+    '    ls\n'
+    '\n'
+    'COMANDO: Memoria\n'
+    'free -m\n'
+    '\n'
+    '[Finale]\n'
+    'Ultima sezione\n'
+    '\n'
+    'COMANDO: Uptime\n'
+    'uptime\n'
+)
+
+
+class PatchingTestCase(SimpleTestCase):
+    """Modifiche puntuali ai file: il contenuto non toccato deve restare identico byte per byte"""
+
+    filename = 'test.txt'
+
+    def setUp(self):
+        self.files_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.files_dir)
+        settings_override = override_settings(PROCEDURE_FILES_DIR=Path(self.files_dir), PROCEDURE_COMPILED_DIR='')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.path = os.path.join(self.files_dir, self.filename)
+        self.write(PROCEDURE)
+
+    def write(self, text):
+        with open(self.path, 'wb') as f:
+            f.write(text.encode('utf-8'))
+        parsed_procedures.invalidate(self.filename)
+        offset_indexes.invalidate(self.filename)
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def section_text(self, text, title):
+        """Testo della sezione `title` (dal titolo alla sezione successiva)"""
+        start = text.index(f'[{title}]')
+        end = text.find('\n[', start)
+        return text[start:] if end == -1 else text[start:end + 1]
+
+    def assertUntouched(self, before, after, title):
+        """Tutto tranne la sezione `title` è identico"""
+        section_before = self.section_text(before, title)
+        section_after = self.section_text(after, title)
+        start = before.index(section_before)
+        self.assertEqual(after[:start], before[:start])
+        self.assertEqual(after[start + len(section_after):], before[start + len(section_before):])
+
+
+class ApplyOperationsTests(PatchingTestCase):
+
+    def test_update_keeps_other_sections_byte_identical(self):
+        patching.apply_operations(self.filename, [
+            {'section': 'Altro', 'command_label': 'Memoria', 'new_command': 'free -h'},
+        ])
+        text = self.read()
+        self.assertUntouched(PROCEDURE, text, 'Altro')
+        # Preambolo, comando vuoto e indentazione della prima riga restano
+        self.assertTrue(text.startswith('Note interne: testo prima della prima sezione\n'))
+        self.assertIn('COMANDO: Vuoto\n\n', text)
+        self.assertIn('COMANDO: Avvia\n    cd /srv\n', text)
+
+    def test_update_keeps_untouched_commands_of_the_section(self):
+        patching.apply_operations(self.filename, [
+            {'section': 'Altro', 'command_label': 'Spazio disco', 'new_command': 'df -h /'},
+        ])
+        self.assertEqual(self.read(), PROCEDURE.replace('df -h\n', 'df -h /\n'))
+
+    def test_delete_keeps_lines_ignored_by_the_parser(self):
+        sections = patching.apply_operations(self.filename, [
+            {'op': 'delete', 'section': 'Docker', 'command_label': 'Lista container'},
+        ])
+        text = self.read()
+        self.assertUntouched(PROCEDURE, text, 'Docker')
+        self.assertNotIn('docker ps -a', text)
+        self.assertIn('COMANDO: Vuoto\n', text)
+        self.assertEqual([c.label for c in sections[0].commands], ['Avvia'])
+
+    def test_add_and_reorder(self):
+        sections = patching.apply_operations(self.filename, [
+            {'op': 'add', 'section': 'Altro', 'command_label': 'Processi', 'new_command': 'ps aux', 'position': 0},
+            {'op': 'reorder', 'section': 'Altro', 'order': ['Memoria', 'Processi', 'Indentato', 'Spazio disco']},
+        ])
+        text = self.read()
+        self.assertUntouched(PROCEDURE, text, 'Altro')
+        self.assertEqual(
+            [c.label for c in sections[1].commands], ['Memoria', 'Processi', 'Indentato', 'Spazio disco']
+        )
+        # I comandi spostati sono copiati così come sono
+        self.assertIn('COMANDO: Indentato\n    cd /opt\n    ls\n', text)
+        self.assertEqual(parsed_procedures.get(self.filename), sections)
+
+    def test_crlf_line_endings_are_kept(self):
+        crlf = PROCEDURE.replace('\n', '\r\n')
+        self.write(crlf)
+        patching.apply_operations(self.filename, [
+            {'section': 'Finale', 'command_label': 'Uptime', 'new_command': 'uptime -p'},
+            {'op': 'add', 'section': 'Finale', 'command_label': 'Data', 'new_command': 'date'},
+        ])
+        text = self.read()
+        self.assertTrue(text.startswith(crlf[:crlf.index('[Finale]')]))
+        self.assertNotIn('\n', text.replace('\r\n', ''))
+
+    def test_failing_operation_leaves_file_unchanged(self):
+        with self.assertRaises(patching.CommandNotFound):
+            patching.apply_operations(self.filename, [
+                {'section': 'Altro', 'command_label': 'Memoria', 'new_command': 'free -h'},
+                {'op': 'delete', 'section': 'Altro', 'command_label': 'Inesistente'},
+            ])
+        self.assertEqual(self.read(), PROCEDURE)
+
+
+class ReplaceCommandTests(PatchingTestCase):
+
+    def test_only_the_command_body_changes(self):
+        cmd = patching.replace_command(self.filename, 'Docker', 'Avvia', '    cd /srv\n    docker compose pull')
+        self.assertEqual(cmd, 'cd /srv\n    docker compose pull')
+        self.assertEqual(self.read(), PROCEDURE.replace('docker compose up -d', 'docker compose pull'))
+
+
+class ReplaceSectionsTests(PatchingTestCase):
+
+    def test_other_sections_are_copied(self):
+        stamp, spans = offset_indexes.get(self.filename)
+        ids = section_ids(spans)
+        patching.replace_sections(self.filename, version(stamp), [
+            (ids[1], '[Altro]\nComandi vari\n\nCOMANDO: Spazio disco\ndf -h\n'),
+        ])
+        text = self.read()
+        self.assertUntouched(PROCEDURE, text, 'Altro')
+        self.assertNotIn('free -m', text)
+
+    def test_stale_version_is_rejected(self):
+        stamp, spans = offset_indexes.get(self.filename)
+        patching.replace_command(self.filename, 'Finale', 'Uptime', 'uptime -p')
+        with self.assertRaises(patching.VersionMismatch):
+            patching.replace_sections(self.filename, version(stamp), [(section_ids(spans)[2], '')])
+        self.assertIn('uptime -p', self.read())
+
+
+class PrecompressedTests(SimpleTestCase):
+
+    filename = 'test.txt'
+
+    def setUp(self):
+        self.compressed_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.compressed_dir)
+        settings_override = override_settings(PROCEDURE_COMPRESSED_DIR=self.compressed_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.body = PROCEDURE.encode('utf-8') * 10
+
+    def test_variant_being_created_is_not_compressed_twice(self):
+        digest = hashlib.sha256(self.body).hexdigest()
+        path = precompressed.variant_path(self.filename, digest, 'gzip')
+        precompressed._in_progress.add(path)
+        self.addCleanup(precompressed._in_progress.discard, path)
+        self.assertIsNone(precompressed.variant(self.filename, digest, 'gzip', lambda: self.body))
+        self.assertFalse(os.path.exists(path))
+
+    def test_discarded_variant_is_sent_uncompressed(self):
+        response = HttpResponse(self.body)
+        with mock.patch.object(precompressed, 'variant', return_value=os.path.join(self.compressed_dir, 'x.gz')):
+            precompressed.compress_response(response, self.filename, 'gzip')
+        self.assertEqual(response.content, self.body)
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_variant_is_reused(self):
+        first = precompressed.compress_response(HttpResponse(self.body), self.filename, 'gzip')
+        second = precompressed.compress_response(HttpResponse(self.body), self.filename, 'gzip')
+        self.assertEqual(first['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(second.content), self.body)
+
+
+class CompiledTests(PatchingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.compiled_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.compiled_dir)
+        settings_override = override_settings(PROCEDURE_COMPILED_DIR=self.compiled_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_compile_reads_the_sidecar_once(self):
+        compiled.compile_procedure(self.filename)
+        # Stesso contenuto, stamp diverso: il sidecar viene solo aggiornato
+        st = os.stat(self.path)
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        with mock.patch.object(compiled, '_read', wraps=compiled._read) as read, \
+                mock.patch.object(compiled, 'parse_file', wraps=compiled.parse_file) as parse:
+            compiled.compile_procedure(self.filename)
+        self.assertEqual(read.call_count, 1)
+        parse.assert_not_called()
+        st = os.stat(self.path)
+        sections, _, parsed = compiled.load(self.filename, (st.st_mtime_ns, st.st_size))
+        self.assertFalse(parsed)
+        self.assertEqual(sections, parsed_procedures.get(self.filename))
+
+
+# Casi del parser con l'output del parser originale (prima del parser in streaming):
+# (nome, testo, [(titolo, descrizione, [(etichetta, comando)])])
+PARSER_CASES = (
+    (
+        'base',
+        '[Docker]\nGestione container\n\nCOMANDO: Lista\ndocker ps -a\n\n'
+        'COMANDO: Avvio\n    cd /srv\n    docker compose up -d\n',
+        [('Docker', 'Gestione container', [
+            ('Lista', 'docker ps -a'), ('Avvio', 'cd /srv\n    docker compose up -d'),
+        ])],
+    ),
+    (
+        'crlf',
+        '[Docker]\r\nGestione container\r\n\r\nCOMANDO: Lista\r\ndocker ps -a\r\n\r\n'
+        'COMANDO: Due righe\r\nuno\r\n\r\ndue\r\n',
+        [('Docker', 'Gestione container', [('Lista', 'docker ps -a'), ('Due righe', 'uno\n\ndue')])],
+    ),
+    (
+        'sezione finale senza descrizione',
+        '[Prima]\nDescrizione\n\nCOMANDO: Uno\necho 1\n\n[Ultima]\n',
+        [('Prima', 'Descrizione', [('Uno', 'echo 1')]), ('Ultima', '', [])],
+    ),
+    (
+        'comandi prima della prima sezione',
+        'COMANDO: Orfano\necho orfano\n\ntesto libero\n[Sezione]\nDescrizione\nCOMANDO: Dopo\necho dopo\n',
+        [('Sezione', 'Descrizione', [('Dopo', 'echo dopo')])],
+    ),
+    (
+        'comandi vuoti',
+        '[Sezione]\nDescrizione\n\nCOMANDO: Vuoto\n\nCOMANDO:   \nCOMANDO: Pieno\necho ok\n'
+        'COMANDO: Solo spazi\n   \n',
+        [('Sezione', 'Descrizione', [('Pieno', 'echo ok')])],
+    ),
+    (
+        'non ASCII',
+        '[Rete è attiva]\nVerifica già fatta — ok\n\nCOMANDO: Ping ☃\nping -c 3 café.example\n\n'
+        '[Ünïcode]\n日本語のセクション\n\nCOMANDO: Eco\necho «ciao»\n',
+        [
+            ('Rete è attiva', 'Verifica già fatta — ok', [('Ping ☃', 'ping -c 3 café.example')]),
+            ('Ünïcode', '日本語のセクション', [('Eco', 'echo «ciao»')]),
+        ],
+    ),
+    (
+        'descrizione alla prima riga non vuota',
+        '[A]\n\n\nCOMANDO: Non è un comando\nCOMANDO: Vero\nls\n',
+        [('A', 'COMANDO: Non è un comando', [('Vero', 'ls')])],
+    ),
+    (
+        'spazi e tab',
+        '  [Indentata]  \n  descrizione  \n\nCOMANDO:Etichetta\n\tcorpo con tab\t\n',
+        [('Indentata', 'descrizione', [('Etichetta', 'corpo con tab')])],
+    ),
+    ('vuoto', '', []),
+)
+
+
+class ParserTests(SimpleTestCase):
+    """I parser in streaming danno esattamente l'output del parser originale"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def expected(self, sections):
+        return [
+            {'title': title, 'desc': desc, 'commands': [{'label': label, 'cmd': cmd} for label, cmd in commands]}
+            for title, desc, commands in sections
+        ]
+
+    def test_parsers_match_the_original_output(self):
+        for name, text, sections in PARSER_CASES:
+            with self.subTest(name):
+                expected = self.expected(sections)
+                path = os.path.join(self.dir, 'case.txt')
+                with open(path, 'wb') as f:
+                    f.write(text.encode('utf-8'))
+
+                self.assertEqual(sections_to_dicts(parse_procedure_file(text)), expected)
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.assertEqual(sections_to_dicts(parse_procedure_lines(f)), expected)
+                with open(path, 'r', encoding='utf-8', newline='') as f:
+                    parsed, _ = parse_procedure_with_offsets(f, os.path.getsize(path))
+                self.assertEqual(sections_to_dicts(parsed), expected)
+
+    def test_spans_slice_back_to_the_source(self):
+        for name, text, _ in PARSER_CASES:
+            with self.subTest(name):
+                data = text.encode('utf-8')
+                sections, spans = parse_procedure_with_offsets(io.StringIO(text, newline=''), len(data))
+                # Le sezioni sono contigue e arrivano alla fine del file
+                if spans:
+                    self.assertEqual(spans[-1].end, len(data))
+                for span, following in zip(spans, spans[1:]):
+                    self.assertEqual(span.end, following.start)
+
+                for section, span in zip(sections, spans):
+                    chunk = data[span.start:span.end].decode('utf-8')
+                    self.assertEqual(parse_procedure_file(chunk), [section])
+                    for cmd, cmd_span in zip(section.commands, span.commands):
+                        self.assertTrue(span.start <= cmd_span.start < cmd_span.end <= span.end)
+                        first, *body = data[cmd_span.start:cmd_span.end].decode('utf-8').splitlines()
+                        self.assertEqual(first.strip().replace('COMANDO:', '').strip(), cmd.label)
+                        self.assertEqual('\n'.join(line.rstrip() for line in body).strip(), cmd.cmd)
+
+
+class HTMLConversionTests(SimpleTestCase):
+    """La via rapida (_feed_simple) dà lo stesso risultato di HTMLParser, o lo lascia a lui"""
+
+    def parse_with_htmlparser(self, html):
+        parser = ProcedureHTMLParser()
+        parser.feed(html)
+        return parser.finish()
+
+    def parse_fast(self, html):
+        parser = ProcedureHTMLParser()
+        return _feed_simple(parser, html), parser.finish()
+
+    def assertSameConversion(self, html, simple):
+        handled, sections = self.parse_fast(html)
+        self.assertEqual(handled, simple)
+        expected = self.parse_with_htmlparser(html)
+        if handled:
+            self.assertEqual(sections, expected)
+        else:
+            # Nessun handler chiamato: il parser resta vuoto per HTMLParser
+            self.assertEqual(sections, [])
+        self.assertEqual(self.convert(html), self.format(expected))
+
+    def convert(self, html):
+        return convert_html_to_procedure_format(html)
+
+    def format(self, sections):
+        lines = []
+        for title, desc, commands in sections:
+            lines += [f"[{''.join(title)}]", ''.join(desc), '']
+            for label, cmd in commands:
+                lines += [f"COMANDO: {''.join(label)}", ''.join(cmd), '']
+        return '\n'.join(lines)
+
+    def test_simple_html(self):
+        for name, html in (
+            ('entità', '<h2>A &amp; B &lt;x&gt;</h2><p>d&eacute;</p><h3>Eco</h3>'
+                       '<pre>echo &quot;ciao&quot; &#39;x&#39; &#x41;</pre>'),
+            ('tag maiuscoli', '<H2>Titolo</H2><P>Descrizione</P><H3>Etichetta</H3><PRE>ls -la</PRE>'),
+            ('tag autochiusi', '<h2>Titolo<br/></h2><p>d</p><h3>Due righe</h3><pre>ls<br />pwd</pre>'),
+            ('testo spezzato in span', '<h2><span>Tit</span><span>olo</span></h2><p>d</p>'
+                                       '<h3><span class="a">Eti</span>chetta</h3><pre><code>'
+                                       '<span class="hljs-keyword">docker</span> <span>ps</span></code></pre>'),
+            ('attributi', '<h2 class="x" data-id=\'1\'>T</h2><p id="d">d</p><h3>L</h3><pre>ls</pre>'),
+        ):
+            with self.subTest(name):
+                self.assertSameConversion(html, simple=True)
+
+    def test_other_html_goes_through_htmlparser(self):
+        for name, html in (
+            ('script', '<h2>T</h2><p>d</p><script>var a = "<h3>x</h3>";</script><h3>L</h3><pre>ls</pre>'),
+            ('commento', '<h2>T</h2><!-- <h3>no</h3> --><p>d</p><h3>L</h3><pre>ls</pre>'),
+            ('&amp finale', '<h2>T</h2><p>d</p><h3>L</h3><pre>ls</pre>a &amp'),
+            ('tag malformato', '<h2>T</h2><p>d</p><h3>L</h3><pre>a < b</pre>'),
+            ('attributo senza virgolette', '<h2>T</h2><p id=d>d</p><h3>L</h3><pre>ls</pre>'),
+        ):
+            with self.subTest(name):
+                self.assertSameConversion(html, simple=False)
+
+
+DOCKER = (
+    '[Container]\n'
+    'Gestione dei container\n'
+    '\n'
+    'COMANDO: Lista container\n'
+    'docker ps -a\n'
+    '\n'
+    'COMANDO: Rimuovi container fermi\n'
+    'docker container prune -f\n'
+    '\n'
+    '[Immagini]\n'
+    'Gestione delle immagini\n'
+    '\n'
+    'COMANDO: Scarica immagine\n'
+    'docker pull nginx\n'
+)
+
+LINUX = (
+    '[Gestione File]\n'
+    'Operazioni su file e directory\n'
+    '\n'
+    'COMANDO: Lista dettagliata\n'
+    'ls -lah\n'
+    '\n'
+    'COMANDO: Elimina cartella\n'
+    'rm -rf /tmp/prova\n'
+    '\n'
+    'COMANDO: Estrai archivio\n'
+    'tar -xzf archivio.tar.gz\n'
+    '\n'
+    '[Monitoraggio]\n'
+    'Risorse del sistema\n'
+    '\n'
+    'COMANDO: Utilizzo disco\n'
+    'df -h\n'
+)
+
+GIT = (
+    '[Repository]\n'
+    'Operazioni sul repository\n'
+    '\n'
+    'COMANDO: Stato\n'
+    'git status\n'
+    '\n'
+    'COMANDO: Invia le modifiche\n'
+    'git push origin main\n'
+)
+
+
+class ProcedureViewTestCase(TestCase):
+    """
+    API sulle procedure con file e categorie di prova: docker.txt, linux.txt e
+    git.txt pubblici, in una cartella temporanea; utenti admin, editor e viewer.
+    """
+
+    files = {'docker.txt': DOCKER, 'linux.txt': LINUX, 'git.txt': GIT}
+
+    def setUp(self):
+        self.files_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.files_dir)
+        settings_override = override_settings(
+            PROCEDURE_FILES_DIR=Path(self.files_dir), PROCEDURE_COMPILED_DIR='', PROCEDURE_COMPRESSED_DIR=''
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        # Cache e indici in memoria sono per processo: ogni test parte da zero
+        cache.clear()
+        parsed_procedures.clear()
+        suggest_index.__init__()
+        fuzzy_index.__init__()
+        for filename in self.files:
+            offset_indexes.invalidate(filename)
+
+        self.admin = self.create_user('admin', 'admin')
+        self.editor = self.create_user('editor', 'editor')
+        self.viewer = self.create_user('viewer', 'viewer')
+
+        self.categories = {}
+        for order, (filename, text) in enumerate(self.files.items()):
+            self.write(filename, text)
+            self.categories[filename] = self.create_category(filename, order=order)
+        self.login(self.viewer)
+
+    def create_user(self, username, role):
+        user = User.objects.create_user(username)
+        user.profile.role = role
+        user.profile.save()
+        return user
+
+    def create_category(self, filename, **fields):
+        fields.setdefault('name', filename.rsplit('.', 1)[0].capitalize())
+        fields.setdefault('icon', '📄')
+        fields.setdefault('description', f'Procedure {filename}')
+        return ProcedureCategory.objects.create(filename=filename, **fields)
+
+    def write(self, filename, text):
+        with open(os.path.join(self.files_dir, filename), 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+    def login(self, user):
+        self.client.force_login(user)
+
+    def get_json(self, url, status=200, **params):
+        response = self.client.get(url, params, headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertEqual(response.status_code, status, response.content[:500])
+        return response.json()
+
+    def post_json(self, url, data, status=200):
+        response = self.client.post(url, data, headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertEqual(response.status_code, status, response.content[:500])
+        return response.json()
+
+    def edit_command(self, filename, section, label, new_command):
+        """Modifica un comando con l'API update-command (come admin)"""
+        self.login(self.admin)
+        try:
+            return self.post_json(f'/api/category/{self.categories[filename].id}/update-command/', {
+                'section': section, 'command_label': label, 'new_command': new_command,
+            })
+        finally:
+            self.login(self.viewer)
+
+    def search(self, q, **params):
+        params.setdefault('highlight', 'offsets')
+        return self.get_json('/api/search/', q=q, **params)
+
+    def labels(self, data):
+        """Etichette dei comandi trovati, nell'ordine dei risultati"""
+        return [
+            command['label']
+            for result in data['results'] if result['type'] == 'content'
+            for section in result['sections']
+            for command in section['commands']
+        ]
+
+
+class QueryTests(SimpleTestCase):
+
+    def test_dashed_words_are_literal(self):
+        for raw, needles in (
+            ('ls -la', ['ls', '-la']),
+            ('tar -xzf', ['tar', '-xzf']),
+            ('rm -rf', ['rm', '-rf']),
+            ('git push --force', ['git', 'push', '--force']),
+        ):
+            query = compile_query(raw)
+            self.assertEqual([t.needle for t in query.positive], needles)
+            self.assertEqual(query.negative, [])
+
+    def test_exclusions(self):
+        query = compile_query('docker !legacy -"force push" -cmd:sudo')
+        self.assertEqual(
+            [(t.needle, t.field, t.phrase) for t in query.negative],
+            [('legacy', None, False), ('force push', None, True), ('sudo', 'cmd', False)],
+        )
+        # La forma canonica si ricompila negli stessi termini
+        self.assertEqual(set(compile_query(query.canonical).terms), set(query.terms))
+
+
+class SearchFlagsTests(ProcedureViewTestCase):
+
+    def test_command_options_still_match(self):
+        for q, label in (
+            ('ls -la', 'Lista dettagliata'),
+            ('tar -xzf', 'Estrai archivio'),
+            ('rm -rf', 'Elimina cartella'),
+        ):
+            for index in (True, False):
+                with self.subTest(q=q, index=index), self.settings(PROCEDURE_SEARCH_INDEX=index):
+                    cache.clear()
+                    data = self.search(q)
+                    self.assertEqual(data['total'], 1)
+                    self.assertEqual(self.labels(data), [label])
+
+    def test_exclusion(self):
+        self.assertIn('Lista container', self.labels(self.search('docker')))
+        self.assertNotIn('Lista container', self.labels(self.search('docker !ps')))
+
+
+class SearchIndexTests(ProcedureViewTestCase):
+
+    def index_rows(self, category_id):
+        start, end = search_index._rowid_range(category_id)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT COUNT(*) FROM {search_index.TABLE} WHERE rowid >= %s AND rowid < %s', [start, end]
+            )
+            return cursor.fetchone()[0]
+
+    def assertSearch(self, q, labels):
+        """Stessi risultati con l'indice full-text e con la scansione dei file"""
+        for index in (True, False):
+            with self.subTest(q=q, index=index), self.settings(PROCEDURE_SEARCH_INDEX=index):
+                cache.clear()
+                self.assertEqual(self.labels(self.search(q, fuzzy=0)), labels)
+
+    def test_categories_are_indexed_on_create(self):
+        # Righe di sezioni e comandi: 2 + 3 per docker.txt
+        self.assertEqual(self.index_rows(self.categories['docker.txt'].id), 5)
+        self.write('nuova.txt', '[Rete]\nDiagnostica\n\nCOMANDO: Porte aperte\nss -tulpn\n')
+        category = self.create_category('nuova.txt')
+        self.assertEqual(self.index_rows(category.id), 2)
+        self.assertSearch('tulpn', ['Porte aperte'])
+
+    def test_edit_updates_the_index(self):
+        self.edit_command('git.txt', 'Repository', 'Stato', 'git status --short')
+        self.assertSearch('short', ['Stato'])
+        self.edit_command('git.txt', 'Repository', 'Stato', 'git log --oneline')
+        self.assertSearch('short', [])
+        self.assertSearch('oneline', ['Stato'])
+
+    def test_delete_removes_the_rows(self):
+        category_id = self.categories['git.txt'].id
+        self.categories['git.txt'].delete()
+        self.assertEqual(self.index_rows(category_id), 0)
+        self.assertSearch('push', [])
+
+    def test_short_terms_use_like(self):
+        # Sotto i 3 caratteri il tokenizer trigram non trova nulla con MATCH
+        self.assertSearch('df', ['Utilizzo disco'])
+        self.assertSearch('cmd:ps', ['Lista container'])
+
+    def test_rebuild_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search_index.TABLE}')
+        with self.settings(PROCEDURE_SEARCH_INDEX=True):
+            cache.clear()
+            self.assertEqual(self.labels(self.search('nginx', fuzzy=0)), [])
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(self.index_rows(self.categories['linux.txt'].id), 6)
+        self.assertSearch('nginx', ['Scarica immagine'])
+
+    def test_missing_table_is_remembered(self):
+        self.addCleanup(search_index.forget_table)
+        with mock.patch.object(search_index, 'TABLE', 'procedures_missing_index'):
+            search_index.forget_table()
+            self.assertFalse(search_index.is_available())
+            with self.assertNumQueries(0):
+                self.assertFalse(search_index.is_available())
+
+
+class SearchRankingTests(ProcedureViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # "nginx" è nel nome di questa categoria e solo nel corpo di un comando di docker.txt
+        self.write('web.txt', '[Server]\nConfigurazione del server web\n\nCOMANDO: Ricarica\nsystemctl reload web\n')
+        self.create_category('web.txt', name='Nginx', description='Server web')
+
+    def ranking(self, q, **params):
+        return [
+            (result['type'], result['category_id'])
+            for result in self.search(q, fuzzy=0, **params)['results']
+        ]
+
+    def test_name_match_outranks_cmd_match(self):
+        web = ProcedureCategory.objects.get(filename='web.txt')
+        self.assertEqual(self.ranking('nginx'), [
+            ('category', web.id), ('content', self.categories['docker.txt'].id),
+        ])
+
+    def test_field_weights(self):
+        weights = {'name': 0.1, 'description': 0.1, 'cmd': 10.0}
+        with self.settings(PROCEDURE_SEARCH_WEIGHTS=weights):
+            ranking = self.ranking('nginx')
+        self.assertEqual(ranking[0], ('content', self.categories['docker.txt'].id))
+
+    def test_paging(self):
+        for n in range(5):
+            self.write(f'backup{n}.txt', f'[Backup]\nCopie\n\nCOMANDO: Copia {n}\nrsync -a /dati /backup{n}\n')
+            self.create_category(f'backup{n}.txt', name=f'Archivio {n}', order=10 + n)
+
+        everything = self.search('rsync', fuzzy=0, limit=100)
+        self.assertEqual(everything['total'], 5)
+        expected = [result['category_id'] for result in everything['results']]
+
+        pages = []
+        for offset in (0, 2, 4):
+            page = self.search('rsync', fuzzy=0, limit=2, offset=offset)
+            self.assertEqual(page['total'], 5)
+            self.assertEqual(page['offset'], offset)
+            self.assertEqual(page['has_more'], offset + 2 < 5)
+            pages.append([result['category_id'] for result in page['results']])
+        self.assertEqual(pages, [expected[0:2], expected[2:4], expected[4:]])
+        self.assertEqual(self.search('rsync', fuzzy=0, limit=2, offset=10)['results'], [])
+
+    def test_invalid_paging(self):
+        for params in ({'limit': 0}, {'limit': 'x'}, {'offset': -1}):
+            with self.subTest(params):
+                self.get_json('/api/search/', status=400, q='rsync', **params)
+
+
+class SearchCacheTests(ProcedureViewTestCase):
+
+    def commands(self, data):
+        return [
+            command['cmd']
+            for result in data['results'] if result['type'] == 'content'
+            for section in result['sections']
+            for command in section['commands']
+        ]
+
+    def test_results_are_cached(self):
+        with mock.patch.object(search, 'run_search', wraps=search.run_search) as run_search:
+            first = self.search('status')
+            second = self.search('status')
+        self.assertEqual(run_search.call_count, 1)
+        self.assertEqual(first, second)
+
+    def test_edit_invalidates_the_cache(self):
+        self.assertEqual(self.commands(self.search('status')), ['git status'])
+        self.edit_command('git.txt', 'Repository', 'Stato', 'git status --short')
+        self.assertEqual(self.commands(self.search('status')), ['git status --short'])
+
+    def test_cache_is_split_by_visibility(self):
+        self.write('segreto.txt', '[Cluster]\nAccesso\n\nCOMANDO: Pod\nkubectl get pods\n')
+        self.create_category('segreto.txt', owner=self.editor, is_public=False)
+
+        self.login(self.editor)
+        self.assertEqual(self.commands(self.search('kubectl', fuzzy=0)), ['kubectl get pods'])
+        self.login(self.viewer)
+        self.assertEqual(self.search('kubectl', fuzzy=0)['total'], 0)
+        self.assertEqual(self.search('kubectl', fuzzy=1)['total'], 0)
+        # E nell'ordine inverso, con la voce del viewer già in cache
+        self.login(self.editor)
+        self.assertEqual(self.search('kubectl', fuzzy=0)['total'], 1)
+
+
+@override_settings(PROCEDURE_SEARCH_INDEX=False)
+class SearchDeadlineTests(ProcedureViewTestCase):
+    """Scansione dei file senza indice, con il tempo massimo per richiesta"""
+
+    def slow_scan(self, filename, delay):
+        """_scan_category che impiega `delay` secondi sul file indicato"""
+        scan = search._scan_category
+
+        def slow(cat, query):
+            if cat.filename == filename:
+                time.sleep(delay)
+            return scan(cat, query)
+
+        return mock.patch.object(search, '_scan_category', slow)
+
+    def test_scan_within_the_deadline(self):
+        data = self.search('git', fuzzy=0)
+        self.assertFalse(data['truncated'])
+        self.assertEqual(self.labels(data), ['Stato', 'Invia le modifiche'])
+
+    def test_expired_deadline_truncates_the_results(self):
+        with self.settings(PROCEDURE_SEARCH_DEADLINE=0.2), self.slow_scan('git.txt', 0.6):
+            data = self.search('on', fuzzy=0)
+        self.assertTrue(data['truncated'])
+        # I file scansionati in tempo restano nei risultati
+        self.assertEqual(
+            {result['category_id'] for result in data['results']},
+            {self.categories['docker.txt'].id, self.categories['linux.txt'].id},
+        )
+
+    def test_truncated_results_are_not_cached(self):
+        with self.settings(PROCEDURE_SEARCH_DEADLINE=0.2), self.slow_scan('git.txt', 0.6):
+            self.assertTrue(self.search('git', fuzzy=0)['truncated'])
+        data = self.search('git', fuzzy=0)
+        self.assertFalse(data['truncated'])
+        self.assertEqual(self.labels(data), ['Stato', 'Invia le modifiche'])
+
+
+class FuzzySearchTests(ProcedureViewTestCase):
+
+    def test_auto_corrects_when_nothing_matches(self):
+        data = self.search('dokcer')
+        self.assertTrue(data['fuzzy'])
+        self.assertEqual(data['corrections'], {'dokcer': ['docker']})
+        self.assertGreater(data['total'], 0)
+        self.assertEqual({result['distance'] for result in data['results']}, {1})
+        self.assertIn('Lista container', self.labels(data))
+
+    def test_auto_keeps_exact_results(self):
+        data = self.search('docker')
+        self.assertFalse(data['fuzzy'])
+        self.assertEqual(data['corrections'], {})
+
+    def test_off(self):
+        data = self.search('dokcer', fuzzy=0)
+        self.assertFalse(data['fuzzy'])
+        self.assertEqual((data['total'], data['corrections']), (0, {}))
+
+    def test_on_includes_exact_results_first(self):
+        data = self.search('status', fuzzy=1)
+        self.assertTrue(data['fuzzy'])
+        self.assertEqual(data['results'][0]['distance'], 0)
+        self.assertEqual(self.labels(data)[0], 'Stato')
+
+    def test_invalid_mode(self):
+        self.get_json('/api/search/', status=400, q='docker', fuzzy='forse')
+
+    def test_words_of_hidden_categories_are_not_suggested(self):
+        self.write('segreto.txt', '[Cluster]\nAccesso\n\nCOMANDO: Pod\nkubectl get pods\n')
+        self.create_category('segreto.txt', owner=self.editor, is_public=False)
+        self.assertEqual(self.search('kubetcl')['corrections'], {})
+        self.login(self.editor)
+        self.assertEqual(self.search('kubetcl')['corrections'], {'kubetcl': ['kubectl']})
+
+    def test_rewrites_share_the_request_deadline(self):
+        collect = search.collect_candidates
+
+        def slow(categories, query, deadline=None):
+            time.sleep(0.3)
+            return collect(categories, query, deadline)
+
+        with self.settings(PROCEDURE_SEARCH_DEADLINE=0.2), \
+                mock.patch.object(search, 'collect_candidates', side_effect=slow) as collect_candidates:
+            data = self.search('dokcer', fuzzy=1)
+        # La prima ricerca (esatta) consuma il tempo: nessuna riscrittura viene cercata
+        self.assertEqual(collect_candidates.call_count, 1)
+        self.assertTrue(data['truncated'])
+        self.assertEqual(data['corrections'], {})
+
+    def test_expired_deadline_searches_nothing(self):
+        with self.settings(PROCEDURE_SEARCH_DEADLINE=0), \
+                mock.patch.object(search, 'collect_candidates', wraps=search.collect_candidates) as collect:
+            data = self.search('dokcer', fuzzy=1)
+        collect.assert_not_called()
+        self.assertTrue(data['truncated'])
+        self.assertEqual(data['total'], 0)
+
+
+class FullOverwriteTests(ProcedureViewTestCase):
+    """Salvataggio completo dall'editor e upload: il file viene sostituito, non riscritto sul posto"""
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.files_dir, 'git.txt')
+        os.chmod(self.path, 0o640)
+        self.url = f"/api/category/{self.categories['git.txt'].id}"
+        self.login(self.admin)
+
+    def assertReplaced(self, reader, before, expected):
+        # Chi aveva già aperto il file legge ancora la versione precedente, intera
+        self.assertEqual(reader.read().decode('utf-8'), GIT)
+        st = os.stat(self.path)
+        self.assertNotEqual(st.st_ino, before.st_ino)
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o640)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read().decode('utf-8'), expected)
+        self.assertEqual([name for name in os.listdir(self.files_dir) if name.startswith('.tmp-')], [])
+
+    def test_wysiwyg_save(self):
+        before = os.stat(self.path)
+        with open(self.path, 'rb') as reader:
+            self.post_json(f'{self.url}/update-wysiwyg/', {
+                'content': '<h2>Repository</h2><p>Già</p><h3>Stato</h3><pre>git status -sb</pre>',
+            })
+            self.assertReplaced(reader, before, '[Repository]\nGià\n\nCOMANDO: Stato\ngit status -sb\n')
+        self.assertEqual(self.labels(self.search('-sb')), ['Stato'])
+
+    def test_file_upload(self):
+        before = os.stat(self.path)
+        upload = SimpleUploadedFile('git.txt', b'[Nuova]\nDescrizione\n\nCOMANDO: Log\ngit log\n')
+        with open(self.path, 'rb') as reader:
+            self.post_json(f'{self.url}/update-file/', {'file': upload})
+            self.assertReplaced(reader, before, '[Nuova]\nDescrizione\n\nCOMANDO: Log\ngit log\n')
+        self.assertEqual(self.labels(self.search('git log')), ['Log'])
+
+
+class ParsedCacheInvalidationTests(ProcedureViewTestCase):
+
+    def test_patch_keeps_the_entry_it_stored(self):
+        offset_indexes.get('git.txt')
+        # Le sezioni salvate dalla modifica puntuale servono gli indici e le letture
+        with mock.patch.object(compiled, 'load', wraps=compiled.load) as load:
+            self.edit_command('git.txt', 'Repository', 'Stato', 'git status --short')
+            data = self.get_json('/api/procedure/git.txt/')
+            self.get_json('/api/procedure/git.txt/toc/')
+        load.assert_not_called()
+        self.assertEqual(data['sections'][0]['commands'][0]['cmd'], 'git status --short')
+
+    def test_other_writes_drop_the_entry(self):
+        self.write('git.txt', GIT.replace('git status', 'git status --porcelain'))
+        with mock.patch.object(compiled, 'load', wraps=compiled.load) as load:
+            self.categories['git.txt'].save()
+            data = self.get_json('/api/procedure/git.txt/')
+        load.assert_called_once()
+        self.assertEqual(data['sections'][0]['commands'][0]['cmd'], 'git status --porcelain')
+
+
+@override_settings(PROCEDURE_IMPORT_WORKERS=1)
+class ImportTests(ProcedureViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.login(self.editor)
+
+    def archive(self, members, kind='zip'):
+        """Archivio in memoria con i membri indicati (nome -> byte)"""
+        buffer = io.BytesIO()
+        if kind == 'zip':
+            with zipfile.ZipFile(buffer, 'w') as archive:
+                for name, data in members.items():
+                    archive.writestr(name, data)
+        else:
+            with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+                for name, data in members.items():
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    archive.addfile(info, io.BytesIO(data))
+        return SimpleUploadedFile(f'procedure.{kind}', buffer.getvalue())
+
+    def procedure(self, n):
+        return f'[Sezione {n}]\nDescrizione\n\nCOMANDO: Comando {n}\necho importato{n}\n'.encode('utf-8')
+
+    def import_archive(self, members, status=200, kind='zip', **data):
+        return self.post_json('/api/import/', dict(data, archive=self.archive(members, kind)), status=status)
+
+    def test_import_creates_searchable_procedures(self):
+        for kind in ('zip', 'tar.gz'):
+            with self.subTest(kind):
+                name = f'nuova_{kind.replace(".", "")}.txt'
+                result = self.import_archive({f'cartella/{name}': self.procedure(1)}, kind=kind)
+                self.assertEqual([c['filename'] for c in result['created']], [name])
+                self.assertEqual(result['skipped'], [])
+                category = ProcedureCategory.objects.get(filename=name)
+                self.assertEqual(category.owner, self.editor)
+        self.assertEqual(self.labels(self.search('importato1', fuzzy=0)), ['Comando 1', 'Comando 1'])
+        self.assertEqual(self.get_json('/api/suggest/', q='comando')['suggestions'][0]['text'], 'Comando 1')
+
+    def test_traversal_names_stay_in_the_procedure_folder(self):
+        result = self.import_archive({'../evil.txt': self.procedure(1), '/etc/abs.txt': self.procedure(2)})
+        self.assertEqual(sorted(c['filename'] for c in result['created']), ['abs.txt', 'evil.txt'])
+        self.assertTrue(os.path.exists(os.path.join(self.files_dir, 'evil.txt')))
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(self.files_dir), 'evil.txt')))
+
+    def test_skipped_files(self):
+        result = self.import_archive({
+            'a/doppio.txt': self.procedure(1),
+            'b/doppio.txt': self.procedure(2),
+            'git.txt': self.procedure(3),
+            'latin1.txt': '[Sezione]\nè\n'.encode('latin-1'),
+            'vuoto.txt': b'solo testo\n',
+            'immagine.png': b'\x89PNG',
+        })
+        self.assertEqual([c['filename'] for c in result['created']], ['doppio.txt'])
+        self.assertEqual({item['filename']: item['error'] for item in result['skipped']}, {
+            'doppio.txt': 'File duplicato nell\'archivio',
+            'git.txt': 'Un file con questo nome esiste già',
+            'latin1.txt': 'Il file non è in formato UTF-8',
+            'vuoto.txt': 'Nessuna sezione [TITOLO] trovata',
+        })
+        # Il file esistente non viene toccato
+        with open(os.path.join(self.files_dir, 'git.txt'), 'rb') as f:
+            self.assertEqual(f.read().decode('utf-8'), GIT)
+
+    def test_limits(self):
+        with self.settings(PROCEDURE_IMPORT_MAX_BYTES=100):
+            error = self.import_archive({'grande.txt': self.procedure(1) * 5}, status=400)['error']
+        self.assertIn('troppo grande', error)
+        with self.settings(PROCEDURE_IMPORT_MAX_FILES=2):
+            error = self.import_archive({f'p{n}.txt': self.procedure(n) for n in range(3)}, status=400)['error']
+        self.assertIn('Troppi file', error)
+        self.assertFalse(ProcedureCategory.objects.filter(filename__in=['grande.txt', 'p0.txt']).exists())
+
+    def test_manifest_metadata(self):
+        manifest = json.dumps({'procedures': [
+            {'filename': 'secondo.txt', 'name': 'Secondo', 'icon': '🚀', 'description': 'Dal manifest',
+             'is_public': False, 'order': 1},
+            {'filename': 'primo.txt', 'name': 'Primo', 'order': 0},
+        ]}).encode('utf-8')
+        result = self.import_archive({
+            'manifest.json': manifest, 'secondo.txt': self.procedure(2), 'primo.txt': self.procedure(1),
+        })
+        self.assertEqual([c['filename'] for c in result['created']], ['primo.txt', 'secondo.txt'])
+        second = ProcedureCategory.objects.get(filename='secondo.txt')
+        self.assertEqual((second.name, second.icon, second.description, second.is_public),
+                         ('Secondo', '🚀', 'Dal manifest', False))
+        first = ProcedureCategory.objects.get(filename='primo.txt')
+        self.assertLess(first.order, second.order)
+
+    def test_viewer_cannot_import(self):
+        self.login(self.viewer)
+        self.import_archive({'p.txt': self.procedure(1)}, status=403)
+
+    def test_one_batch_per_import(self):
+        def queries(count, offset):
+            members = {f'blocco{offset + n}.txt': self.procedure(offset + n) for n in range(count)}
+            with CaptureQueriesContext(connection) as captured:
+                self.import_archive(members)
+            return len(captured)
+
+        # Le query non crescono con il numero di file
+        self.assertEqual(queries(2, 0), queries(6, 10))
+        self.assertEqual(
+            ProcedureEvent.objects.filter(kind='created', category_id__in=ProcedureCategory.objects.filter(
+                filename__startswith='blocco').values('id')).count(),
+            8,
+        )
+        self.assertEqual(self.search('importato13', fuzzy=0)['total'], 1)
+
+
+class ExportTests(ProcedureViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.login(self.admin)
+
+    def export(self, fmt, status=200):
+        response = self.client.get('/api/export/', {'format': fmt})
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def members(self, fmt):
+        """Contenuto dell'archivio esportato: nome -> byte"""
+        response = self.export(fmt)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], export.FORMATS[fmt][0])
+        self.assertIn(f'.{fmt}"', response['Content-Disposition'])
+        data = io.BytesIO(b''.join(response.streaming_content))
+        if fmt == 'zip':
+            with zipfile.ZipFile(data) as archive:
+                self.assertIsNone(archive.testzip())
+                return {name: archive.read(name) for name in archive.namelist()}
+        with tarfile.open(fileobj=data, mode='r:gz') as archive:
+            return {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+
+    def on_disk(self, filename):
+        with open(os.path.join(self.files_dir, filename), 'rb') as f:
+            return f.read()
+
+    def test_archive_matches_the_files_on_disk(self):
+        for fmt in export.FORMATS:
+            with self.subTest(fmt):
+                members = self.members(fmt)
+                self.assertEqual(list(members), [f'procedure_files/{name}' for name in self.files] + ['manifest.json'])
+                for filename in self.files:
+                    self.assertEqual(members[f'procedure_files/{filename}'], self.on_disk(filename))
+
+                manifest = json.loads(members['manifest.json'])
+                self.assertEqual(manifest['version'], export.MANIFEST_VERSION)
+                self.assertEqual(manifest['missing'], [])
+                self.assertEqual([entry['filename'] for entry in manifest['procedures']], list(self.files))
+                for entry in manifest['procedures']:
+                    content = self.on_disk(entry['filename'])
+                    category = self.categories[entry['filename']]
+                    self.assertEqual(entry['size'], len(content))
+                    self.assertEqual(entry['sha256'], hashlib.sha256(content).hexdigest())
+                    self.assertEqual((entry['name'], entry['order'], entry['is_public']),
+                                     (category.name, category.order, category.is_public))
+
+    def test_missing_files_are_listed_in_the_manifest(self):
+        os.remove(os.path.join(self.files_dir, 'linux.txt'))
+        for fmt in export.FORMATS:
+            with self.subTest(fmt):
+                members = self.members(fmt)
+                self.assertNotIn('procedure_files/linux.txt', members)
+                self.assertEqual(json.loads(members['manifest.json'])['missing'], ['linux.txt'])
+
+    def test_invalid_format(self):
+        self.export('rar', status=400)
+
+    def test_only_admins_can_export(self):
+        for user in (self.editor, self.viewer):
+            with self.subTest(user.username):
+                self.login(user)
+                response = self.export('zip', status=403)
+                self.assertFalse(response.streaming)
+
+
+class ConditionalRequestTests(ProcedureViewTestCase):
+
+    def get(self, url, **headers):
+        return self.client.get(url, headers=dict(headers, **{'X-Requested-With': 'XMLHttpRequest'}))
+
+    def test_unchanged_content_is_not_modified(self):
+        for url in ('/api/procedure/linux.txt/', '/api/procedure/linux.txt/section/0/'):
+            with self.subTest(url):
+                response = self.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Cache-Control'], 'private, no-cache')
+                etag, last_modified = response['ETag'], response['Last-Modified']
+
+                # Il 304 è prodotto senza parsare il file
+                with mock.patch.object(parsed_procedures, 'get', side_effect=AssertionError):
+                    for headers in ({'If-None-Match': etag}, {'If-Modified-Since': last_modified}):
+                        response = self.get(url, **headers)
+                        self.assertEqual(response.status_code, 304)
+                        self.assertEqual(response['ETag'], etag)
+                        self.assertEqual(response.content, b'')
+
+    def test_changed_content_is_sent_again(self):
+        etag = self.get('/api/procedure/git.txt/')['ETag']
+        self.edit_command('git.txt', 'Repository', 'Stato', 'git status -sb')
+        response = self.get('/api/procedure/git.txt/', **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('git status -sb', response.content.decode('utf-8'))
+
+    def test_etag_depends_on_edit_permission(self):
+        etag = self.get('/api/procedure/git.txt/')['ETag']
+        self.login(self.admin)
+        response = self.get('/api/procedure/git.txt/', **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['can_edit'])
+
+
+class DownloadTests(ProcedureViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = f'/api/category/{self.categories["linux.txt"].id}/download/'
+        with open(os.path.join(self.files_dir, 'linux.txt'), 'rb') as f:
+            self.content = f.read()
+        self.size = len(self.content)
+
+    def download(self, status, **headers):
+        response = self.client.get(self.url, headers=dict(headers, **{'X-Requested-With': 'XMLHttpRequest'}))
+        self.assertEqual(response.status_code, status)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, body
+
+    def test_full_download(self):
+        response, body = self.download(200)
+        self.assertEqual(body, self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="linux.txt"')
+
+        response, body = self.download(304, **{'If-None-Match': response['ETag']})
+        self.assertEqual(body, b'')
+
+    def test_ranges(self):
+        cases = [
+            ('bytes=0-9', 0, 9),
+            ('bytes=10-', 10, self.size - 1),
+            ('bytes=-5', self.size - 5, self.size - 1),
+            (f'bytes=-{self.size + 100}', 0, self.size - 1),
+            (f'bytes=5-{self.size + 100}', 5, self.size - 1),
+        ]
+        for header, start, end in cases:
+            with self.subTest(header):
+                response, body = self.download(206, Range=header)
+                self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/{self.size}')
+                self.assertEqual(response['Content-Length'], str(end - start + 1))
+                self.assertEqual(body, self.content[start:end + 1])
+
+    def test_unsatisfiable_ranges(self):
+        for header in (f'bytes={self.size}-', f'bytes={self.size + 10}-{self.size + 20}', 'bytes=-0'):
+            with self.subTest(header):
+                response, body = self.download(416, Range=header)
+                self.assertEqual(response['Content-Range'], f'bytes */{self.size}')
+
+    def test_ignored_ranges_send_the_whole_file(self):
+        for header in ('bytes=0-1,5-6', 'bytes=9-3', 'items=0-5', 'bytes=-'):
+            with self.subTest(header):
+                response, body = self.download(200, Range=header)
+                self.assertNotIn('Content-Range', response)
+                self.assertEqual(body, self.content)
+
+    def test_if_range(self):
+        response, _ = self.download(200)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        for validator in (etag, last_modified):
+            with self.subTest(validator):
+                _, body = self.download(206, Range='bytes=0-3', **{'If-Range': validator})
+                self.assertEqual(body, self.content[:4])
+
+        # Versione diversa: si invia il file intero
+        _, body = self.download(200, Range='bytes=0-3', **{'If-Range': '"vecchio"'})
+        self.assertEqual(body, self.content)
+
+    @override_settings(PROCEDURE_DOWNLOAD_MODE='x-accel', PROCEDURE_DOWNLOAD_ACCEL_PREFIX='/protected/procedure/')
+    def test_x_accel_redirect(self):
+        response, body = self.download(200, Range='bytes=0-3')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/procedure/linux.txt')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="linux.txt"')
+        self.assertEqual(body, b'')
+
+        # I permessi sono verificati prima di delegare a nginx
+        self.categories['linux.txt'].is_public = False
+        self.categories['linux.txt'].save()
+        response, _ = self.download(404)
+        self.assertNotIn('X-Accel-Redirect', response)
+
+
+class TableOfContentsTests(ProcedureViewTestCase):
+
+    def test_toc(self):
+        data = self.get_json('/api/procedure/docker.txt/toc/')
+        stamp, spans = offset_indexes.get('docker.txt')
+        self.assertEqual(data['version'], version(stamp))
+        self.assertEqual([(s['index'], s['title'], s['commands']) for s in data['sections']],
+                         [(0, 'Container', 2), (1, 'Immagini', 1)])
+        self.assertEqual([s['id'] for s in data['sections']], section_ids(spans))
+        self.assertFalse(data['can_edit'])
+
+    def test_section_ids_are_stable(self):
+        ids = [s['id'] for s in self.get_json('/api/procedure/docker.txt/toc/')['sections']]
+        self.edit_command('docker.txt', 'Immagini', 'Scarica immagine', 'docker pull nginx:latest')
+        data = self.get_json('/api/procedure/docker.txt/toc/')
+        self.assertEqual([s['id'] for s in data['sections']], ids)
+
+        # Titoli ripetuti: id distinti
+        self.write('docker.txt', DOCKER + DOCKER)
+        ids = [s['id'] for s in self.get_json('/api/procedure/docker.txt/toc/')['sections']]
+        self.assertEqual(len(set(ids)), 4)
+
+    def test_section(self):
+        for index, title in enumerate(('Container', 'Immagini')):
+            with self.subTest(title):
+                data = self.get_json(f'/api/procedure/docker.txt/section/{index}/')
+                self.assertEqual(data['index'], index)
+                self.assertEqual(data['section'], sections_to_dicts(parsed_procedures.get('docker.txt'))[index])
+
+    def test_missing_section(self):
+        self.assertEqual(self.get_json('/api/procedure/docker.txt/section/2/', status=404)['error'],
+                         'Sezione non trovata')
+
+    def test_hidden_procedure(self):
+        self.categories['git.txt'].is_public = False
+        self.categories['git.txt'].save()
+        for url in ('/api/procedure/git.txt/toc/', '/api/procedure/git.txt/section/0/', '/api/procedure/assente.txt/toc/'):
+            with self.subTest(url):
+                self.get_json(url, status=404)
+
+        self.login(self.admin)
+        self.get_json('/api/procedure/git.txt/toc/')
+
+
+class BatchTests(ProcedureViewTestCase):
+
+    def batch(self, *ids, status=200):
+        return self.get_json('/api/procedures/batch/', status=status, ids=','.join(str(i) for i in ids))
+
+    def test_batch(self):
+        docker, git = self.categories['docker.txt'].id, self.categories['git.txt'].id
+        data = self.batch(git, docker, git, 9999)
+        self.assertEqual([p['filename'] for p in data['procedures']], ['git.txt', 'docker.txt'])
+        self.assertEqual(data['procedures'][0]['sections'], sections_to_dicts(parsed_procedures.get('git.txt')))
+        self.assertEqual(data['not_found'], [9999])
+        self.assertEqual(data['omitted'], [])
+
+    def test_hidden_procedures_are_not_found(self):
+        self.categories['git.txt'].is_public = False
+        self.categories['git.txt'].save()
+        data = self.batch(self.categories['git.txt'].id, self.categories['linux.txt'].id)
+        self.assertEqual([p['filename'] for p in data['procedures']], ['linux.txt'])
+        self.assertEqual(data['not_found'], [self.categories['git.txt'].id])
+
+    def test_invalid_ids(self):
+        self.batch(status=400)
+        self.get_json('/api/procedures/batch/', status=400, ids='1,due')
+
+    @override_settings(PROCEDURE_BATCH_MAX_IDS=2)
+    def test_max_ids(self):
+        ids = [c.id for c in self.categories.values()]
+        self.assertEqual(self.batch(*ids, status=400)['error'], 'Massimo 2 procedure per richiesta')
+        self.assertEqual(len(self.batch(*ids[:2])['procedures']), 2)
+
+    def test_max_bytes(self):
+        ids = [c.id for c in self.categories.values()]
+        sizes = {}
+        for category in self.categories.values():
+            encoded = json.dumps(self.batch(category.id)['procedures'][0])
+            sizes[category.id] = len(encoded.encode('utf-8'))
+
+        # Il limite vale sul JSON: la prima e la terza ci stanno, la seconda no
+        first, second, third = ids
+        limit = sizes[first] + sizes[third]
+        with override_settings(PROCEDURE_BATCH_MAX_BYTES=limit):
+            data = self.batch(*ids)
+        self.assertEqual([p['id'] for p in data['procedures']], [first, third])
+        self.assertEqual(data['omitted'], [second])
+        self.assertEqual(data['not_found'], [])
+
+        # Una procedura più grande del limite da sola viene omessa
+        with override_settings(PROCEDURE_BATCH_MAX_BYTES=sizes[first] - 1):
+            data = self.batch(first)
+        self.assertEqual((data['procedures'], data['omitted']), ([], [first]))
+
+
+class SuggestTests(ProcedureViewTestCase):
+
+    def suggest(self, q, status=200, **params):
+        return self.get_json('/api/suggest/', status=status, q=q, **params)
+
+    def texts(self, q, **params):
+        return [item['text'] for item in self.suggest(q, **params)['suggestions']]
+
+    def test_prefixes(self):
+        self.assertEqual(self.texts('lis'), ['Lista container', 'Lista dettagliata'])
+        self.assertEqual(self.texts('cont'), ['Container', 'Lista container', 'Rimuovi container fermi'])
+        self.assertEqual(self.suggest('')['suggestions'], [])
+
+    def test_limit(self):
+        self.assertEqual(len(self.texts('c', limit=1)), 1)
+        for limit in ('0', '-1', 'tanti'):
+            with self.subTest(limit):
+                self.assertEqual(self.suggest('c', status=400, limit=limit)['error'], 'Parametro limit non valido')
+
+    def test_hidden_categories(self):
+        self.categories['git.txt'].is_public = False
+        self.categories['git.txt'].save()
+        self.assertEqual(self.texts('sta'), [])
+        self.login(self.admin)
+        self.assertEqual(self.texts('sta'), ['Stato'])
+
+        self.categories['git.txt'].owner = self.editor
+        self.categories['git.txt'].save()
+        self.login(self.editor)
+        self.assertEqual(self.texts('sta'), ['Stato'])
+
+    def test_one_version_query_per_request(self):
+        self.suggest('lis')
+        with CaptureQueriesContext(connection) as captured:
+            self.suggest('doc')
+        tables = [query['sql'] for query in captured.captured_queries if 'procedures_procedure' in query['sql']]
+        self.assertEqual(len(tables), 1)
+        self.assertIn('procedures_procedureevent', tables[0])
+
+    def test_changes_from_other_processes(self):
+        self.suggest('lis')
+        # Scrittura di un altro processo: nessun segnale in questo, solo il nuovo evento
+        self.write('rete.txt', '[Rete]\nInterfacce\n\nCOMANDO: Lista interfacce\nip addr\n')
+        category = ProcedureCategory.objects.bulk_create([ProcedureCategory(
+            filename='rete.txt', name='Rete', icon='🌐', description='Rete'
+        )])[0]
+        ProcedureEvent.objects.create(kind='created', category_id=category.id)
+        self.assertIn('Lista interfacce', self.texts('lis'))
+
+
+class AsyncViewTests(ProcedureViewTestCase):
+    """Viste async (PROCEDURE_ASYNC_VIEWS) interrogate con AsyncClient"""
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(PROCEDURE_ASYNC_VIEWS=True)
+        settings_override.enable()
+        self.addCleanup(self.reload_urls)
+        self.addCleanup(settings_override.disable)
+        self.reload_urls()
+        self.async_client.force_login(self.viewer)
+
+    def reload_urls(self):
+        """Le viste async sono scelte all'import degli URL: si ricaricano con l'impostazione corrente"""
+        importlib.reload(importlib.import_module('procedures.urls'))
+        importlib.reload(importlib.import_module(django_settings.ROOT_URLCONF))
+        clear_url_caches()
+
+    async def get(self, url, status=200, headers=None, **params):
+        response = await self.async_client.get(
+            url, params, headers={'X-Requested-With': 'XMLHttpRequest', **(headers or {})}
+        )
+        self.assertEqual(response.status_code, status)
+        if response.streaming:
+            response.body = b''.join([chunk async for chunk in response.streaming_content])
+        else:
+            response.body = response.content
+        return response
+
+    def test_urls_use_the_async_views(self):
+        for url in ('/api/procedure/git.txt/', '/api/search/', '/api/category/1/download/', '/api/events/'):
+            with self.subTest(url):
+                self.assertTrue(iscoroutinefunction(resolve(url).func))
+
+    async def test_content(self):
+        response = await self.get('/api/procedure/git.txt/')
+        data = json.loads(response.body)
+        self.assertEqual(data['sections'], sections_to_dicts(parsed_procedures.get('git.txt')))
+        self.assertFalse(data['can_edit'])
+
+        response = await self.get('/api/procedure/git.txt/', 304, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.body, b'')
+        await self.get('/api/procedure/assente.txt/', 404)
+
+    async def test_hidden_content(self):
+        await ProcedureCategory.objects.filter(filename='git.txt').aupdate(is_public=False)
+        await self.get('/api/procedure/git.txt/', 404)
+
+    async def test_search(self):
+        response = await self.get('/api/search/', q='container', highlight='offsets', fuzzy=0)
+        data = json.loads(response.body)
+        self.assertEqual(self.labels(data), ['Lista container', 'Rimuovi container fermi'])
+        await self.get('/api/search/', 400, q='docker', limit=0)
+
+    async def test_download(self):
+        category = self.categories['linux.txt']
+        with open(os.path.join(self.files_dir, 'linux.txt'), 'rb') as f:
+            content = f.read()
+        url = f'/api/category/{category.id}/download/'
+
+        response = await self.get(url)
+        self.assertEqual(response.body, content)
+        self.assertEqual(response['Content-Length'], str(len(content)))
+
+        response = await self.get(url, 206, headers={'Range': 'bytes=-5'})
+        self.assertEqual(response.body, content[-5:])
+        self.assertEqual(response['Content-Range'], f'bytes {len(content) - 5}-{len(content) - 1}/{len(content)}')
+
+        response = await self.get(url, 416, headers={'Range': f'bytes={len(content)}-'})
+        self.assertEqual(response['Content-Range'], f'bytes */{len(content)}')
+
+    async def test_events(self):
+        latest = await events.alatest_version()
+        data = json.loads((await self.get('/api/events/')).body)
+        self.assertEqual((data['version'], data['events']), (latest, []))
+
+        data = json.loads((await self.get('/api/events/', since=latest - 1)).body)
+        self.assertEqual([event['category_id'] for event in data['events']], [self.categories['git.txt'].id])
+        await self.get('/api/events/', 400, since='ieri')
+
+    @override_settings(PROCEDURE_EVENTS_STREAM_TIMEOUT=0, PROCEDURE_EVENTS_RETRY=2)
+    async def test_event_stream(self):
+        latest = await events.alatest_version()
+        response = await self.get('/api/events/', headers={
+            'Accept': 'text/event-stream', 'Last-Event-ID': str(latest - 1)
+        })
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['X-Accel-Buffering'], 'no')
+        body = response.body.decode('utf-8')
+        self.assertTrue(body.startswith('retry: 2000\n\n'))
+        self.assertIn(f'id: {latest}\nevent: procedure\ndata: ', body)
+
+
+class EventTests(ProcedureViewTestCase):
+
+    def latest(self):
+        return events.latest_version()
+
+    def poll(self, since=None, status=200, **headers):
+        params = {} if since is None else {'since': since}
+        response = self.client.get('/api/events/', params, headers={'X-Requested-With': 'XMLHttpRequest', **headers})
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def pending(self, since):
+        return self.poll(since).json()
+
+    def stream(self, since):
+        response = self.poll(**{'Accept': 'text/event-stream', 'Last-Event-ID': str(since)})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual((response['Cache-Control'], response['X-Accel-Buffering']), ('no-cache', 'no'))
+        return response.content.decode('utf-8')
+
+    def test_current_version(self):
+        data = self.poll().json()
+        self.assertEqual((data['version'], data['events'], data['reset'], data['has_more']),
+                         (self.latest(), [], False, False))
+        self.poll('ieri', status=400)
+        self.poll('-1', status=400)
+
+    def test_since(self):
+        since = self.latest()
+        self.edit_command('git.txt', 'Repository', 'Stato', 'git status -s')
+        self.edit_command('git.txt', 'Repository', 'Stato', 'git status -sb')
+        self.edit_command('docker.txt', 'Immagini', 'Scarica immagine', 'docker pull nginx:latest')
+        linux_id = self.categories['linux.txt'].id
+        self.categories['linux.txt'].delete()
+
+        data = self.pending(since)
+        # Un solo evento per categoria, l'ultimo
+        self.assertEqual([(e['type'], e['category_id']) for e in data['events']], [
+            ('updated', self.categories['git.txt'].id),
+            ('updated', self.categories['docker.txt'].id),
+            ('deleted', linux_id),
+        ])
+        self.assertEqual(data['version'], self.latest())
+        self.assertEqual(data['events'][0]['category']['filename'], 'git.txt')
+        self.assertEqual(self.pending(data['version'])['events'], [])
+
+    def test_hidden_categories_arrive_as_deleted(self):
+        since = self.latest()
+        self.write('segreto.txt', GIT)
+        self.create_category('segreto.txt', owner=self.editor, is_public=False)
+        git = self.categories['git.txt']
+        git.is_public = False
+        git.save()
+
+        data = self.pending(since)
+        self.assertEqual([(e['type'], e['category_id']) for e in data['events']], [('deleted', git.id)])
+        self.assertEqual(data['version'], self.latest())
+
+    def test_has_more(self):
+        since = self.latest()
+        for category in self.categories.values():
+            category.save()
+        with mock.patch.object(events, 'BATCH_SIZE', 2):
+            first = self.pending(since)
+            self.assertTrue(first['has_more'])
+            self.assertEqual(first['version'], since + 2)
+            second = self.pending(first['version'])
+        self.assertFalse(second['has_more'])
+        self.assertEqual(second['version'], self.latest())
+        self.assertEqual(len(first['events']) + len(second['events']), 3)
+
+    def test_reset(self):
+        # Versione mai esistita (database ricreato)
+        data = self.pending(self.latest() + 10)
+        self.assertEqual((data['reset'], data['version'], data['events']), (True, self.latest(), []))
+
+        # Eventi non più conservati
+        ProcedureEvent.objects.filter(id__lt=self.latest()).delete()
+        self.assertTrue(self.pending(self.latest() - 2)['reset'])
+        self.assertFalse(self.pending(self.latest() - 1)['reset'])
+
+    @override_settings(PROCEDURE_EVENTS_KEEP=5)
+    def test_pruning(self):
+        category_id = self.categories['git.txt'].id
+        with mock.patch.object(events, 'PRUNE_EVERY', 10):
+            while self.latest() % 10 != 9:
+                events.record('updated', category_id)
+            self.assertGreater(ProcedureEvent.objects.count(), 5)
+
+            # Superato un multiplo di PRUNE_EVERY restano gli ultimi PROCEDURE_EVENTS_KEEP
+            events.record('updated', category_id)
+            self.assertEqual(list(ProcedureEvent.objects.values_list('id', flat=True)),
+                             list(range(self.latest() - 4, self.latest() + 1)))
+
+            events.record_many('created', [category_id] * 12)
+            self.assertEqual(ProcedureEvent.objects.count(), 5)
+            self.assertEqual(ProcedureEvent.objects.order_by('-id').first().id, self.latest())
+
+    def test_event_stream(self):
+        since = self.latest()
+        self.edit_command('git.txt', 'Repository', 'Stato', 'git status -s')
+        body = self.stream(since)
+        retry, block = body.split('\n\n')[:2]
+        self.assertEqual(retry, 'retry: 10000')
+        lines = block.split('\n')
+        self.assertEqual(lines[:2], [f'id: {self.latest()}', 'event: procedure'])
+        message = json.loads(lines[2].removeprefix('data: '))
+        self.assertEqual((message['type'], message['category_id']), ('updated', self.categories['git.txt'].id))
+        self.assertTrue(body.endswith('\n\n'))
+
+    def test_event_stream_advances_past_hidden_events(self):
+        since = self.latest()
+        self.write('segreto.txt', GIT)
+        self.create_category('segreto.txt', owner=self.editor, is_public=False)
+        with self.settings(PROCEDURE_EVENTS_RETRY=2):
+            self.assertEqual(self.stream(since), f'retry: 2000\n\nid: {self.latest()}\n\n')
+
+    def test_event_stream_reset_and_backlog(self):
+        self.assertEqual(self.stream(self.latest() + 1),
+                         f'retry: 10000\n\nid: {self.latest()}\nevent: reset\ndata: {{}}\n\n')
+
+        # Altri eventi in attesa: il browser si riconnette subito
+        since = self.latest()
+        self.categories['git.txt'].save()
+        with mock.patch.object(events, 'BATCH_SIZE', 1):
+            self.categories['docker.txt'].save()
+            self.assertTrue(self.stream(since).startswith('retry: 0\n\n'))
@@ -1,5 +1,9 @@
+from django.conf import settings
 from django.urls import path
-from . import views, auth_views
+from . import async_views, views, auth_views
+
+# Con il deploy ASGI le API legate ai file e lo stream degli eventi usano le viste async (vedi async_views.py)
+io_views = async_views if settings.PROCEDURE_ASYNC_VIEWS else views
 
 app_name = 'procedures'
 
@@ -24,16 +28,29 @@ urlpatterns = [
     path('api/category/<int:category_id>/update-wysiwyg/', views.update_procedure_wysiwyg, name='update_procedure_wysiwyg'),
     
     # API Procedure - Lettura
-    path('api/procedure/<str:filename>/', views.get_procedure_content, name='get_procedure_content'),
-    path('api/category/<int:category_id>/download/', views.download_procedure_file, name='download_procedure'),
+    path('api/procedure/<str:filename>/', io_views.get_procedure_content, name='get_procedure_content'),
+    path('api/procedure/<str:filename>/toc/', views.get_procedure_toc, name='get_procedure_toc'),
+    path('api/procedure/<str:filename>/section/<int:index>/', views.get_procedure_section, name='get_procedure_section'),
+    path('api/procedures/batch/', views.get_procedures_batch, name='get_procedures_batch'),
+    path('api/category/<int:category_id>/download/', io_views.download_procedure_file, name='download_procedure'),
+    path('api/export/', views.export_procedures, name='export_procedures'),
     
     # API Procedure - Scrittura (Upload tradizionale)
     path('api/upload/', views.upload_procedure_file, name='upload_procedure'),
+    path('api/import/', views.import_procedures, name='import_procedures'),
     path('api/category/<int:category_id>/update/', views.update_procedure_category, name='update_category'),
     path('api/category/<int:category_id>/delete/', views.delete_procedure_category, name='delete_category'),
     path('api/category/<int:category_id>/update-file/', views.update_procedure_file, name='update_file'),
     path('api/category/<int:category_id>/update-command/', views.update_single_command, name='update_single_command'),
+    path('api/category/<int:category_id>/update-commands/', views.update_commands_batch, name='update_commands_batch'),
     
     # API Ricerca Full-Text
-    path('api/search/', views.search_procedures, name='search_procedures'),
+    path('api/search/', io_views.search_procedures, name='search_procedures'),
+    path('api/suggest/', views.suggest_procedures, name='suggest_procedures'),
+
+    # API Eventi (aggiornamento della dashboard)
+    path('api/events/', io_views.procedure_events, name='procedure_events'),
+    
+    # API Diagnostica (solo Admin)
+    path('api/stats/parse-cache/', views.parse_cache_stats, name='parse_cache_stats'),
 ]
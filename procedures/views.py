@@ -1,11 +1,16 @@
 from django.shortcuts import render
-from django.http import JsonResponse, FileResponse, Http404 
+from django.http import JsonResponse, FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
+from django.utils.cache import patch_vary_headers
 from .models import ProcedureCategory
 from .decorators import role_required, ajax_login_required, can_edit_procedure, can_delete_procedure
+from .procedure_cache import parsed_procedures
+from .parsing import sections_to_dicts
+from .html_format import convert_html_to_procedure_format
+from .suggest import suggest_index
+from . import api, conditional, downloads, events, export, importing, offsets, patching, precompressed, search
 import os
 import json
 import mimetypes
@@ -14,15 +19,7 @@ import mimetypes
 def dashboard(request):
     """Vista principale della dashboard"""
     # Filtra le categorie in base ai permessi
-    if request.user.is_superuser or (hasattr(request.user, 'profile') and request.user.profile.role == 'admin'):
-        # Admin vede tutto
-        categories = ProcedureCategory.objects.all()
-    else:
-        # Altri vedono solo pubbliche o proprie
-        categories = ProcedureCategory.objects.filter(
-            is_public=True
-        ) | ProcedureCategory.objects.filter(owner=request.user)
-        categories = categories.distinct()
+    categories = api.visible_categories(request.user)
     
     # Aggiungi informazioni sui permessi per ogni categoria
     categories_with_perms = []
@@ -35,125 +32,59 @@ def dashboard(request):
     
     return render(request, 'procedures/dashboard.html', {
         'categories': categories_with_perms,
-        'user': request.user
+        'user': request.user,
+        # Versione da cui la pagina riceve gli aggiornamenti (api/events/)
+        'events_version': events.latest_version(),
+        'events_retry_ms': int(events.retry_interval() * 1000)
     })
 
 
-def highlight_text(text, query):
-    """Evidenzia le occorrenze di query nel testo con tag <mark>"""
-    if not text or not query:
-        return text
-    
-    import re
-    # Escape caratteri speciali regex
-    escaped_query = re.escape(query)
-    # Case-insensitive replace con tag <mark>
-    pattern = re.compile(f'({escaped_query})', re.IGNORECASE)
-    highlighted = pattern.sub(r'<mark class="highlight">\1</mark>', text)
-    return highlighted
-
-
 @ajax_login_required
 def search_procedures(request):
-    """API per ricerca full-text nelle procedure"""
+    """API per ricerca full-text nelle procedure, con risultati ordinati per rilevanza e paginati"""
     try:
-        query = request.GET.get('q', '').strip()
-        
-        if not query or len(query) < 2:
-            return JsonResponse({
-                'success': False,
-                'message': 'Query troppo corta (minimo 2 caratteri)'
-            })
+        error, params = api.search_params(request)
+        if error:
+            return error
         
         # Determina quali categorie l'utente può vedere
-        if request.user.is_superuser or (hasattr(request.user, 'profile') and request.user.profile.role == 'admin'):
-            categories = ProcedureCategory.objects.all()
-        else:
-            categories = ProcedureCategory.objects.filter(
-                Q(is_public=True) | Q(owner=request.user)
-            ).distinct()
-        
-        results = []
+        categories = api.visible_categories(request.user)
         
-        # Cerca nelle categorie
-        matching_categories = categories.filter(
-            Q(name__icontains=query) | 
-            Q(description__icontains=query)
+        found = search.cached_search(
+            categories, params['compiled'], params['limit'], params['offset'],
+            params['highlight'], params['fuzzy']
         )
         
-        for cat in matching_categories:
-            results.append({
-                'type': 'category',
-                'category_id': cat.id,
-                'category_name': highlight_text(cat.name, query),
-                'icon': cat.icon,
-                'description': highlight_text(cat.description, query),
-                'match_type': 'metadata',
-                'owner': cat.owner.username if cat.owner else None
-            })
+        return api.search_response(params, found)
+    
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@ajax_login_required
+def suggest_procedures(request):
+    """API per i suggerimenti durante la digitazione (prefissi di categorie, sezioni e comandi)"""
+    try:
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({'success': True, 'query': query, 'suggestions': []})
         
-        # Cerca nei file di contenuto
-        for cat in categories:
-            try:
-                file_path = os.path.join(settings.PROCEDURE_FILES_DIR, cat.filename)
-                if os.path.exists(file_path):
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    # Cerca nel contenuto
-                    if query.lower() in content.lower():
-                        # Trova le sezioni che contengono la query
-                        sections = parse_procedure_file(content)
-                        matching_sections = []
-                        
-                        for section in sections:
-                            section_match = False
-                            matching_commands = []
-                            
-                            # Cerca nel titolo e descrizione della sezione
-                            if query.lower() in section['title'].lower() or query.lower() in section['desc'].lower():
-                                section_match = True
-                            
-                            # Cerca nei comandi
-                            for cmd in section['commands']:
-                                if query.lower() in cmd['label'].lower() or query.lower() in cmd['cmd'].lower():
-                                    matching_commands.append(cmd)
-                        
-                            if section_match or matching_commands:
-                                matching_sections.append({
-                                    'title': highlight_text(section['title'], query),
-                                    'desc': highlight_text(section['desc'], query),
-                                    'has_match': True,
-                                    'matching_commands': len(matching_commands),
-                                    'commands': [
-                                        {
-                                            'label': highlight_text(cmd['label'], query),
-                                            'cmd': highlight_text(cmd['cmd'], query)
-                                        }
-                                        for cmd in matching_commands
-                                    ]
-                                })
-
-                        if matching_sections:
-                            results.append({
-                                'type': 'content',
-                                'category_id': cat.id,
-                                'category_name': highlight_text(cat.name, query),
-                                'icon': cat.icon,
-                                'match_type': 'content',
-                                'sections': matching_sections,
-                                'owner': cat.owner.username if cat.owner else None
-                            })
-            
-            except Exception as e:
-                # Ignora errori di lettura file singoli
-                continue
+        try:
+            limit = int(request.GET.get('limit', 8))
+        except ValueError:
+            return JsonResponse({'error': 'Parametro limit non valido'}, status=400)
+        if limit < 1:
+            return JsonResponse({'error': 'Parametro limit non valido'}, status=400)
+        limit = min(limit, 20)
+        
+        # Una sola query per richiesta: la versione del corpus. Visibilità e
+        # owner delle categorie sono nell'indice, aggiornati insieme ai suggerimenti
+        suggest_index.refresh(events.latest_version())
+        visible_ids = suggest_index.visible_ids(request.user.id, api.sees_all_procedures(request.user))
         
         return JsonResponse({
             'success': True,
             'query': query,
-            'results': results,
-            'total': len(results)
+            'suggestions': suggest_index.lookup(query, visible_ids, limit)
         })
     
     except Exception as e:
@@ -163,43 +94,233 @@ def search_procedures(request):
 def get_procedure_content(request, filename):
     """API per ottenere il contenuto di un file di procedura"""
     try:
-        file_path = os.path.join(settings.PROCEDURE_FILES_DIR, filename)
+        error, can_edit = api.procedure_file_access(request.user, filename)
+        if error:
+            return error
         
-        # Verifica che il file esista e sia nella cartella corretta
-        if not os.path.exists(file_path):
-            return JsonResponse({'error': 'File non trovato'}, status=404)
+        # Se il client ha già questa versione si risponde 304 senza parsare il file
+        encoding = precompressed.negotiate(request)
+        etag, last_modified = api.procedure_validators(filename, can_edit, encoding)
+        response = conditional.not_modified(request, etag, last_modified, vary=('Accept-Encoding',))
+        if response is not None:
+            return response
         
-        # Verifica che il percorso sia sicuro (previene path traversal)
-        if not os.path.abspath(file_path).startswith(str(settings.PROCEDURE_FILES_DIR)):
-            return JsonResponse({'error': 'Accesso negato'}, status=403)
+        # Sezioni parsate (dalla cache se il file non è cambiato)
+        sections = parsed_procedures.get(filename)
         
-        # Trova la categoria associata al file per verificare i permessi
-        try:
-            category = ProcedureCategory.objects.get(filename=filename)
-            # L'utente può modificare se è admin o se è l'owner
-            can_edit = (
-                request.user.is_authenticated and 
-                (request.user.profile.role == 'admin' or 
-                 (request.user.profile.role == 'editor' and category.owner == request.user))
-            )
-        except ProcedureCategory.DoesNotExist:
-            can_edit = False
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Parsa il contenuto del file
-        sections = parse_procedure_file(content)
+        response = conditional.set_validators(JsonResponse({
+            'success': True,
+            'sections': sections_to_dicts(sections),
+            'can_edit': can_edit
+        }), etag, last_modified)
+        # Corpo compresso una sola volta per versione del contenuto
+        return precompressed.compress_response(response, filename, encoding)
+    
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@ajax_login_required
+def get_procedure_toc(request, filename):
+    """API per l'indice di una procedura: versione del file, id e titoli delle sezioni e numero di comandi"""
+    try:
+        error, can_edit = api.procedure_file_access(request.user, filename)
+        if error:
+            return error
         
-        return JsonResponse({
+        encoding = precompressed.negotiate(request)
+        etag, last_modified = api.procedure_validators(filename, can_edit, encoding)
+        response = conditional.not_modified(request, etag, last_modified, vary=('Accept-Encoding',))
+        if response is not None:
+            return response
+        
+        version, sections = offsets.table_of_contents(filename)
+        
+        response = conditional.set_validators(JsonResponse({
             'success': True,
+            'version': version,
             'sections': sections,
             'can_edit': can_edit
-        })
+        }), etag, last_modified)
+        return precompressed.compress_response(response, filename, encoding)
+    
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@ajax_login_required
+def get_procedure_section(request, filename, index):
+    """API per il contenuto di una singola sezione, letta dal file con una seek"""
+    try:
+        error, can_edit = api.procedure_file_access(request.user, filename)
+        if error:
+            return error
+        
+        encoding = precompressed.negotiate(request)
+        etag, last_modified = api.procedure_validators(filename, can_edit, encoding)
+        response = conditional.not_modified(request, etag, last_modified, vary=('Accept-Encoding',))
+        if response is not None:
+            return response
+        
+        try:
+            section = offsets.read_section(filename, index)
+        except IndexError:
+            return JsonResponse({'error': 'Sezione non trovata'}, status=404)
+        
+        response = conditional.set_validators(JsonResponse({
+            'success': True,
+            'index': index,
+            'section': section.to_dict(),
+            'can_edit': can_edit
+        }), etag, last_modified)
+        return precompressed.compress_response(response, filename, encoding)
     
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+@ajax_login_required
+def get_procedures_batch(request):
+    """
+    API per il contenuto di più procedure in una sola richiesta: ?ids=1,2,3.
+    Un'unica query per i permessi; i file non in cache vengono letti in parallelo.
+    Il JSON delle procedure incluse non supera PROCEDURE_BATCH_MAX_BYTES: quelle
+    che non ci stanno, anche da sole, sono elencate in 'omitted' e vanno
+    richieste singolarmente.
+    """
+    try:
+        ids = []
+        try:
+            for value in request.GET.getlist('ids'):
+                ids.extend(int(part) for part in value.split(',') if part.strip())
+        except ValueError:
+            return JsonResponse({'error': 'Parametro ids non valido'}, status=400)
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return JsonResponse({'error': 'Nessuna procedura indicata'}, status=400)
+        max_ids = getattr(settings, 'PROCEDURE_BATCH_MAX_IDS', 20)
+        if len(ids) > max_ids:
+            return JsonResponse({'error': f'Massimo {max_ids} procedure per richiesta'}, status=400)
+        
+        # Una sola query per tutte le categorie visibili all'utente
+        categories = {cat.id: cat for cat in api.visible_categories(request.user).filter(id__in=ids)}
+        
+        # Prima selezione sulla dimensione dei file, per non leggere procedure
+        # che non possono rientrare nel limite
+        max_bytes = getattr(settings, 'PROCEDURE_BATCH_MAX_BYTES', 4 * 1024 * 1024)
+        selected = []
+        omitted = []
+        total = 0
+        for category_id in ids:
+            category = categories.get(category_id)
+            if category is None:
+                continue
+            try:
+                size = os.path.getsize(os.path.join(settings.PROCEDURE_FILES_DIR, category.filename))
+            except OSError:
+                continue
+            if total + size > max_bytes:
+                omitted.append(category_id)
+                continue
+            selected.append(category)
+            total += size
+        
+        # Sezioni parsate: dalla cache o lette in parallelo
+        loaded = parsed_procedures.get_many(
+            [category.filename for category in selected], executor=search.get_scan_executor()
+        )
+        
+        # Il limite vale sul JSON inviato: ogni procedura viene serializzata una
+        # sola volta e il corpo della risposta è composto dai pezzi già pronti
+        procedures = []
+        returned = set()
+        total = 0
+        for category in selected:
+            if category.filename not in loaded:
+                continue
+            encoded = json.dumps({
+                'id': category.id,
+                'name': category.name,
+                'icon': category.icon,
+                'filename': category.filename,
+                'sections': sections_to_dicts(loaded[category.filename]),
+                'can_edit': api.user_can_edit(request.user, category)
+            })
+            size = len(encoded.encode('utf-8'))
+            if total + size > max_bytes:
+                omitted.append(category.id)
+                continue
+            procedures.append(encoded)
+            returned.add(category.id)
+            total += size
+        
+        not_found = [i for i in ids if i not in returned and i not in omitted]
+        omitted.sort(key=ids.index)
+        body = '{"success": true, "procedures": [%s], "not_found": %s, "omitted": %s}' % (
+            ', '.join(procedures), json.dumps(not_found), json.dumps(omitted)
+        )
+        return HttpResponse(body, content_type='application/json')
+    
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@ajax_login_required
+def procedure_events(request):
+    """
+    API degli eventi di modifica delle procedure (vedi events.py): server-sent
+    events se il client li chiede (Accept: text/event-stream), altrimenti JSON
+    per il polling con ?since=<versione>. Senza versione ritorna solo quella attuale.
+    Con WSGI lo stream invia gli eventi in attesa e si chiude, indicando a
+    EventSource dopo quanto riconnettersi: nessun worker resta occupato.
+    """
+    try:
+        since = api.events_since(request)
+    except ValueError:
+        return JsonResponse({'error': 'Versione non valida'}, status=400)
+
+    try:
+        if since is None:
+            batch = {'version': events.latest_version(), 'events': [], 'reset': False, 'has_more': False}
+        else:
+            batch = events.pending(request.user, api.visible_categories(request.user), since)
+
+        if api.wants_event_stream(request):
+            retry = 0 if batch['has_more'] else int(events.retry_interval() * 1000)
+            return api.event_stream_headers(HttpResponse(
+                f'retry: {retry}\n\n' + events.sse(batch, since), content_type='text/event-stream'
+            ))
+        return JsonResponse({'success': True, **batch})
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@role_required('admin')
+def parse_cache_stats(request):
+    """API per i contatori della cache delle procedure parsate (per processo)"""
+    return JsonResponse({
+        'success': True,
+        'pid': os.getpid(),
+        'stats': parsed_procedures.stats()
+    })
+
+@role_required('admin')
+def export_procedures(request):
+    """
+    API per esportare tutte le procedure visibili come archivio zip o tar.gz
+    (?format=zip|tar.gz) con manifest.json dei metadati. L'archivio è
+    generato in streaming, senza costruirlo in memoria o su disco.
+    """
+    fmt = request.GET.get('format', 'zip')
+    if fmt not in export.FORMATS:
+        return JsonResponse({'error': f'Formato non valido: usa {", ".join(export.FORMATS)}'}, status=400)
+
+    try:
+        categories = api.visible_categories(request.user).select_related('owner')
+        response = StreamingHttpResponse(export.stream(categories, fmt), content_type=export.FORMATS[fmt][0])
+        response['Content-Disposition'] = f'attachment; filename="{export.archive_name(fmt)}"'
+        response['Cache-Control'] = 'no-store'
+        return response
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
 @role_required('admin', 'editor')
 def upload_procedure_file(request):
     """API per caricare un nuovo file di procedura"""
@@ -218,8 +339,7 @@ def upload_procedure_file(request):
             return JsonResponse({'error': 'Solo file .txt sono consentiti'}, status=400)
         
         # Sanitizza il nome del file
-        filename = uploaded_file.name.replace(' ', '_')
-        filename = ''.join(c for c in filename if c.isalnum() or c in '._-')
+        filename = importing.safe_filename(uploaded_file.name)
         
         # Verifica che il file non esista già
         file_path = os.path.join(settings.PROCEDURE_FILES_DIR, filename)
@@ -265,6 +385,46 @@ def upload_procedure_file(request):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+@role_required('admin', 'editor')
+def import_procedures(request):
+    """
+    API per importare un archivio (zip, tar o tar.gz) di file di procedura,
+    con manifest.json opzionale dei metadati. I file non validi o già
+    esistenti vengono saltati e riportati in 'skipped'.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Metodo non consentito'}, status=405)
+
+    try:
+        if 'archive' not in request.FILES:
+            return JsonResponse({'error': 'Nessun archivio caricato'}, status=400)
+
+        is_public = request.POST.get('is_public', 'true').lower() == 'true'
+        categories, skipped = importing.import_archive(
+            request.FILES['archive'], owner=request.user, is_public=is_public
+        )
+
+        return JsonResponse({
+            'success': True,
+            'message': f'{len(categories)} procedure importate',
+            'created': [
+                {
+                    'id': category.id,
+                    'name': category.name,
+                    'icon': category.icon,
+                    'filename': category.filename,
+                    'is_public': category.is_public
+                }
+                for category in categories
+            ],
+            'skipped': skipped
+        })
+
+    except importing.ArchiveError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
 @role_required('admin', 'editor')
 def create_procedure_wysiwyg(request):
     """API per creare una nuova procedura usando l'editor WYSIWYG"""
@@ -332,13 +492,20 @@ def create_procedure_wysiwyg(request):
 
 @can_edit_procedure
 def update_procedure_wysiwyg(request, category_id):
-    """API per aggiornare una procedura usando l'editor WYSIWYG"""
+    """
+    API per aggiornare una procedura usando l'editor WYSIWYG.
+    Con 'sections' e 'base_version' salva solo le sezioni modificate (vedi
+    _update_procedure_sections), altrimenti 'content' sostituisce l'intero file.
+    """
     if request.method != 'POST':
         return JsonResponse({'error': 'Metodo non consentito'}, status=405)
     
     try:
         category = ProcedureCategory.objects.get(id=category_id)
         
+        if 'sections' in request.POST:
+            return _update_procedure_sections(request, category)
+        
         # Ottieni i dati
         html_content = request.POST.get('content', '')
         
@@ -350,8 +517,11 @@ def update_procedure_wysiwyg(request, category_id):
         
         # Sovrascrivi il file esistente
         file_path = os.path.join(settings.PROCEDURE_FILES_DIR, category.filename)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(txt_content)
+        # Scrittura atomica: le letture in corso non vedono un file scritto a metà
+        patching.replace_file(file_path, lambda f: f.write(txt_content.encode('utf-8')))
+        
+        # Aggiorna updated_at: il post_save notifica la modifica (indice, cache, suggerimenti)
+        category.save(update_fields=['updated_at'])
         
         return JsonResponse({
             'success': True,
@@ -363,85 +533,58 @@ def update_procedure_wysiwyg(request, category_id):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
-def convert_html_to_procedure_format(html_content):
-    """Converte contenuto HTML dell'editor in formato procedura .txt"""
-    from html.parser import HTMLParser
+def _update_procedure_sections(request, category):
+    """
+    Salvataggio incrementale dall'editor WYSIWYG.
+    POST 'base_version': versione del file su cui si basano le modifiche (da /toc/);
+    'sections': JSON [{"id": id sezione o null, "content": HTML}]. L'HTML
+    sostituisce la sezione con quell'id (vuoto la elimina); con id null le
+    sezioni vengono aggiunte in fondo.
+    """
+    base_version = request.POST.get('base_version')
+    if not base_version:
+        return JsonResponse({'error': 'Versione di partenza obbligatoria'}, status=400)
     
-    class ProcedureHTMLParser(HTMLParser):
-        def __init__(self):
-            super().__init__()
-            self.sections = []
-            self.current_section = None
-            self.current_command = None
-            self.in_section_title = False
-            self.in_section_desc = False
-            self.in_command_label = False
-            self.in_command_code = False
-            self.text_buffer = []
-        
-        def handle_starttag(self, tag, attrs):
-            attrs_dict = dict(attrs)
-            
-            if tag == 'h2':
-                self.in_section_title = True
-                if self.current_section:
-                    self.sections.append(self.current_section)
-                self.current_section = {'title': '', 'desc': '', 'commands': []}
-            elif tag == 'p' and self.current_section and not self.current_section['desc']:
-                self.in_section_desc = True
-            elif tag == 'h3':
-                self.in_command_label = True
-                self.current_command = {'label': '', 'cmd': ''}
-            elif tag == 'pre' or tag == 'code':
-                self.in_command_code = True
-        
-        def handle_endtag(self, tag):
-            if tag == 'h2':
-                self.in_section_title = False
-            elif tag == 'p':
-                self.in_section_desc = False
-            elif tag == 'h3':
-                self.in_command_label = False
-            elif tag == 'pre' or tag == 'code':
-                self.in_command_code = False
-                if self.current_command and self.current_section:
-                    self.current_section['commands'].append(self.current_command)
-                    self.current_command = None
-        
-        def handle_data(self, data):
-            data = data.strip()
-            if not data:
-                return
-            
-            if self.in_section_title and self.current_section is not None:
-                self.current_section['title'] += data
-            elif self.in_section_desc and self.current_section is not None:
-                self.current_section['desc'] += data
-            elif self.in_command_label and self.current_command is not None:
-                self.current_command['label'] += data
-            elif self.in_command_code and self.current_command is not None:
-                self.current_command['cmd'] += data
+    try:
+        changes = json.loads(request.POST['sections'])
+    except ValueError:
+        return JsonResponse({'error': 'JSON non valido'}, status=400)
+    if not isinstance(changes, list) or not all(
+        isinstance(change, dict)
+        and isinstance(change.get('id'), (str, type(None)))
+        and isinstance(change.get('content', ''), str)
+        for change in changes
+    ):
+        return JsonResponse({'error': 'Formato delle sezioni non valido'}, status=400)
     
-    parser = ProcedureHTMLParser()
-    parser.feed(html_content)
+    # Verifica che il file esista
+    file_path = os.path.join(settings.PROCEDURE_FILES_DIR, category.filename)
+    if not os.path.exists(file_path):
+        return JsonResponse({'error': 'File non trovato'}, status=404)
     
-    # Aggiungi l'ultima sezione
-    if parser.current_section:
-        parser.sections.append(parser.current_section)
+    # Solo l'HTML delle sezioni modificate viene convertito
+    changes = [
+        (change.get('id'), convert_html_to_procedure_format(change.get('content', '')))
+        for change in changes
+    ]
+    try:
+        version, spans = patching.replace_sections(category.filename, base_version, changes)
+    except patching.SectionNotFound as e:
+        return JsonResponse({'error': str(e)}, status=404)
+    except patching.ConcurrentModification as e:
+        return JsonResponse({'error': str(e)}, status=409)
+    except patching.PatchError as e:
+        return JsonResponse({'error': str(e)}, status=400)
     
-    # Genera formato .txt
-    txt_lines = []
-    for section in parser.sections:
-        txt_lines.append(f"[{section['title']}]")
-        txt_lines.append(section['desc'])
-        txt_lines.append('')
-        
-        for cmd in section['commands']:
-            txt_lines.append(f"COMANDO: {cmd['label']}")
-            txt_lines.append(cmd['cmd'])
-            txt_lines.append('')
+    # Aggiorna updated_at: il post_save notifica la modifica (indice, cache, suggerimenti)
+    category.save(update_fields=['updated_at'])
     
-    return '\n'.join(txt_lines)
+    return JsonResponse({
+        'success': True,
+        'message': 'Procedura aggiornata con successo',
+        'version': version,
+        'sections': offsets.toc_entries(spans)
+    })
 
 @can_edit_procedure
 def update_procedure_category(request, category_id):
@@ -531,9 +674,15 @@ def update_procedure_file(request, category_id):
         
         # Sovrascrivi il file esistente
         file_path = os.path.join(settings.PROCEDURE_FILES_DIR, category.filename)
-        with open(file_path, 'wb+') as destination:
+        # Scrittura atomica: le letture in corso non vedono un file scritto a metà
+        def write(destination):
             for chunk in uploaded_file.chunks():
                 destination.write(chunk)
+
+        patching.replace_file(file_path, write)
+        
+        # Aggiorna updated_at: il post_save notifica la modifica (indice, cache, suggerimenti)
+        category.save(update_fields=['updated_at'])
         
         return JsonResponse({
             'success': True,
@@ -545,122 +694,83 @@ def update_procedure_file(request, category_id):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
-def parse_procedure_file(content):
-    """
-    Parsa un file di procedura con formato specifico.
-    Supporta comandi su più righe fino alla prossima sezione o comando.
-
-    Formato:
-    [SEZIONE]
-    Descrizione sezione
-
-    COMANDO: Descrizione comando
-    comando riga 1
-    comando riga 2
-    comando riga 3
-
-    COMANDO: Altro comando
-    altro comando
-    """
-    sections = []
-    current_section = None
-    lines = content.strip().split('\n')
-    i = 0
-
-    while i < len(lines):
-        line = lines[i].strip()
-
-        # Nuova sezione
-        if line.startswith('[') and line.endswith(']'):
-            # Salva la sezione precedente se esiste
-            if current_section:
-                sections.append(current_section)
-
-            section_name = line[1:-1]
-            i += 1
-            # Leggi la descrizione della sezione (prossima riga non vuota)
-            section_desc = ''
-            while i < len(lines) and not lines[i].strip():
-                i += 1
-            if i < len(lines):
-                section_desc = lines[i].strip()
-
-            current_section = {
-                'title': section_name,
-                'desc': section_desc,
-                'commands': []
-            }
-
-        # Nuovo comando
-        elif line.startswith('COMANDO:'):
-            label = line.replace('COMANDO:', '').strip()
-            i += 1
-
-            # Raccogli tutte le righe del comando fino al prossimo COMANDO: o [SEZIONE]
-            cmd_lines = []
-            while i < len(lines):
-                next_line = lines[i].strip()
-
-                # Stop se troviamo una nuova sezione o comando
-                if (next_line.startswith('[') and next_line.endswith(']')) or \
-                   next_line.startswith('COMANDO:'):
-                    break
-
-                # Aggiungi la riga (anche se vuota, per mantenere la formattazione)
-                cmd_lines.append(lines[i].rstrip())
-                i += 1
-
-            # Unisci le righe mantenendo i newline
-            cmd = '\n'.join(cmd_lines).strip()
-
-            if current_section and cmd:
-                current_section['commands'].append({
-                    'label': label,
-                    'cmd': cmd
-                })
-
-            # Decrementa i perché il while principale lo incrementerà
-            i -= 1
-
-        i += 1
-
-    # Aggiungi l'ultima sezione se esiste
-    if current_section:
-        sections.append(current_section)
-
-    return sections
-
 @ajax_login_required
 def download_procedure_file(request, category_id):
-    """API per scaricare il file di procedura"""
+    """
+    API per scaricare il file di procedura. Il file è inviato dal worker
+    (con supporto Range) o, con PROCEDURE_DOWNLOAD_MODE='x-accel', da nginx.
+    """
     try:
         category = ProcedureCategory.objects.get(id=category_id)
         file_path = os.path.join(settings.PROCEDURE_FILES_DIR, category.filename)
 
+        # Verifica permessi: stesse procedure visibili nella dashboard
+        if not api.visible_categories(request.user).filter(id=category.id).exists():
+            raise Http404("Categoria non trovata")
+
         # Verifica che il file esista
         if not os.path.exists(file_path):
             raise Http404("File non trovato")
 
         # Verifica sicurezza path
-        if not os.path.abspath(file_path).startswith(str(settings.PROCEDURE_FILES_DIR)):
+        if not api.is_inside_files_dir(file_path):
             raise Http404("Accesso negato")
 
-        # Apri il file e preparalo per il download
-        file_handle = open(file_path, 'rb')
-
         # Determina il mime type
         mime_type, _ = mimetypes.guess_type(file_path)
         if mime_type is None:
             mime_type = 'text/plain'
 
-        # Crea response con il file
-        response = FileResponse(file_handle, content_type=mime_type)
+        if downloads.mode() == 'x-accel':
+            # nginx invia il file (validatori, Range e compressione compresi)
+            response = downloads.accel_response(category.filename, mime_type)
+            response['Content-Disposition'] = f'attachment; filename="{category.filename}"'
+            response['Cache-Control'] = 'private, no-cache'
+            return response
+
+        # Apri il file e preparalo per il download
+        file_handle = open(file_path, 'rb')
+
+        # Se il client ha già questa versione del file si risponde 304 senza inviarlo.
+        # Le richieste Range si riferiscono sempre al file non compresso.
+        st = os.fstat(file_handle.fileno())
+        range_header = request.headers.get('Range')
+        encoding = None if range_header else precompressed.negotiate(request)
+        etag, last_modified = conditional.file_validators(st, encoding or '')
+        response = conditional.not_modified(request, etag, last_modified, vary=('Accept-Encoding',))
+        if response is not None:
+            file_handle.close()
+            return response
+
+        byte_range = None
+        if range_header and downloads.if_range_matches(request, etag, last_modified):
+            byte_range = downloads.parse_range(range_header, st.st_size)
+
+        if byte_range is not None:
+            response = downloads.range_response(file_handle, st.st_size, byte_range, mime_type)
+        else:
+            # Variante precompressa del file, se il client la accetta
+            compressed_path = precompressed.file_variant(category.filename, file_handle, st, encoding)
+            compressed = precompressed.open_variant(compressed_path) if compressed_path else None
+            if compressed:
+                file_handle.close()
+                file_handle = compressed[0]
+
+            # Crea response con il file
+            response = FileResponse(file_handle, content_type=mime_type)
+            if compressed:
+                response['Content-Encoding'] = encoding
+
         response['Content-Disposition'] = f'attachment; filename="{category.filename}"'
+        response['Accept-Ranges'] = 'bytes'
+        patch_vary_headers(response, ('Accept-Encoding',))
 
-        return response
+        return conditional.set_validators(response, etag, last_modified)
 
     except ProcedureCategory.DoesNotExist:
         raise Http404("Categoria non trovata")
+    except Http404:
+        raise
     except Exception as e:
         raise Http404(f"Errore: {str(e)}")
 
@@ -685,61 +795,84 @@ def update_single_command(request, category_id):
         if not all([section_name, command_label, new_command]):
             return JsonResponse({'success': False, 'error': 'Dati mancanti'}, status=400)
         
-        # Leggi il file
+        # Verifica che il file esista
         file_path = os.path.join(settings.PROCEDURE_FILES_DIR, category.filename)
         
         if not os.path.exists(file_path):
             return JsonResponse({'success': False, 'error': 'File non trovato'}, status=404)
         
-        with open(file_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        # Cerca e modifica il comando specifico
-        modified = False
-        current_section = None
-        i = 0
-        
-        while i < len(lines):
-            line = lines[i].strip()
-            
-            # Identifica la sezione
-            if line.startswith('[') and line.endswith(']'):
-                current_section = line[1:-1].strip()
-            
-            # Trova il comando da modificare
-            if current_section == section_name and line.startswith('COMANDO:'):
-                cmd_label = line.replace('COMANDO:', '').strip()
-                
-                if cmd_label == command_label:
-                    # Modifica le righe del comando (possono essere multilinea)
-                    i += 1
-                    # Rimuovi le vecchie righe del comando
-                    while i < len(lines) and not lines[i].strip().startswith('COMANDO:') and not lines[i].strip().startswith('['):
-                        lines.pop(i)
-                    
-                    # Inserisci il nuovo comando
-                    lines.insert(i, new_command + '\n')
-                    if i + 1 < len(lines) and lines[i + 1].strip() != '':
-                        lines.insert(i + 1, '\n')
-                    
-                    modified = True
-                    break
-            
-            i += 1
-        
-        if not modified:
-            return JsonResponse({'success': False, 'error': 'Comando non trovato'}, status=404)
-        
-        # Salva il file modificato
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.writelines(lines)
+        # Sostituisce solo le righe del comando, con una scrittura atomica
+        try:
+            command = patching.replace_command(category.filename, section_name, command_label, new_command)
+        except patching.CommandNotFound as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=404)
+        except patching.ConcurrentModification as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=409)
+        except patching.PatchError as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+        
+        # Aggiorna updated_at: il post_save notifica la modifica (indice, cache, suggerimenti)
+        category.save(update_fields=['updated_at'])
         
         return JsonResponse({
             'success': True,
-            'message': 'Comando aggiornato con successo'
+            'message': 'Comando aggiornato con successo',
+            'command': command
         })
         
     except ProcedureCategory.DoesNotExist:
         return JsonResponse({'success': False, 'error': 'Procedura non trovata'}, status=404)
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@can_edit_procedure
+def update_commands_batch(request, category_id):
+    """
+    Applica più modifiche ai comandi di una procedura con una sola scrittura.
+    Corpo JSON: {"operations": [{"op": "update"|"add"|"delete"|"reorder", "section": ..., ...}]}
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Metodo non consentito'}, status=405)
+
+    try:
+        category = ProcedureCategory.objects.get(id=category_id)
+
+        try:
+            payload = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({'error': 'JSON non valido'}, status=400)
+
+        operations = payload.get('operations') if isinstance(payload, dict) else None
+        if not isinstance(operations, list) or not operations:
+            return JsonResponse({'error': 'Nessuna operazione indicata'}, status=400)
+        if len(operations) > patching.MAX_BATCH_OPERATIONS:
+            return JsonResponse({'error': f'Massimo {patching.MAX_BATCH_OPERATIONS} operazioni per richiesta'}, status=400)
+
+        # Verifica che il file esista
+        file_path = os.path.join(settings.PROCEDURE_FILES_DIR, category.filename)
+        if not os.path.exists(file_path):
+            return JsonResponse({'error': 'File non trovato'}, status=404)
+
+        # Tutte le operazioni sono validate prima dell'unica scrittura atomica
+        try:
+            sections = patching.apply_operations(category.filename, operations)
+        except patching.CommandNotFound as e:
+            return JsonResponse({'error': str(e)}, status=404)
+        except patching.ConcurrentModification as e:
+            return JsonResponse({'error': str(e)}, status=409)
+        except patching.PatchError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        # Aggiorna updated_at: il post_save notifica la modifica (indice, cache, suggerimenti)
+        category.save(update_fields=['updated_at'])
+
+        return JsonResponse({
+            'success': True,
+            'message': f'{len(operations)} modifiche applicate con successo',
+            'sections': sections_to_dicts(sections)
+        })
+
+    except ProcedureCategory.DoesNotExist:
+        return JsonResponse({'error': 'Categoria non trovata'}, status=404)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)